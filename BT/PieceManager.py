@@ -1,28 +1,421 @@
-import os
+import time
 import logging
 import asyncio
+import threading
+from bitarray import bitarray
+from bitarray.util import zeros, ones
+from picker import PiecePicker
+from piece_buffer import PieceBuffer
+from metrics import REGISTRY
+from tracing import TRACER
 
 logger = logging.getLogger(__name__)
 
+hash_failures = REGISTRY.counter("bt_hash_failures_total", "Pieces which failed the hash check")
+wasted_bytes = REGISTRY.counter("bt_wasted_bytes_total", "Downloaded bytes thrown away, as duplicates or of pieces which failed the hash check")
+
 class PieceManager:
-    def __init__(self, total_pieces, torrent):
-        self.have_pieces = set()
+    def __init__(self, total_pieces, torrent, storage, resume=None, resume_interval=32, pick_mode="rarest",
+                 endgame_threshold=64):
+        # One bit per piece, bitwise operations replace set arithmetic on large torrents
+        self.have_pieces = zeros(total_pieces, endian='big')
         self.total_pieces = total_pieces
-        self.pieces_data = {}
-        self.downloading_pieces = set()
+        self.downloading_pieces = zeros(total_pieces, endian='big')
         self.torrent = torrent
+        self.storage = storage
+        self.total_length = storage.total_length
+        self.piece_length = torrent.get_piece_length()
+        self.downloaded = 0
+        self.uploaded = 0
+        self.picker = PiecePicker(total_pieces, mode=pick_mode)
+
+        # Pieces of at least one file which is not skipped, only these count towards completion
+        self.wanted_pieces = ones(total_pieces, endian='big')
+
+        # Pieces being downloaded, shared by all peers at block granularity so that blocks
+        # survive a peer disconnecting. Once fewer than endgame_threshold blocks are missing,
+        # blocks may be requested from several peers at once
+        self.partial_pieces = {}
+        self.endgame_threshold = endgame_threshold
+        self.endgame = False
+        self.duplicate_bytes = 0
+
+        # Pipeline state reported as metrics: pieces waiting for or being hashed, and hash failures
+        self.name = torrent.get_file_name()
+        self.verify_queue = 0
+        self.hash_failures = 0
+        self.hash_failed_bytes = 0
+
+        # Resume data is saved every resume_interval verified pieces, on the executor since it
+        # stats every file. Snapshots of have_pieces are numbered so that a slow save never
+        # overwrites a newer one
+        self.resume = resume
+        self.resume_interval = resume_interval
+        self.pieces_since_save = 0
+        self.resume_version = 0
+        self.resume_written = 0
+        self.resume_lock = threading.Lock()
         self.lock = asyncio.Lock()
+        self.completed = asyncio.Event()
+
+        # Connected exchanges, told about every piece we complete and ranked by the choker
+        self.peers = set()
+
+        # Events of pieces someone waits for to be verified and written, e.g. a stream reading them
+        self.piece_waiters = {}
 
     async def piece_complete(self, piece_index, piece_data):
 
         """
-        Adds piece data to dict containing data of all currently downloaded pieces
+        Writes a verified piece to disk and marks it as downloaded
+        """
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.storage.write_piece, piece_index, piece_data)
+
+        async with self.lock:
+            self.have_pieces[piece_index] = 1
+            self.downloading_pieces[piece_index] = 0
+            self.partial_pieces.pop(piece_index, None)
+            self.picker.complete(piece_index)
+            self.downloaded += len(piece_data)
+            self.pieces_since_save += 1
+            resume_snapshot = None
+            if self.resume is not None and self.pieces_since_save >= self.resume_interval:
+                resume_snapshot = self.get_resume_snapshot()
+            if self.has_all_wanted():
+                self.completed.set()
+
+        waiter = self.piece_waiters.pop(piece_index, None)
+        if waiter is not None:
+            waiter.set()
+
+        for peer in list(self.peers):
+            peer.send_have(piece_index)
+
+        if resume_snapshot is not None:
+            await loop.run_in_executor(None, self.write_resume, resume_snapshot)
+
+    async def wait_for_piece(self, piece_index):
+
+        """
+        Returns once a piece is verified and on disk
+        """
+
+        if self.have_pieces[piece_index]:
+            return
+        waiter = self.piece_waiters.get(piece_index)
+        if waiter is None:
+            waiter = self.piece_waiters[piece_index] = asyncio.Event()
+        await waiter.wait()
+
+    def set_file_priorities(self, priorities):
+
+        """
+        Takes the priority of every file of the torrent (PRIORITIES values). A piece gets the highest
+        priority of the files it overlaps, so pieces spanning a file boundary are downloaded if
+        either file is wanted
+        """
+
+        piece_priorities = bytearray(self.total_pieces)
+        for file, priority in zip(self.storage.files, priorities):
+            if not file["Length"] or not priority:
+                continue
+            first = file["Offset"] // self.piece_length
+            last = (file["Offset"] + file["Length"] - 1) // self.piece_length
+            for piece_index in range(first, last + 1):
+                piece_priorities[piece_index] = max(piece_priorities[piece_index], priority)
+
+        self.wanted_pieces = bitarray([priority > 0 for priority in piece_priorities], endian='big')
+        self.picker.set_priorities(piece_priorities)
+        if self.has_all_wanted():
+            self.completed.set()
+        else:
+            self.completed.clear()
+
+        for peer in self.peers:
+            peer.interest_changed = True
+
+    def has_all_wanted(self):
+        return not (self.wanted_pieces & ~self.have_pieces).any()
+
+    def set_deadlines(self, deadlines):
+
+        """
+        Has the picker download pieces by the time (time.monotonic()) they are needed, earliest
+        first. Pieces we have are left out
+        """
+
+        self.picker.set_deadlines({piece_index: deadline for piece_index, deadline in deadlines.items()
+                                   if not self.have_pieces[piece_index]})
+
+    def register_peer(self, peer):
+        self.peers.add(peer)
+
+    def unregister_peer(self, peer):
+        self.peers.discard(peer)
+
+    def is_seeding(self):
+        return self.completed.is_set()
+
+    async def read_block(self, piece_index, offset, length):
+
+        """
+        Reads a block of a piece we have back from disk to upload it
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.storage.read, piece_index * self.piece_length + offset, length)
+
+    def load_pieces(self, pieces):
+
+        """
+        Marks pieces which were verified on disk before the download started as downloaded
+        """
+
+        self.have_pieces |= pieces
+        for piece_index in pieces.search(1):
+            self.picker.complete(piece_index)
+        if self.has_all_wanted():
+            self.completed.set()
+
+    def get_pieces_length(self, pieces):
+
+        """
+        Returns the number of bytes in a set of pieces (a bitarray)
+        """
+
+        length = pieces.count() * self.piece_length
+        if self.total_pieces and pieces[-1]:
+            length -= self.total_pieces * self.piece_length - self.total_length
+        return length
+
+    def get_transfer_stats(self):
+
+        """
+        Returns the uploaded, downloaded and left byte counts reported to trackers. Only the wanted
+        pieces are left to download
+        """
+
+        return {
+            'uploaded': self.uploaded,
+            'downloaded': self.downloaded,
+            'left': self.get_pieces_length(self.wanted_pieces & ~self.have_pieces)
+        }
+
+    async def add_peer_pieces(self, pieces):
+
+        """
+        Counts the pieces of a peer's bitfield towards their availability
+        """
+
+        async with self.lock:
+            self.picker.add_peer(pieces)
+
+    async def add_peer_piece(self, piece_index, pieces):
+
+        """
+        Counts a piece of a have message towards its availability, pieces is the peer's bitfield
+        including it
         """
 
         async with self.lock:
-            self.have_pieces.add(piece_index)
-            self.downloading_pieces.discard(piece_index)
-            self.pieces_data[piece_index] = piece_data
+            self.picker.peer_has(piece_index)
+            if pieces.all():
+                self.picker.peer_completed()
+
+    async def remove_peer_pieces(self, pieces):
+        async with self.lock:
+            self.picker.remove_peer(pieces)
+
+    def get_piece_size(self, piece_index):
+        if piece_index == self.total_pieces - 1:
+            return self.total_length - piece_index * self.piece_length
+        return self.piece_length
+
+    async def request_blocks(self, peer, peer_pieces, count, suggested=None):
+
+        """
+        Hands a peer up to count blocks to request as (index, offset, length). Unrequested blocks of
+        pieces already in progress come first, those with the earliest deadline first, then blocks
+        of newly picked pieces, of those the peer suggested first within the deadlines and file
+        priorities. Blocks of pieces past their deadline are requested from a second peer. Once
+        nothing new can be picked and few blocks are missing, blocks other peers requested are
+        handed out too
+        """
+
+        async with self.lock:
+            blocks = []
+
+            partial_pieces = self.partial_pieces.values()
+            deadlines = self.picker.deadlines
+            if deadlines:
+                partial_pieces = sorted(partial_pieces, key=lambda piece: deadlines.get(piece.piece_index, float("inf")))
+
+            for piece in partial_pieces:
+                if len(blocks) >= count:
+                    return blocks
+                if piece.verifying or not peer_pieces[piece.piece_index]:
+                    continue
+                for block in piece.free_blocks():
+                    if len(blocks) >= count:
+                        break
+                    piece.add_requester(block, peer)
+                    blocks.append(piece.get_request(block))
+
+            # Suggestions (BEP 6) are usually pieces the peer has in its cache
+            while len(blocks) < count:
+                piece_index = self.picker.pick(peer_pieces, suggested)
+                if piece_index is None:
+                    break
+                blocks += self.start_piece(peer, piece_index, count - len(blocks))
+
+            if len(blocks) < count and deadlines:
+                blocks += self.request_overdue_blocks(peer, peer_pieces, count - len(blocks))
+
+            if len(blocks) < count and self.missing_blocks() <= self.endgame_threshold:
+                blocks += self.request_endgame_blocks(peer, peer_pieces, count - len(blocks))
+
+            return blocks
+
+    def start_piece(self, peer, piece_index, count):
+        self.picker.start(piece_index)
+        self.downloading_pieces[piece_index] = 1
+        piece = PieceBuffer(piece_index, self.get_piece_size(piece_index))
+        self.partial_pieces[piece_index] = piece
+        blocks = []
+        for block in range(min(piece.total_blocks, count)):
+            piece.add_requester(block, peer)
+            blocks.append(piece.get_request(block))
+        return blocks
+
+    def missing_blocks(self):
+        return sum(piece.missing_blocks() for piece in self.partial_pieces.values())
+
+    def request_endgame_blocks(self, peer, peer_pieces, count):
+
+        """
+        Returns missing blocks the peer has not requested yet, fewest requesters first
+        """
+
+        candidates = []
+        for piece in self.partial_pieces.values():
+            if piece.verifying or not peer_pieces[piece.piece_index]:
+                continue
+            for block in (~piece.received).search(1):
+                if peer not in piece.requesters[block]:
+                    candidates.append((len(piece.requesters[block]), piece, block))
+
+        if not candidates:
+            return []
+
+        if not self.endgame:
+            logger.info(f"Entering endgame with {self.missing_blocks()} blocks missing")
+            self.endgame = True
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        blocks = []
+        for _, piece, block in candidates[:count]:
+            piece.add_requester(block, peer)
+            blocks.append(piece.get_request(block))
+        return blocks
+
+    def request_overdue_blocks(self, peer, peer_pieces, count):
+
+        """
+        Returns missing blocks of pieces past their deadline which only one other peer was asked for
+        """
+
+        now = time.monotonic()
+        blocks = []
+        for piece_index, deadline in self.picker.deadlines.items():
+            piece = self.partial_pieces.get(piece_index)
+            if deadline > now or piece is None or piece.verifying or not peer_pieces[piece_index]:
+                continue
+            for block in (~piece.received).search(1):
+                if len(blocks) >= count:
+                    return blocks
+                if len(piece.requesters[block]) == 1 and peer not in piece.requesters[block]:
+                    piece.add_requester(block, peer)
+                    blocks.append(piece.get_request(block))
+        return blocks
+
+    async def block_received(self, peer, piece_index, offset, data):
+
+        """
+        Stores a block in its piece. Other peers that requested the same block are told to cancel.
+        Returns the piece once all its blocks are in and it should be verified, otherwise None
+        """
+
+        async with self.lock:
+            piece = self.partial_pieces.get(piece_index)
+            if piece is None or piece.verifying or not piece.write_block(offset, data):
+                self.add_duplicate_bytes(len(data))
+                return None
+
+            block = offset // piece.block_size
+            for other in piece.requesters[block]:
+                if other is not peer:
+                    other.cancel_block(piece_index, offset, len(data))
+            piece.clear_requesters(block)
+
+            if not piece.is_complete():
+                return None
+            piece.verifying = True
+            return piece
+
+    async def release_blocks(self, peer, blocks):
+
+        """
+        Returns blocks a peer requested but will not deliver (choke, disconnect) to the pool.
+        Blocks that already arrived are kept. Pieces nobody is working on any more are given
+        back to the picker
+        """
+
+        async with self.lock:
+            for piece_index, offset in blocks:
+                piece = self.partial_pieces.get(piece_index)
+                if piece is None:
+                    continue
+                piece.remove_requester(offset // piece.block_size, peer)
+                if piece.is_idle() and not piece.verifying:
+                    del self.partial_pieces[piece_index]
+                    self.downloading_pieces[piece_index] = 0
+                    self.picker.abort(piece_index)
+                    if TRACER.enabled:
+                        TRACER.piece_aborted(self, piece_index)
+
+    def get_resume_snapshot(self):
+        self.resume_version += 1
+        self.pieces_since_save = 0
+        return self.resume_version, self.have_pieces.copy()
+
+    def write_resume(self, snapshot):
+
+        """
+        Writes a snapshot of the pieces we have to the resume file, unless a newer one was written
+        already. Safe to call from executor threads
+        """
+
+        version, have_pieces = snapshot
+        with self.resume_lock:
+            if version <= self.resume_written:
+                return
+            try:
+                self.resume.save(have_pieces)
+                self.resume_written = version
+            except OSError as e:
+                logger.debug(f"Could not write resume file: {e}")
+
+    def save_resume(self):
+
+        """
+        Records the pieces we have in the resume file right away, when stopping
+        """
+
+        if self.resume is None:
+            return
+        self.write_resume(self.get_resume_snapshot())
 
     async def is_piece_complete(self, piece_index):
 
@@ -30,53 +423,55 @@ class PieceManager:
         Returns boolean whether piece has already been downloaded
         """
         async with self.lock:
-            return piece_index in self.have_pieces
+            return bool(self.have_pieces[piece_index])
 
     async def is_download_complete(self):
 
         """
-        Checks if we have all pieces 
+        Checks if we have all wanted pieces
         """
         async with self.lock:
-            for piece in list(self.downloading_pieces):
-                if piece in self.have_pieces:
-                    self.downloading_pieces.discard(piece)
-            logger.debug(f"{len(self.have_pieces)} and {self.total_pieces}")
-            return len(self.have_pieces) == self.total_pieces   
+            return self.has_all_wanted()
     
     async def get_missing_pieces(self):
 
         """
-        Returns a set of pieces we are missing
+        Returns a bitarray of wanted pieces we are missing and nobody is downloading
         """
 
         async with self.lock:
-            for piece in list(self.downloading_pieces):
-                if piece in self.have_pieces:
-                    self.downloading_pieces.discard(piece)
-            return set(range(self.total_pieces)) - self.have_pieces - self.downloading_pieces
+            return self.wanted_pieces & ~(self.have_pieces | self.downloading_pieces)
 
-    async def is_piece_downloading(self, piece_index):
+    async def peer_has_needed_pieces(self, peer_pieces):
 
         """
-        Returns a boolean whether a piece is currently downloading or already downloaded
+        Returns whether a peer has any wanted piece we do not have yet
         """
 
         async with self.lock:
-            if piece_index in self.downloading_pieces or piece_index in self.have_pieces:
-                return True
-            self.downloading_pieces.add(piece_index)
-            return False    
-        
-    async def piece_failed(self, piece_index):
+            return (peer_pieces & self.wanted_pieces & ~self.have_pieces).any()
+
+    def add_duplicate_bytes(self, length):
+        self.duplicate_bytes += length
+        wasted_bytes.inc(length, torrent=self.name, reason="duplicate")
+
+    async def piece_failed(self, piece_index, hash_failure=True):
 
         """
-        Acknowledge a piece as failed by removing it from downloading pieces
+        Acknowledge a piece as failed hash check (or failed to be stored), its blocks are all
+        requested again
         """
 
         async with self.lock:
-            self.downloading_pieces.discard(piece_index)
-            logger.debug(f"Piece {piece_index} marked as failed, removed from downloading set")
+            piece = self.partial_pieces.get(piece_index)
+            if piece is not None:
+                if hash_failure:
+                    self.hash_failures += 1
+                    self.hash_failed_bytes += piece.length
+                    hash_failures.inc(torrent=self.name)
+                    wasted_bytes.inc(piece.length, torrent=self.name, reason="hash_failure")
+                piece.reset()
+            logger.debug("Piece %d failed, all of its blocks will be downloaded again", piece_index)
 
     async def get_info(self):
             
@@ -86,51 +481,29 @@ class PieceManager:
 
             async with self.lock:
                 return {
-                    'have': len(self.have_pieces),
-                    'downloading': len(self.downloading_pieces),
+                    'have': self.have_pieces.count(),
+                    'downloading': self.downloading_pieces.count(),
+                    'wanted': self.wanted_pieces.count(),
                     'total': self.total_pieces,
-                    'downloading_pieces': sorted(self.downloading_pieces),
-                    'missing': self.total_pieces - len(self.have_pieces) - len(self.downloading_pieces)
+                    'downloading_pieces': list(self.downloading_pieces.search(1)),
+                    'missing': (self.wanted_pieces & ~(self.have_pieces | self.downloading_pieces)).count(),
+                    'missing_blocks': self.missing_blocks(),
+                    'endgame': self.endgame,
+                    'duplicate_bytes': self.duplicate_bytes,
+                    'hash_failures': self.hash_failures,
+                    'hash_failed_bytes': self.hash_failed_bytes
                 }
             
             
     def write_to_file(self):
 
         """
-        For multi-file torrents, this function puts all piece data into bytearray and splits data exactly so it matches each file size,
-        and creates a folder for all files
-        For single file torrents, we just write all data to file
+        Pieces are written to disk as soon as they are verified, so all that is left is closing
+        the files
         """
 
-        all_data = bytearray()
-        for data in sorted(self.pieces_data):
-                all_data.extend(self.pieces_data[data])      
-
-        if self.torrent.is_torrent_multi_file():
-            file_list = self.torrent.get_file_list()
-            offset = 0
-
-            for i in range(len(file_list)):
-                file_name = file_list[i]["Path"]
-                file_length = file_list[i]["Length"]
-
-                file_bytes = all_data[offset:offset + file_length]
-                offset += file_length
-
-                if file_bytes:
-                    folder = os.path.dirname(file_name)
-                    if folder:
-                        os.makedirs(folder, exist_ok=True)
-                    with open(file_name, 'wb') as f:
-                        f.write(file_bytes)
-                        logger.info(f"File {i}: {file_name} downloaded!")
-
-                else:        
-                    logger.info(f"File {i}: {file_name} could not be downloaded") 
-
-        else: 
-            file_name = self.torrent.get_file_name()
-            with open(file_name, 'wb') as f:
-                    f.write(all_data)
-                    logger.info(f"File: {file_name} downloaded!")
-
+        self.save_resume()
+        self.storage.close()
+        for i, file in enumerate(self.storage.files):
+            if i not in self.storage.skipped:
+                logger.info(f"File {i}: {file['Path']} downloaded!")
@@ -0,0 +1,177 @@
+class BencodeError(ValueError):
+    pass
+
+class RawValue:
+    def __init__(self, data, start, end):
+        # A value left encoded while decoding, decoded the first time it is needed
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def raw(self):
+        return self.data[self.start:self.end]
+
+    def decode(self):
+        try:
+            return Decoder(self.data).decode_plain(self.start)[0]
+        except (IndexError, ValueError, RecursionError) as e:
+            raise BencodeError(f"Malformed data: {e}") from None
+
+class Decoder:
+    def __init__(self, data, lazy_keys=()):
+        self.data = bytes(data)
+
+        # Byte span (start, end) of the value of every top-level dict key, so that e.g. the info
+        # hash is one SHA-1 over the original bytes instead of a re-encode. Values at a key path
+        # in lazy_keys, e.g. (b"info", b"files"), are skipped over and returned as RawValue
+        self.spans = {}
+        self.lazy_keys = set(lazy_keys)
+
+    def decode(self):
+        try:
+            value, end = self.decode_value(0, ())
+        except BencodeError:
+            raise
+        except (IndexError, ValueError, RecursionError) as e:
+            raise BencodeError(f"Malformed data: {e}") from None
+        if end != len(self.data):
+            raise BencodeError(f"Trailing data after position {end}")
+        return value
+
+    def decode_value(self, index, path=None):
+
+        """
+        Decodes the value starting at index and returns it with the index just past it. path is
+        the key path of a dict value while it is shallow enough to be in lazy_keys
+        """
+
+        if path is None or self.data[index] != 0x64:
+            return self.decode_plain(index)
+
+        data = self.data
+        index += 1
+        result = {}
+        while data[index] != 0x65:
+            key, index = self.decode_string(index)
+            child = path + (key,) if len(path) < 2 else None
+            start = index
+            if child in self.lazy_keys:
+                index = self.skip_value(index)
+                result[key] = RawValue(data, start, index)
+            else:
+                result[key], index = self.decode_value(index, child)
+            if path == ():
+                self.spans[key] = (start, index)
+        return result, index + 1
+
+    def decode_plain(self, index):
+
+        """
+        Decoding without span bookkeeping, the fast path used for everything below the top levels
+        """
+
+        data = self.data
+        token = data[index]
+
+        if 0x30 <= token <= 0x39:
+            colon = data.index(b":", index)
+            end = colon + 1 + int(data[index:colon])
+            if end > len(data):
+                raise BencodeError(f"String at position {index} runs past the end of the data")
+            return data[colon + 1:end], end
+
+        if token == 0x6C:  # l
+            index += 1
+            result = []
+            append = result.append
+            decode_plain = self.decode_plain
+            while data[index] != 0x65:
+                value, index = decode_plain(index)
+                append(value)
+            return result, index + 1
+
+        if token == 0x64:  # d
+            index += 1
+            result = {}
+            decode_plain = self.decode_plain
+            while data[index] != 0x65:
+                key, index = self.decode_string(index)
+                result[key], index = decode_plain(index)
+            return result, index + 1
+
+        if token == 0x69:  # i
+            end = data.index(b"e", index)
+            return int(data[index + 1:end]), end + 1
+
+        raise BencodeError(f"Unexpected byte {token!r} at position {index}")
+
+    def decode_string(self, index):
+        if not 0x30 <= self.data[index] <= 0x39:
+            raise BencodeError(f"Expected a string at position {index}")
+        colon = self.data.index(b":", index)
+        start = colon + 1
+        end = start + int(self.data[index:colon])
+        if end > len(self.data):
+            raise BencodeError(f"String at position {index} runs past the end of the data")
+        return self.data[start:end], end
+
+    def skip_value(self, index):
+
+        """
+        Returns the index just past the value starting at index, without building any objects
+        """
+
+        data = self.data
+        depth = 0
+        while True:
+            token = data[index]
+            if token == 0x64 or token == 0x6C:
+                depth += 1
+                index += 1
+            elif token == 0x65:
+                depth -= 1
+                index += 1
+            elif token == 0x69:
+                index = data.index(b"e", index) + 1
+            elif 0x30 <= token <= 0x39:
+                colon = data.index(b":", index)
+                index = colon + 1 + int(data[index:colon])
+            else:
+                raise BencodeError(f"Unexpected byte {token!r} at position {index}")
+            if depth == 0:
+                if index > len(data):
+                    raise BencodeError("Data ends inside a value")
+                return index
+
+def decode(data):
+    return Decoder(data).decode()
+
+def encode(value):
+    parts = []
+    encode_into(value, parts)
+    return b"".join(parts)
+
+def encode_into(value, parts):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value)
+        parts.append(str(len(value)).encode() + b":" + value)
+    elif isinstance(value, str):
+        encode_into(value.encode("utf-8"), parts)
+    elif isinstance(value, bool) or not isinstance(value, (int, list, tuple, dict, RawValue)):
+        raise TypeError(f"Cannot bencode {type(value).__name__}")
+    elif isinstance(value, int):
+        parts.append(b"i%de" % value)
+    elif isinstance(value, (list, tuple)):
+        parts.append(b"l")
+        for item in value:
+            encode_into(item, parts)
+        parts.append(b"e")
+    elif isinstance(value, dict):
+        parts.append(b"d")
+        items = [(key.encode("utf-8") if isinstance(key, str) else bytes(key), item) for key, item in value.items()]
+        for key, item in sorted(items, key=lambda pair: pair[0]):
+            encode_into(key, parts)
+            encode_into(item, parts)
+        parts.append(b"e")
+    else:
+        parts.append(value.raw())
@@ -0,0 +1,75 @@
+import random
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Choker:
+    def __init__(self, piece_manager, upload_slots=4, interval=10, optimistic_rounds=3):
+        self.piece_manager = piece_manager
+
+        # Tit-for-tat: every interval the upload_slots interested peers with the best rate are
+        # unchoked, plus one optimistic unchoke rotated every optimistic_rounds rounds so that
+        # new peers get a chance to show their rate
+        self.upload_slots = upload_slots
+        self.interval = interval
+        self.optimistic_rounds = optimistic_rounds
+        self.round = 0
+        self.optimistic = None
+
+        # Transfer totals of each peer at the previous round, rates are the difference
+        self.last_totals = {}
+
+    def get_rates(self, peers):
+
+        """
+        Returns each peer's rate over the last round. While downloading peers are ranked by how
+        fast they upload to us, once seeding by how fast they take data from us
+        """
+
+        seeding = self.piece_manager.is_seeding()
+        rates = {}
+        for peer in peers:
+            downloaded, uploaded = self.last_totals.get(peer, (0, 0))
+            if seeding:
+                rates[peer] = (peer.uploaded - uploaded) / self.interval
+            else:
+                rates[peer] = (peer.downloaded - downloaded) / self.interval
+        self.last_totals = {peer: (peer.downloaded, peer.uploaded) for peer in peers}
+        return rates
+
+    def choke_round(self):
+        peers = list(self.piece_manager.peers)
+        rates = self.get_rates(peers)
+        interested = [peer for peer in peers if peer.peer_interested]
+
+        if self.optimistic not in interested or self.round % self.optimistic_rounds == 0:
+            candidates = [peer for peer in interested if peer.am_choking]
+            self.optimistic = random.choice(candidates) if candidates else None
+        self.round += 1
+
+        regular = [peer for peer in interested if peer is not self.optimistic]
+        regular.sort(key=lambda peer: rates[peer], reverse=True)
+        unchoked = set(regular[:self.upload_slots])
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for peer in peers:
+            peer.set_choking(peer not in unchoked)
+        logger.debug(f"Choke round: {len(unchoked)} of {len(peers)} peers unchoked")
+
+    def peer_interested(self, peer):
+
+        """
+        Unchokes a peer that became interested right away if an upload slot is free, rather than
+        making it wait for the next round
+        """
+
+        unchoked = sum(1 for other in self.piece_manager.peers if not other.am_choking)
+        if peer.am_choking and unchoked < self.upload_slots + 1:
+            peer.set_choking(False)
+
+    async def run(self):
+        while True:
+            self.choke_round()
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,191 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class PeerCandidate:
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.failures = 0
+        self.next_attempt = 0
+        # Download rate of the last session with this peer in bytes per second, None if never connected
+        self.throughput = None
+
+    def score(self):
+
+        """
+        Peers that were fast before come first, then peers we never tried, then peers that failed
+        """
+
+        if self.throughput is not None and self.failures == 0:
+            return (0, -self.throughput)
+        if self.throughput is None and self.failures == 0:
+            return (1, 0)
+        return (2, self.failures)
+
+class ConnectionBudget:
+    def __init__(self, limit):
+        # Connection slots shared by every torrent of a session, inbound connections included
+        self.limit = limit
+        self.used = 0
+        self.waiting = set()
+
+    def acquire(self, manager=None):
+
+        """
+        Takes a slot if one is free. A manager that found none is woken once a slot is released
+        """
+
+        if self.used < self.limit:
+            self.used += 1
+            return True
+        if manager is not None:
+            self.waiting.add(manager)
+        return False
+
+    def release(self):
+        self.used -= 1
+        for manager in self.waiting:
+            manager.wakeup.set()
+        self.waiting.clear()
+
+class ConnectionManager:
+    def __init__(self, connect_peer, max_active=50, max_failures=5, base_backoff=10,
+                 reconnect_delay=5, idle_timeout=120, on_starved=None, budget=None):
+
+        # connect_peer(ip, port) runs a whole session with a peer and returns a dict with
+        # "connected" and "downloaded" (bytes)
+        self.connect_peer = connect_peer
+        self.max_active = max_active
+        self.max_failures = max_failures
+        self.base_backoff = base_backoff
+        self.reconnect_delay = reconnect_delay
+        self.idle_timeout = idle_timeout
+        self.on_starved = on_starved
+        self.budget = budget
+
+        self.peers = {}
+        self.active = {}
+        self.wakeup = asyncio.Event()
+
+    def add_peers(self, peers):
+
+        """
+        Adds peers we did not know about to the candidate pool
+        """
+
+        added = 0
+        for ip, port in peers:
+            if (ip, port) not in self.peers:
+                self.peers[(ip, port)] = PeerCandidate(ip, port)
+                added += 1
+        if added:
+            logger.debug(f"{added} new peers, {len(self.peers)} known")
+            self.wakeup.set()
+
+    def get_candidates(self, now):
+        candidates = [
+            peer for key, peer in self.peers.items()
+            if key not in self.active and peer.failures < self.max_failures and peer.next_attempt <= now
+        ]
+        candidates.sort(key=PeerCandidate.score)
+        return candidates
+
+    def next_scheduled_attempt(self, now):
+
+        """
+        Returns when the next backed off peer becomes eligible again, None if there is none
+        """
+
+        pending = [
+            peer.next_attempt for key, peer in self.peers.items()
+            if key not in self.active and peer.failures < self.max_failures and peer.next_attempt > now
+        ]
+        return min(pending) if pending else None
+
+    async def run_session(self, peer):
+        start = time.monotonic()
+        try:
+            result = await self.connect_peer(peer.ip, peer.port)
+        except Exception as e:
+            logger.debug(f"Session with {peer.ip} crashed: {e}")
+            result = None
+        duration = max(time.monotonic() - start, 1e-3)
+        self.record_result(peer, result, duration)
+
+    def record_result(self, peer, result, duration):
+
+        """
+        Scores a peer after its session ended. Peers which gave us data are reconnected soon,
+        peers which failed or had nothing for us are retried with exponential backoff
+        """
+
+        now = time.monotonic()
+        if result and result["connected"] and result["downloaded"] > 0:
+            peer.failures = 0
+            peer.throughput = result["downloaded"] / duration
+            peer.next_attempt = now + self.reconnect_delay
+            return
+
+        peer.failures += 1
+        peer.next_attempt = now + self.base_backoff * 2 ** (peer.failures - 1)
+
+    async def run(self):
+
+        """
+        Keeps up to max_active sessions running, starting the best candidate whenever a session
+        ends. Returns when no session is running and no peer became available for idle_timeout
+        """
+
+        idle_since = None
+        while True:
+            now = time.monotonic()
+            over_budget = False
+            for peer in self.get_candidates(now)[:self.max_active - len(self.active)]:
+                if self.budget is not None and not self.budget.acquire(self):
+                    over_budget = True
+                    break
+                task = asyncio.create_task(self.run_session(peer))
+                self.active[(peer.ip, peer.port)] = task
+                task.add_done_callback(lambda _, key=(peer.ip, peer.port): self.session_done(key))
+
+            next_attempt = self.next_scheduled_attempt(now)
+            timeout = None
+
+            # Waiting for other torrents to free a connection slot is not running out of peers
+            if self.active or over_budget:
+                idle_since = None
+            else:
+                if idle_since is None:
+                    idle_since = now
+                    if self.on_starved is not None:
+                        self.on_starved()
+                # Only give up once no backed off peer is left to retry either
+                if next_attempt is None:
+                    if now - idle_since >= self.idle_timeout:
+                        logger.info("Ran out of peers to connect to")
+                        return
+                    timeout = self.idle_timeout - (now - idle_since)
+
+            if next_attempt is not None:
+                delay = max(next_attempt - now, 0.05)
+                timeout = delay if timeout is None else min(timeout, delay)
+
+            self.wakeup.clear()
+            waiters = [asyncio.ensure_future(self.wakeup.wait())] + list(self.active.values())
+            try:
+                await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiters[0].cancel()
+
+    def session_done(self, key):
+        if self.active.pop(key, None) is not None and self.budget is not None:
+            self.budget.release()
+
+    async def close(self):
+        for task in list(self.active.values()):
+            task.cancel()
+        await asyncio.gather(*self.active.values(), return_exceptions=True)
+        self.active.clear()
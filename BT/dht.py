@@ -0,0 +1,500 @@
+import os
+import time
+import heapq
+import socket
+import struct
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict, deque
+import bencoding
+
+logger = logging.getLogger(__name__)
+
+# BEP 5 constants
+K = 8
+ALPHA = 3
+BOOTSTRAP_NODES = [("router.bittorrent.com", 6881), ("dht.transmissionbt.com", 6881), ("router.utorrent.com", 6881)]
+TOKEN_LIFETIME = 300
+PEER_LIFETIME = 30 * 60
+NODE_LIFETIME = 15 * 60
+
+class DHTError(Exception):
+    pass
+
+def distance(a, b):
+    return int.from_bytes(a, "big") ^ int.from_bytes(b, "big")
+
+def encode_nodes(nodes):
+    return b"".join(node.id + socket.inet_aton(node.ip) + struct.pack(">H", node.port) for node in nodes)
+
+def decode_nodes(data):
+
+    """
+    Returns the nodes of a compact node info string, 26 bytes per node (BEP 5)
+    """
+
+    nodes = []
+    if not isinstance(data, bytes):
+        return nodes
+    for i in range(0, len(data) - 25, 26):
+        port = struct.unpack(">H", data[i + 24:i + 26])[0]
+        if port:
+            nodes.append(Node(data[i:i + 20], socket.inet_ntoa(data[i + 20:i + 24]), port))
+    return nodes
+
+def decode_peers(values):
+    peers = []
+    if not isinstance(values, list):
+        return peers
+    for value in values:
+        if isinstance(value, bytes) and len(value) == 6:
+            peers.append((socket.inet_ntoa(value[:4]), struct.unpack(">H", value[4:])[0]))
+    return peers
+
+class Node:
+    def __init__(self, node_id, ip, port):
+        self.id = node_id
+        self.ip = ip
+        self.port = port
+        # Nodes we only heard of from other nodes have never been seen
+        self.last_seen = 0
+        self.failures = 0
+
+    def is_good(self, now):
+        return self.failures == 0 and now - self.last_seen < NODE_LIFETIME
+
+class RoutingTable:
+    def __init__(self, node_id, k=K, max_failures=2):
+        self.node_id = node_id
+        self.k = k
+        self.max_failures = max_failures
+
+        # Bucket i holds up to k nodes whose distance to us is 2^i to 2^(i+1)-1, least recently
+        # seen first
+        self.buckets = [OrderedDict() for _ in range(160)]
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def get_bucket(self, node_id):
+        return self.buckets[distance(self.node_id, node_id).bit_length() - 1]
+
+    def add(self, node, seen=True):
+
+        """
+        Adds a node or refreshes it. A full bucket only makes room by dropping a node that failed
+        or went quiet, since nodes which stayed up long are the most likely to stay up
+        """
+
+        if len(node.id) != 20 or node.id == self.node_id:
+            return
+        bucket = self.get_bucket(node.id)
+        known = bucket.get(node.id)
+        if known is not None:
+            if seen:
+                known.ip, known.port = node.ip, node.port
+                known.last_seen = time.monotonic()
+                known.failures = 0
+                bucket.move_to_end(node.id)
+            return
+
+        if len(bucket) >= self.k:
+            now = time.monotonic()
+            stale = next((old for old in bucket.values() if not old.is_good(now)), None)
+            if stale is None:
+                return
+            del bucket[stale.id]
+        if seen:
+            node.last_seen = time.monotonic()
+        bucket[node.id] = node
+
+    def failed(self, node_id):
+        bucket = self.get_bucket(node_id)
+        node = bucket.get(node_id)
+        if node is not None:
+            node.failures += 1
+            if node.failures >= self.max_failures:
+                del bucket[node_id]
+
+    def closest(self, target, count=K):
+        nodes = (node for bucket in self.buckets for node in bucket.values())
+        return heapq.nsmallest(count, nodes, key=lambda node: distance(node.id, target))
+
+    def save(self, path):
+        nodes = [node for bucket in self.buckets for node in bucket.values()]
+        data = {b"id": self.node_id, b"nodes": encode_nodes(nodes)}
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(bencoding.encode(data))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+
+        """
+        Returns the routing table saved by an earlier run, None if there is none
+        """
+
+        try:
+            with open(path, "rb") as f:
+                data = bencoding.decode(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.info(f"Ignoring unreadable DHT state {path}: {e}")
+            return None
+
+        node_id = data.get(b"id")
+        if not isinstance(node_id, bytes) or len(node_id) != 20:
+            return None
+        table = cls(node_id)
+        for node in decode_nodes(data.get(b"nodes", b"")):
+            table.add(node, seen=False)
+        logger.debug(f"Loaded {len(table)} DHT nodes from {path}")
+        return table
+
+class DHTProtocol(asyncio.DatagramProtocol):
+    def __init__(self, dht):
+        self.dht = dht
+
+    def datagram_received(self, data, addr):
+        self.dht.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        logger.debug(f"DHT socket error: {exc}")
+
+class DHTNode:
+    def __init__(self, port, state_path=None, bootstrap_nodes=BOOTSTRAP_NODES, alpha=ALPHA, query_timeout=2,
+                 refresh_interval=NODE_LIFETIME, max_torrents=1000, max_peers_per_torrent=100):
+        self.port = port
+        self.state_path = state_path
+        self.bootstrap_nodes = bootstrap_nodes
+        self.alpha = alpha
+        self.query_timeout = query_timeout
+        self.refresh_interval = refresh_interval
+
+        # The routing table and with it our node id survive restarts, so that we come back to the
+        # same place in the DHT and do not need the bootstrap nodes
+        table = RoutingTable.load(state_path) if state_path else None
+        self.table = table or RoutingTable(os.urandom(20))
+        self.node_id = self.table.node_id
+
+        self.transport = None
+        # Transaction id -> future waiting for the matching response
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.maintain_task = None
+
+        # Peers which announced themselves to us, by info hash. Tokens for announce_peer are a hash
+        # of the querying ip with a secret that rotates every TOKEN_LIFETIME, the previous one
+        # stays valid
+        self.stored_peers = {}
+        self.max_torrents = max_torrents
+        self.max_peers_per_torrent = max_peers_per_torrent
+        self.secret = os.urandom(16)
+        self.previous_secret = self.secret
+        self.secret_time = time.monotonic()
+
+        # Lookup latency metric, seconds of the most recent lookups
+        self.lookups = 0
+        self.lookup_times = deque(maxlen=100)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: DHTProtocol(self), local_addr=("0.0.0.0", self.port))
+        self.maintain_task = asyncio.create_task(self.maintain())
+
+    def close(self):
+        if self.maintain_task is not None:
+            self.maintain_task.cancel()
+        self.save()
+        if self.transport is not None:
+            self.transport.close()
+        for future in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+
+    def save(self):
+        if self.state_path:
+            try:
+                self.table.save(self.state_path)
+            except OSError as e:
+                logger.info(f"Could not save DHT state to {self.state_path}: {e}")
+
+    def get_stats(self):
+        times = self.lookup_times
+        return {
+            "nodes": len(self.table),
+            "lookups": self.lookups,
+            "lookup latency": sum(times) / len(times) if times else None,
+            "torrents stored": len(self.stored_peers)
+        }
+
+    async def maintain(self):
+
+        """
+        Bootstraps, then refreshes the routing table and saves it every refresh interval
+        """
+
+        while True:
+            try:
+                await self.bootstrap()
+            except Exception as e:
+                logger.debug(f"DHT bootstrap failed: {e}")
+            self.ready.set()
+            self.save()
+            await asyncio.sleep(self.refresh_interval)
+
+    async def bootstrap(self):
+
+        """
+        Fills the routing table: the bootstrap nodes are only asked if too few nodes are known from
+        the last run. Then looks up our own id, which finds the nodes closest to us
+        """
+
+        if len(self.table) < self.table.k:
+            loop = asyncio.get_running_loop()
+            addresses = []
+            for host, port in self.bootstrap_nodes:
+                try:
+                    infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                except OSError as e:
+                    logger.debug(f"Could not resolve DHT bootstrap node {host}: {e}")
+                    continue
+                if infos:
+                    addresses.append(infos[0][4][:2])
+
+            responses = await asyncio.gather(
+                *(self.query(address, b"find_node", {b"target": self.node_id}) for address in addresses),
+                return_exceptions=True
+            )
+            for response in responses:
+                if isinstance(response, dict):
+                    for node in decode_nodes(response.get(b"nodes")):
+                        self.table.add(node, seen=False)
+
+        await self.lookup(self.node_id)
+        logger.info(f"DHT routing table has {len(self.table)} nodes")
+
+    def datagram_received(self, data, addr):
+        try:
+            message = bencoding.decode(data)
+        except bencoding.BencodeError:
+            return
+        if not isinstance(message, dict) or not isinstance(message.get(b"t"), bytes):
+            return
+
+        kind = message.get(b"y")
+        if kind == b"q":
+            self.handle_query(message, addr)
+            return
+
+        future = self.pending.pop(message.get(b"t"), None)
+        if future is None or future.done():
+            return
+        if kind == b"r" and isinstance(message.get(b"r"), dict):
+            future.set_result(message[b"r"])
+        else:
+            future.set_exception(DHTError(f"Error from {addr[0]}: {message.get(b'e')}"))
+
+    def send(self, addr, message):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(bencoding.encode(message), addr)
+
+    async def query(self, addr, method, arguments):
+
+        """
+        Sends a query and returns the response dict. A node that answers goes into the routing table
+        """
+
+        transaction_id = os.urandom(2)
+        while transaction_id in self.pending:
+            transaction_id = os.urandom(2)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[transaction_id] = future
+        self.send(addr, {b"t": transaction_id, b"y": b"q", b"q": method, b"a": {b"id": self.node_id, **arguments}})
+        try:
+            async with asyncio.timeout(self.query_timeout):
+                response = await future
+        finally:
+            self.pending.pop(transaction_id, None)
+
+        node_id = response.get(b"id")
+        if not isinstance(node_id, bytes) or len(node_id) != 20:
+            raise DHTError(f"Response without a node id from {addr[0]}")
+        self.table.add(Node(node_id, addr[0], addr[1]))
+        return response
+
+    def get_token(self, ip, secret=None):
+        now = time.monotonic()
+        if now - self.secret_time >= TOKEN_LIFETIME:
+            self.previous_secret = self.secret
+            self.secret = os.urandom(16)
+            self.secret_time = now
+        return hashlib.sha1((secret or self.secret) + socket.inet_aton(ip)).digest()
+
+    def get_stored_peers(self, info_hash):
+        peers = self.stored_peers.get(info_hash)
+        if not peers:
+            return []
+        now = time.monotonic()
+        for peer in [peer for peer, announced in peers.items() if now - announced > PEER_LIFETIME]:
+            del peers[peer]
+        return [socket.inet_aton(ip) + struct.pack(">H", port) for ip, port in peers]
+
+    def store_peer(self, info_hash, ip, port):
+        peers = self.stored_peers.get(info_hash)
+        if peers is None:
+            if len(self.stored_peers) >= self.max_torrents:
+                return
+            peers = self.stored_peers[info_hash] = OrderedDict()
+        peers[(ip, port)] = time.monotonic()
+        peers.move_to_end((ip, port))
+        if len(peers) > self.max_peers_per_torrent:
+            peers.popitem(last=False)
+
+    def handle_query(self, message, addr):
+
+        """
+        Answers ping, find_node, get_peers and announce_peer queries from other nodes
+        """
+
+        transaction_id = message.get(b"t", b"")
+        method = message.get(b"q")
+        arguments = message.get(b"a")
+        if not isinstance(arguments, dict) or not isinstance(arguments.get(b"id"), bytes) or len(arguments[b"id"]) != 20:
+            self.send(addr, {b"t": transaction_id, b"y": b"e", b"e": [203, b"Protocol Error"]})
+            return
+
+        self.table.add(Node(arguments[b"id"], addr[0], addr[1]))
+        response = {b"id": self.node_id}
+
+        if method == b"ping":
+            pass
+
+        elif method in (b"find_node", b"get_peers", b"announce_peer"):
+            target = arguments.get(b"target" if method == b"find_node" else b"info_hash")
+            if not isinstance(target, bytes) or len(target) != 20:
+                self.send(addr, {b"t": transaction_id, b"y": b"e", b"e": [203, b"Protocol Error"]})
+                return
+
+            if method == b"find_node":
+                response[b"nodes"] = encode_nodes(self.table.closest(target))
+
+            elif method == b"get_peers":
+                response[b"token"] = self.get_token(addr[0])
+                values = self.get_stored_peers(target)
+                if values:
+                    response[b"values"] = values
+                else:
+                    response[b"nodes"] = encode_nodes(self.table.closest(target))
+
+            else:
+                token = arguments.get(b"token")
+                if token not in (self.get_token(addr[0]), self.get_token(addr[0], self.previous_secret)):
+                    self.send(addr, {b"t": transaction_id, b"y": b"e", b"e": [203, b"Bad token"]})
+                    return
+                port = addr[1] if arguments.get(b"implied_port") else arguments.get(b"port")
+                if not isinstance(port, int) or not 0 < port < 65536:
+                    self.send(addr, {b"t": transaction_id, b"y": b"e", b"e": [203, b"Bad port"]})
+                    return
+                self.store_peer(target, addr[0], port)
+
+        else:
+            self.send(addr, {b"t": transaction_id, b"y": b"e", b"e": [204, b"Method Unknown"]})
+            return
+
+        self.send(addr, {b"t": transaction_id, b"y": b"r", b"r": response})
+
+    async def ask(self, node, method, arguments):
+        try:
+            return node, await self.query((node.ip, node.port), method, arguments)
+        except (asyncio.TimeoutError, DHTError, OSError) as e:
+            logger.debug(f"DHT node {node.ip}:{node.port} did not answer: {e}")
+            self.table.failed(node.id)
+            return node, None
+
+    async def lookup(self, target, get_peers=False, on_peers=None):
+
+        """
+        Iterative lookup (BEP 5): queries the closest nodes we know, alpha at a time, and moves
+        closer with the nodes each answer contains, until the k closest nodes left have all
+        answered. With get_peers, peers are handed to on_peers as they arrive. Returns the closest
+        nodes that answered together with the token each gave us
+        """
+
+        start = time.monotonic()
+        method, key = (b"get_peers", b"info_hash") if get_peers else (b"find_node", b"target")
+        candidates = {node.id: node for node in self.table.closest(target)}
+        queried = set()
+        responded = {}
+        peers_found = set()
+        active = set()
+
+        try:
+            while True:
+                nearest = heapq.nsmallest(K, candidates.values(), key=lambda node: distance(node.id, target))
+                for node in nearest:
+                    if len(active) >= self.alpha:
+                        break
+                    if node.id not in queried:
+                        queried.add(node.id)
+                        active.add(asyncio.create_task(self.ask(node, method, {key: target})))
+                if not active:
+                    break
+
+                done, active = await asyncio.wait(active, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node, response = task.result()
+                    if response is None:
+                        del candidates[node.id]
+                        continue
+                    responded[node.id] = (node, response.get(b"token"))
+
+                    for found in decode_nodes(response.get(b"nodes")):
+                        if found.id != self.node_id and found.id not in queried:
+                            candidates.setdefault(found.id, found)
+
+                    if get_peers:
+                        peers = [peer for peer in decode_peers(response.get(b"values")) if peer not in peers_found]
+                        peers_found.update(peers)
+                        if peers and on_peers is not None:
+                            on_peers(peers)
+
+        finally:
+            for task in active:
+                task.cancel()
+
+        elapsed = time.monotonic() - start
+        self.lookups += 1
+        self.lookup_times.append(elapsed)
+        logger.debug(f"DHT lookup of {target.hex()} took {elapsed:.2f}s, {len(responded)} nodes answered, "
+                     f"{len(peers_found)} peers found")
+
+        return heapq.nsmallest(K, responded.values(), key=lambda entry: distance(entry[0].id, target))
+
+    async def announce(self, info_hash, port, on_peers=None):
+
+        """
+        Looks up peers of a torrent and announces that we are downloading it on port to the
+        closest nodes
+        """
+
+        closest = await self.lookup(info_hash, get_peers=True, on_peers=on_peers)
+        await asyncio.gather(*(
+            self.ask(node, b"announce_peer", {b"info_hash": info_hash, b"port": port, b"token": token})
+            for node, token in closest if isinstance(token, bytes)
+        ))
+
+    async def run_announces(self, info_hash, port, on_peers, interval=NODE_LIFETIME):
+
+        """
+        Announces a torrent once the routing table is ready, and again every interval
+        """
+
+        await self.ready.wait()
+        while True:
+            await self.announce(info_hash, port, on_peers)
+            await asyncio.sleep(interval)
@@ -1,161 +1,527 @@
-import math
+import time
+import struct
 import hashlib
 import logging
 import asyncio
+from collections import deque
+from bitarray import bitarray
+from bitarray.util import zeros
+from framer import MessageFramer
+import bencoding
+from metadata import (EXTENDED_MESSAGE_ID, EXTENDED_HANDSHAKE_ID, UT_METADATA_ID, UT_PEX_ID, METADATA_REQUEST,
+                      get_extended_handshake, parse_metadata_message, get_metadata_piece_message)
+from fast import (SUGGEST_PIECE, HAVE_ALL, HAVE_NONE, REJECT_REQUEST, ALLOWED_FAST, MAX_FAST_PIECES,
+                  generate_allowed_fast)
+from pex import PEX_INTERVAL, MAX_PEX_PEERS, PEX_SEED, PEX_CONNECTABLE, get_pex_message, parse_pex_message
+from tracing import TRACER, timed_hash
 
 logger = logging.getLogger(__name__)
 
 class exchange:
-    def __init__(self, info_hash, peer_id, ip, piece_length, total_pieces, last_piece_length, piece_manager, torrent, writer, reader):
+    def __init__(self, info_hash, peer_id, ip, piece_length, total_pieces, last_piece_length, piece_manager, torrent, writer, reader,
+                 min_queue=5, max_queue=250, request_queue_time=3, verify_executor=None, choker=None,
+                 keepalive_interval=60, rate_limiter=None, extensions=False, listen_port=None, peer_port=None,
+                 on_peers=None, fast=False):
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.ip = ip
 
-        self.pieces_peer_has = set()
-        self.requested_blocks = {}
+        self.pieces_peer_has = zeros(total_pieces, endian='big')
+
+        # Pipelining state: requests sent but not answered, keyed by (index, offset). Which
+        # blocks to request and the received data live in the piece manager, shared by all peers
+        self.block_size = 16384
+        self.outstanding = {}
+        self.peer_choking = True
+
+        # Request queue is resized between these bounds from the measured download rate
+        self.min_queue = min_queue
+        self.max_queue = max_queue
+        self.request_queue_time = request_queue_time
+        self.queue_size = min_queue
+        self.rate_bytes = 0
+        self.rate_start = time.monotonic()
+        self.download_rate = 0
 
         self.piece_length = piece_length
         self.total_pieces = total_pieces
         self.last_piece_length = last_piece_length
         self.piece_manager = piece_manager
         self.torrent = torrent
+        self.verify_executor = verify_executor
     
         self.writer = writer
         self.reader = reader
+        self.framer = MessageFramer(reader)
+
+        # Upload side: the peer starts out choked until the choker gives it a slot
+        self.choker = choker
+        self.am_choking = True
+        self.am_interested = False
+        self.peer_interested = False
+        self.interest_changed = True
+        self.max_request_length = 131072
+        self.uploaded = 0
+
+        # Requests from the peer are queued and served by their own task, so that waiting for
+        # upload bandwidth never holds up the messages we receive
+        self.upload_queue = deque()
+        self.max_upload_queue = 250
+        self.upload_ready = asyncio.Event()
+
+        # Downloads are paced when requests are sent, uploads before each block goes out
+        self.rate_limiter = rate_limiter
+        self.rate_limits = None
 
         self.connection_failed = False
+        self.downloaded = 0
         self.consecutive_failures = 0
         self.max_consecutive_failures = 3
 
-
-
-    async def receive_message(self):
+        # Connections where neither side is waiting for data are kept open with keep-alives
+        # and dropped once the peer has been silent for two intervals
+        self.keepalive_interval = keepalive_interval
+        self.last_received = time.monotonic()
+
+        # Extension protocol (BEP 10), used when both handshakes set the reserved bit. The peer's
+        # extended message ids by name come from its extended handshake
+        self.extensions = extensions
+        self.peer_extensions = {}
+        self.listen_port = listen_port
+
+        # Peer exchange (BEP 11), off when on_peers is None. peer_port is the port the peer accepts
+        # connections on: the one we connected to, or for peers which connected to us the one its
+        # extended handshake tells. pex_sent holds the peers we last told it about
+        self.on_peers = on_peers
+        self.peer_port = peer_port
+        self.connectable = peer_port is not None
+        self.pex_sent = set()
+        self.pex_next = 0
+        self.pex_received = None
+
+        # Fast extension (BEP 6), when both handshakes set its bit. Requests are answered or
+        # rejected explicitly, so rejected blocks go back to the pool at once. Pieces in
+        # allowed_fast_in may be requested while the peer chokes us, those in allowed_fast_out the
+        # peer may request while we choke it. rejected_pieces keeps us from asking again for
+        # pieces the peer refused, until it unchokes us anew
+        self.fast = fast
+        self.allowed_fast_in = zeros(total_pieces, endian='big')
+        self.allowed_fast_out = set()
+        self.suggested = []
+        self.rejected_pieces = zeros(total_pieces, endian='big')
+
+
+
+    async def receive_message(self, timeout=5):
 
         """ 
-        Receive bitfield message from peer after handshake which tells us which pieces peer has
+        Receive the next message from the peer through the connection's framer
         """
 
-        buffer = bytearray()
         try:
-            # Keep reading until you get first 4 bytes = message length prefix 
-            while len(buffer) < 4:
-                chunk = await asyncio.wait_for(self.reader.read(4096), timeout=5)
-                if not chunk:
-                    return None
-                buffer += chunk  
-
-            mssg_length = int.from_bytes(buffer[:4], 'big')
-
-            # Keep reading until we have the entire message
-            while len(buffer) < mssg_length + 4:
-                chunk = await asyncio.wait_for(self.reader.read(4096), timeout=5)
-
-                if not chunk:
-                    return None
-                buffer += chunk
-
-            message = buffer[4: 4 + mssg_length]
+            # asyncio.timeout, unlike wait_for on 3.11, never swallows a cancellation that
+            # arrives just as the message does
+            async with asyncio.timeout(timeout):
+                message = await self.framer.read_message()
+            self.last_received = time.monotonic()
+            if message is None:
+                logger.debug("Keep-alive from %s", self.ip)
+            return message
+
+        except (asyncio.IncompleteReadError, ValueError) as e:
+            logger.debug(f"Connection to {self.ip} unusable: {e}")
+            self.connection_failed = True
+            return None
 
-            if mssg_length == 0:
+        except asyncio.TimeoutError:
+            if not self.outstanding:
+                # Nothing is owed to us, silence only matters once the peer missed its keep-alives
+                if time.monotonic() - self.last_received >= 2 * self.keepalive_interval:
+                    logger.debug(f"{self.ip} has been silent for too long")
+                    self.connection_failed = True
+                else:
+                    self.send_message(None)
                 return None
-        
-            message_id = message[0]
-            content = message[1:]
-
-            # id should be 5 for bitfield and content is what pieces peer has (first call)
-            # id should be 7 for message and then content is message
-            return {"id": message_id, "content": content}
-        
+            logger.debug(f"Timed out waiting for blocks from {self.ip}")
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.max_consecutive_failures:
+                self.connection_failed = True
+            return None
+
         except Exception as e:
             logger.debug(f"Socket timed out in receive message function {e}")
             self.consecutive_failures += 1
             if self.consecutive_failures >= self.max_consecutive_failures:
                 self.connection_failed = True
             return None
-  
-    
-    def parse_message(self, content, limit_piece):
+
+    async def handle_message(self, response):
+
+        """
+        Updates the connection state from a message the peer sent
+        """
+
+        if response["id"] == 7:
+            await self.handle_block(response["content"])
+
+        elif response["id"] == 0:
+            # Peer drops all pending requests when it chokes us, so hand them back to the pool. With
+            # the fast extension requests in allowed fast pieces are still served
+            logger.debug(f"Choked by {self.ip}")
+            self.peer_choking = True
+            if self.fast:
+                await self.release_pieces(lambda piece_index: not self.allowed_fast_in[piece_index])
+            else:
+                await self.release_pieces()
+
+        elif response["id"] == 1:
+            logger.debug(f"Unchoked by {self.ip}")
+            self.peer_choking = False
+            self.rejected_pieces.setall(0)
+
+        elif response["id"] == 2:
+            logger.debug(f"{self.ip} is interested")
+            self.peer_interested = True
+            if self.choker is not None:
+                self.choker.peer_interested(self)
+
+        elif response["id"] == 3:
+            self.peer_interested = False
+
+        elif response["id"] == 4 and len(response["content"]) >= 4:
+            piece_index = int.from_bytes(response["content"][:4], byteorder='big')
+            if piece_index < self.total_pieces and not self.pieces_peer_has[piece_index]:
+                self.pieces_peer_has[piece_index] = 1
+                self.interest_changed = True
+                await self.piece_manager.add_peer_piece(piece_index, self.pieces_peer_has)
+
+        elif response["id"] == 5:
+            await self.piece_manager.remove_peer_pieces(self.pieces_peer_has)
+            self.parse_message(response["content"], self.total_pieces)
+            self.interest_changed = True
+            await self.piece_manager.add_peer_pieces(self.pieces_peer_has)
+
+        elif response["id"] == 6:
+            await self.handle_request(response["content"])
+
+        elif response["id"] == 8 and len(response["content"]) >= 12:
+            request = struct.unpack(">III", response["content"][:12])
+            try:
+                self.upload_queue.remove(request)
+            except ValueError:
+                pass
+            else:
+                # With the fast extension every request gets a piece or a reject
+                if self.fast:
+                    self.send_reject(*request)
+
+        elif self.fast and response["id"] in (HAVE_ALL, HAVE_NONE):
+            await self.piece_manager.remove_peer_pieces(self.pieces_peer_has)
+            self.pieces_peer_has = zeros(self.total_pieces, endian='big')
+            if response["id"] == HAVE_ALL:
+                self.pieces_peer_has.setall(1)
+                logger.debug(f"This peer has all {self.total_pieces} pieces")
+            self.interest_changed = True
+            await self.piece_manager.add_peer_pieces(self.pieces_peer_has)
+
+        elif self.fast and response["id"] == REJECT_REQUEST and len(response["content"]) >= 12:
+            piece_index, offset, length = struct.unpack(">III", response["content"][:12])
+            if self.outstanding.pop((piece_index, offset), None) is not None:
+                logger.debug(f"{self.ip} rejected block {offset} of piece {piece_index}")
+                if TRACER.enabled:
+                    TRACER.block_dropped(self, piece_index, offset)
+                self.rejected_pieces[piece_index] = 1
+                await self.piece_manager.release_blocks(self, [(piece_index, offset)])
+
+        elif self.fast and response["id"] in (ALLOWED_FAST, SUGGEST_PIECE) and len(response["content"]) >= 4:
+            piece_index = int.from_bytes(response["content"][:4], byteorder='big')
+            if piece_index >= self.total_pieces:
+                return
+            if response["id"] == ALLOWED_FAST:
+                if self.allowed_fast_in.count() < MAX_FAST_PIECES:
+                    logger.debug(f"{self.ip} allows piece {piece_index} while choking")
+                    self.allowed_fast_in[piece_index] = 1
+            elif piece_index not in self.suggested:
+                self.suggested.append(piece_index)
+                del self.suggested[:-MAX_FAST_PIECES]
+
+        elif response["id"] == EXTENDED_MESSAGE_ID and self.extensions and len(response["content"]) >= 1:
+            self.handle_extended_message(response["content"][0], bytes(response["content"][1:]))
+
+    def handle_extended_message(self, extended_id, payload):
+
+        """
+        Reads the peer's extended handshake and serves its ut_metadata requests for the info dict
+        """
+
+        try:
+            if extended_id == EXTENDED_HANDSHAKE_ID:
+                handshake = bencoding.decode(payload)
+                extensions = handshake.get(b"m", {})
+                if isinstance(extensions, dict):
+                    self.peer_extensions = extensions
+                port = handshake.get(b"p")
+                if self.peer_port is None and isinstance(port, int) and 0 < port < 65536:
+                    self.peer_port = port
+
+            elif extended_id == UT_METADATA_ID:
+                header, _ = parse_metadata_message(payload)
+                peer_metadata_id = self.peer_extensions.get(b"ut_metadata")
+                piece = header.get(b"piece")
+                if header.get(b"msg_type") == METADATA_REQUEST and peer_metadata_id and isinstance(piece, int):
+                    self.writer.write(get_metadata_piece_message(peer_metadata_id, self.torrent.raw_info, piece))
+
+            elif extended_id == UT_PEX_ID and self.on_peers is not None:
+                self.handle_pex(payload)
+
+        except (bencoding.BencodeError, AttributeError) as e:
+            logger.debug(f"Malformed extended message from {self.ip}: {e}")
+
+    def handle_pex(self, payload):
 
         """
-        Parse btifield message and store which pieces peer has (bit-shift)
+        Hands the peers the peer connected to since its last message to the connection pool, leaving
+        out peers we are connected to and, while seeding, other seeds. Dropped peers stay in the
+        pool, they may only have left this peer
         """
 
-        pieces_peer_has = set()
-        index = 0
+        now = time.monotonic()
+        if self.pex_received is not None and now - self.pex_received < PEX_INTERVAL / 2:
+            logger.debug(f"Ignoring PEX message from {self.ip}, the last one came {now - self.pex_received:.0f}s ago")
+            return
+        self.pex_received = now
+
+        added, _ = parse_pex_message(payload)
+        connected = {(peer.ip, peer.peer_port) for peer in self.piece_manager.peers}
+        seeding = self.piece_manager.is_seeding()
+        peers = [address for address, flags in added.items()
+                 if address not in connected and not (seeding and flags & PEX_SEED)]
+        if peers:
+            logger.debug(f"{len(peers)} peers from {self.ip} through PEX")
+            self.on_peers(peers)
+
+    def get_pex_flags(self):
+        flags = PEX_CONNECTABLE if self.connectable else 0
+        if self.pieces_peer_has.all():
+            flags |= PEX_SEED
+        return flags
+
+    def send_pex(self):
+
+        """
+        Tells the peer which peers we connected to and disconnected from since our last message
+        """
+
+        self.pex_next = time.monotonic() + PEX_INTERVAL
+        connected = {(peer.ip, peer.peer_port): peer for peer in self.piece_manager.peers
+                     if peer is not self and peer.peer_port is not None}
+        added = {address: peer.get_pex_flags() for address, peer in connected.items() if address not in self.pex_sent}
+        added = dict(list(added.items())[:MAX_PEX_PEERS])
+        dropped = [address for address in self.pex_sent if address not in connected][:MAX_PEX_PEERS]
+        if not added and not dropped:
+            return
+
+        self.pex_sent.update(added)
+        self.pex_sent.difference_update(dropped)
+        self.writer.write(get_pex_message(self.peer_extensions[b"ut_pex"], added, dropped))
+
+    def parse_message(self, content, limit_piece):
 
-        for byte in content:
-            for bit in range(7, -1, -1):
-                if index >= limit_piece:
-                    break
-                if ((byte >> bit) & 1) == 1:
-                    pieces_peer_has.add(index)
-                index += 1   
+        """
+        Load bitfield message straight into a bitarray of which pieces peer has, dropping spare bits
+        """
+
+        pieces_peer_has = bitarray(endian='big')
+        pieces_peer_has.frombytes(content)
+        if len(pieces_peer_has) < limit_piece:
+            pieces_peer_has.extend(zeros(limit_piece - len(pieces_peer_has)))
+        del pieces_peer_has[limit_piece:]
         self.pieces_peer_has = pieces_peer_has
-        if len(self.pieces_peer_has) == self.total_pieces:
+        if self.pieces_peer_has.all():
             logger.debug(f"This peer has all {self.total_pieces} pieces")
 
-    def get_interested_message(self):
-        return (1).to_bytes(4, 'big') + (2).to_bytes(1, 'big')
-    
-    def get_unchoke_message(self):
-        return (1).to_bytes(4, 'big') + (21).to_bytes(1, 'big')
-    
-    async def decide_interest(self):
+    async def disconnect(self):
 
         """
-        Check if peer has pieces we don't have and then send interested message and wait for unchoke message
+        Returns outstanding blocks, drops the peer's pieces from the availability counts and closes the connection
         """
-        have_pieces = set()
-        async with self.piece_manager.lock:
-            have_pieces = self.piece_manager.have_pieces.copy()
 
-        pieces_needed = self.pieces_peer_has - have_pieces
+        self.piece_manager.unregister_peer(self)
+        await self.release_pieces()
+        await self.piece_manager.remove_peer_pieces(self.pieces_peer_has)
+        self.pieces_peer_has = zeros(self.total_pieces, endian='big')
+        await self.close_connection()
 
-        if pieces_needed:
-            try:
-                self.writer.write(self.get_interested_message())
-                await self.writer.drain()  # type: ignore
+    async def close_connection(self):
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception as e:
+            logger.debug(f"Error while closing connection to {self.ip}: {e}")
 
-            except Exception as e:
-                logger.debug(f"Error sending interest to: {self.ip}: {e}")
-                self.writer.close()
-                await self.writer.wait_closed()  
-                return False
-
-            try: 
-                response = await self.reader.read(4096)
-                
-            except Exception as e:
-                logger.debug(f"Error receiving response: {e} to {self.ip}")
-                self.writer.close()
-                await self.writer.wait_closed()  
-                return False
-            
-            if len(response) >= 5 and response[4] == 1:
-                logger.debug("Peer has unchoked you.")
-                return True 
-            
-        logger.debug("This peer has no pieces we need")
-        return False
-    
-    async def request_block(self, piece_index, offset, block_size):
+    def send_message(self, message_id, payload=b""):
 
         """
-        Send request block message to peer
+        Queues a message on the connection, a message_id of None sends a keep-alive
+        """
+
+        if message_id is None:
+            message = bytes(4)
+        else:
+            message = struct.pack(">IB", 1 + len(payload), message_id) + payload
+        try:
+            self.writer.write(message)
+        except Exception as e:
+            logger.debug(f"Error sending message {message_id} to {self.ip}: {e}")
+            self.connection_failed = True
+
+    async def send_bitfield(self):
+
+        """
+        Tells the peer which pieces we have. With the fast extension, a seed or a peer without
+        pieces sends have all or have none instead, and we tell the peer its allowed fast pieces
+        """
+
+        have_pieces = self.piece_manager.have_pieces
+        if self.fast and have_pieces.all():
+            self.send_message(HAVE_ALL)
+        elif self.fast and not have_pieces.any():
+            self.send_message(HAVE_NONE)
+        elif have_pieces.any():
+            self.send_message(5, have_pieces.tobytes())
+
+        if self.fast:
+            for piece_index in generate_allowed_fast(self.ip, self.info_hash, self.total_pieces):
+                if have_pieces[piece_index]:
+                    self.allowed_fast_out.add(piece_index)
+                    self.send_message(ALLOWED_FAST, piece_index.to_bytes(4, 'big'))
+        await self.writer.drain()
+
+    def send_reject(self, piece_index, offset, length):
+        self.send_message(REJECT_REQUEST, struct.pack(">III", piece_index, offset, length))
+
+    def send_have(self, piece_index):
+
+        """
+        Tells the peer about a piece we completed, unless it already has it
         """
 
+        self.interest_changed = True
+        if not self.pieces_peer_has[piece_index]:
+            self.send_message(4, piece_index.to_bytes(4, 'big'))
+
+    def set_choking(self, choking):
+        if choking == self.am_choking:
+            return
+        self.am_choking = choking
+        self.send_message(0 if choking else 1)
+        if choking:
+            # Choking discards the peer's pending requests. With the fast extension they are
+            # rejected, except those for allowed fast pieces which are still served
+            if self.fast:
+                kept = deque()
+                for request in self.upload_queue:
+                    if request[0] in self.allowed_fast_out:
+                        kept.append(request)
+                    else:
+                        self.send_reject(*request)
+                self.upload_queue = kept
+            else:
+                self.upload_queue.clear()
+        logger.debug(f"{'Choked' if choking else 'Unchoked'} {self.ip}")
+
+    async def update_interest(self):
+
+        """
+        Sends interested or not interested when whether the peer has pieces we need changed
+        """
+
+        interested = await self.piece_manager.peer_has_needed_pieces(self.pieces_peer_has)
+        if interested != self.am_interested:
+            self.am_interested = interested
+            self.send_message(2 if interested else 3)
+            await self.writer.drain()
+
+    async def handle_request(self, content):
+
+        """
+        Queues a block the peer requested for upload, provided it is unchoked (or the piece is
+        allowed fast) and the request is valid. With the fast extension other requests are rejected
+        """
+
+        if len(content) < 12:
+            return
+
+        piece_index, offset, length = struct.unpack(">III", content[:12])
+        if self.am_choking and piece_index not in self.allowed_fast_out:
+            if self.fast:
+                self.send_reject(piece_index, offset, length)
+            return
+
+        if (piece_index >= self.total_pieces or not self.piece_manager.have_pieces[piece_index]
+                or length > self.max_request_length
+                or offset + length > self.piece_manager.get_piece_size(piece_index)
+                or len(self.upload_queue) >= self.max_upload_queue):
+            logger.debug(f"Invalid request for piece {piece_index} from {self.ip}")
+            if self.fast:
+                self.send_reject(piece_index, offset, length)
+            return
+
+        self.upload_queue.append((piece_index, offset, length))
+        self.upload_ready.set()
+
+    async def upload_blocks(self):
+
+        """
+        Serves queued requests in order, as fast as the upload limits allow
+        """
+
+        try:
+            while True:
+                await self.upload_ready.wait()
+                while self.upload_queue:
+                    piece_index, offset, length = self.upload_queue.popleft()
+                    if self.rate_limiter is not None:
+                        await self.rate_limiter.acquire_upload(self.rate_limits, length)
+                    if self.am_choking and piece_index not in self.allowed_fast_out:
+                        if self.fast:
+                            self.send_reject(piece_index, offset, length)
+                        continue
+
+                    block = await self.piece_manager.read_block(piece_index, offset, length)
+                    self.writer.write(struct.pack(">IBII", 9 + length, 7, piece_index, offset))
+                    self.writer.write(block)
+                    await self.writer.drain()
+                    self.uploaded += length
+                    self.piece_manager.uploaded += length
+                self.upload_ready.clear()
+
+        except (ConnectionError, OSError) as e:
+            # The receive loop notices the closed connection and ends the session
+            logger.debug(f"Error uploading to {self.ip}: {e}")
+            self.connection_failed = True
+            self.writer.close()
+    
+    def get_request_message(self, piece_index, offset, block_size):
         length = (13).to_bytes(4, byteorder='big')
         id = (6).to_bytes(1, byteorder='big')
         index_bytes = piece_index.to_bytes(4, byteorder='big')
         offs = offset.to_bytes(4, byteorder='big')
         block_length = block_size.to_bytes(4, byteorder='big')
+        return length + id + index_bytes + offs + block_length
+
+    async def request_block(self, piece_index, offset, block_size):
+
+        """
+        Send request block message to peer
+        """
 
-        request_mssg = length + id + index_bytes + offs + block_length
+        request_mssg = self.get_request_message(piece_index, offset, block_size)
 
         try:
             self.writer.write(request_mssg)
             await self.writer.drain()
-            logger.debug(f"Block requested from {self.ip}")
+            logger.debug("Block requested from %s", self.ip)
         except Exception as e:
             logger.debug(f"Error while requesting piece {e}") 
             self.consecutive_failures += 1
@@ -163,166 +529,256 @@ class exchange:
                 self.connection_failed = True
             raise 
     
-    def get_piece_message(self, content, block_num):
+    async def run(self):
 
         """
-        Puts block message and block offset in nested dict corresponding to piece_index (piece number)
-        """ 
+        Exchanges messages with the peer for as long as either side wants something from the other.
+        Keeps a window of outstanding block requests open while the peer unchokes us, matching each
+        incoming piece message to its request by (index, offset), and answers the peer's requests
+        while we unchoke it
+        """
+
+        self.piece_manager.register_peer(self)
+        if self.rate_limiter is not None:
+            self.rate_limits = self.rate_limiter.add_peer()
+        upload_task = asyncio.create_task(self.upload_blocks())
+        try:
+            await self.send_bitfield()
+            if self.extensions:
+                self.writer.write(get_extended_handshake(len(self.torrent.raw_info), self.listen_port,
+                                                         pex=self.on_peers is not None))
+
+            while True:
+
+                if self.connection_failed:
+                    logger.debug(f"Connection to {self.ip} has failed too many times, skipping peer")
+                    return False
+
+                if self.interest_changed:
+                    self.interest_changed = False
+                    await self.update_interest()
+
+                if self.on_peers is not None and self.peer_extensions.get(b"ut_pex") and time.monotonic() >= self.pex_next:
+                    self.send_pex()
+
+                await self.fill_request_queue()
+
+                idle = not (self.outstanding or self.am_interested or self.peer_interested)
+                if idle and time.monotonic() - self.last_received >= 5:
+                    logger.debug(f"Neither side needs anything from {self.ip}")
+                    return await self.piece_manager.is_download_complete()
+
+                # Waiting on a choked or unchoked peer that owes us nothing, keep-alives every interval
+                timeout = 5 if self.outstanding or idle else self.keepalive_interval
+                response = await self.receive_message(timeout)
+                if response is not None:
+                    await self.handle_message(response)
+
+        except (ConnectionError, BrokenPipeError, OSError) as e:
+            logger.error(f"Connection error with {self.ip}: {e}")
+            self.connection_failed = True
+            return False
 
-        if content is None:
-            logger.debug(f"Peer sent None {self.ip}")
+        finally:
+            upload_task.cancel()
+            if self.rate_limiter is not None:
+                self.rate_limiter.remove_peer(self.rate_limits)
+            await self.release_pieces()
+
+    async def fill_request_queue(self):
+
+        """
+        Sends requests for new blocks until the number of outstanding requests reaches the queue size
+        """
+
+        # Choked peers with the fast extension still serve their allowed fast pieces
+        peer_pieces = self.pieces_peer_has
+        if self.peer_choking:
+            if not self.fast or not self.allowed_fast_in.any():
+                return
+            peer_pieces = peer_pieces & self.allowed_fast_in
+        if self.rejected_pieces.any():
+            peer_pieces = peer_pieces & ~self.rejected_pieces
+
+        wanted = self.queue_size - len(self.outstanding)
+        if wanted <= 0:
+            return
+
+        budget = wanted * self.block_size
+        if self.rate_limiter is not None:
+            budget = self.rate_limiter.take_download(self.rate_limits, budget)
+            if budget < self.block_size:
+                # Out of download tokens, wait for them only if the peer owes us nothing else
+                self.rate_limiter.refund_download(self.rate_limits, budget)
+                if self.outstanding:
+                    return
+                await self.rate_limiter.acquire_download(self.rate_limits, self.block_size)
+                budget = self.block_size
+
+        blocks = await self.piece_manager.request_blocks(self, peer_pieces, budget // self.block_size, self.suggested)
+        if self.rate_limiter is not None:
+            self.rate_limiter.refund_download(self.rate_limits, budget - sum(block[2] for block in blocks))
+        requests = bytearray()
+        for piece_index, offset, length in blocks:
+            self.outstanding[(piece_index, offset)] = length
+            requests += self.get_request_message(piece_index, offset, length)
+            if TRACER.enabled:
+                TRACER.block_requested(self, self.piece_manager, piece_index, offset)
+
+        if requests:
+            try:
+                self.writer.write(requests)
+                await self.writer.drain()
+            except Exception as e:
+                logger.debug(f"Error while requesting blocks {e}")
+                self.connection_failed = True
+                raise
+
+    async def handle_block(self, content):
+
+        """
+        Stores a received block and verifies the piece once all of its blocks are in
+        """
 
         if len(content) < 8:
-            logger.debug(f"Incomplete message from {self.ip}") 
-            logger.debug(content)
+            logger.debug(f"Incomplete message from {self.ip}")
             return
 
-        piece_index = int.from_bytes(content[:4], byteorder='big') 
-        block_offset = int.from_bytes(content[4:8], byteorder='big') 
-        block_data = content[8:] 
+        piece_index = int.from_bytes(content[:4], byteorder='big')
+        block_offset = int.from_bytes(content[4:8], byteorder='big')
+        length = self.outstanding.pop((piece_index, block_offset), None)
 
-        if piece_index not in self.requested_blocks:
-            self.requested_blocks[piece_index] = {}
+        if length is None or length != len(content) - 8:
+            # Usually a block we cancelled in endgame that was already on its way
+            logger.debug("Unrequested block %d of piece %d from %s", block_offset, piece_index, self.ip)
+            self.piece_manager.add_duplicate_bytes(len(content) - 8)
+            return
 
-        self.requested_blocks[piece_index][block_offset] = block_data  
-        logger.debug(f"Received block {block_num} of piece {piece_index} from {self.ip}") 
+        self.downloaded += length
+        self.consecutive_failures = 0
+        self.update_queue_size(length)
+        if TRACER.enabled:
+            TRACER.block_received(self, piece_index, block_offset)
 
-    async def get_all_pieces(self):
+        piece = await self.piece_manager.block_received(self, piece_index, block_offset, content[8:])
+        if piece is None:
+            return
+        if TRACER.enabled:
+            TRACER.piece_downloaded(self.piece_manager, piece_index)
+
+        try:
+            verified = await self.verify_piece(piece_index, piece.data)
+        except BaseException:
+            # Disconnected while hashing, nobody else would ever verify this piece
+            piece.reset()
+            raise
+
+        if verified:
+            write_start = TRACER.now() if TRACER.enabled else None
+            try:
+                async with asyncio.timeout(30):
+                    await self.piece_manager.piece_complete(piece_index, piece.data)
+                logger.debug("Completed piece %d", piece_index)
+                if write_start is not None:
+                    TRACER.piece_written(self.piece_manager, piece_index, write_start)
+            except asyncio.TimeoutError:
+                logger.debug("Piece %d timed out in piece complete function", piece_index)
+                await self.piece_manager.piece_failed(piece_index, hash_failure=False)
+                if write_start is not None:
+                    TRACER.piece_failed(self.piece_manager, piece_index)
+        else:
+            logger.debug("Piece %d failed hash check", piece_index)
+            await self.piece_manager.piece_failed(piece_index)
+            if TRACER.enabled:
+                TRACER.piece_failed(self.piece_manager, piece_index)
+
+    def update_queue_size(self, length):
 
         """
-        Handles the looping of common pieces and blocks which make up the piece
+        Resizes the request queue to the bandwidth-delay product of the peer, measured as the
+        download rate over the last second times the time we want queued requests to cover
         """
 
-        block_size = 16384
+        self.rate_bytes += length
+        now = time.monotonic()
+        elapsed = now - self.rate_start
+        if elapsed < 1:
+            return
 
-        while True:
+        rate = self.rate_bytes / elapsed
+        self.rate_bytes = 0
+        self.rate_start = now
+        self.download_rate = rate
+        wanted = int(rate * self.request_queue_time / self.block_size)
+        self.queue_size = max(self.min_queue, min(self.max_queue, wanted))
+        logger.debug("Request queue for %s is now %d (%.0f KiB/s)", self.ip, self.queue_size, rate / 1024)
 
-            missing_pieces = await self.piece_manager.get_missing_pieces()
-            common = self.pieces_peer_has & missing_pieces
+    def get_download_rate(self):
 
-            if self.connection_failed:
-                logger.debug(f"Connection to {self.ip} has failed too many times, skipping peer")
-                return False
+        """
+        Download rate over the last full second, zero once blocks stopped arriving
+        """
 
-            if not common:
-                logger.debug(f"No more pieces from {self.ip} that we need")
-                return False
-            
-            one_piece_completed = False
+        if time.monotonic() - self.rate_start > 2:
+            return 0
+        return self.download_rate
 
-            for piece_index in sorted(common):
-                    
-                    if await self.piece_manager.is_piece_complete(piece_index): 
-                        continue
+    def get_cancel_message(self, piece_index, offset, block_size):
+        return (13).to_bytes(4, 'big') + (8).to_bytes(1, 'big') + piece_index.to_bytes(4, 'big') + offset.to_bytes(4, 'big') + block_size.to_bytes(4, 'big')
 
-                    if await self.piece_manager.is_piece_downloading(piece_index):
-                        continue
+    def cancel_block(self, piece_index, offset, length):
 
-                    is_last_piece = piece_index == self.total_pieces - 1
-                    current_piece_length = self.last_piece_length if is_last_piece else self.piece_length
-                    total_blocks = math.ceil(current_piece_length / block_size)
-                    self.requested_blocks[piece_index] = {}
-                    success = True
-
-                    for i in range(total_blocks):
-                        offset = i * block_size
-                        current_block = min(block_size, current_piece_length - offset)
-                        retries = 3
-                        received = False
-
-                        while retries > 0 and not received:
-                            try:
-                                await self.request_block(piece_index, offset, current_block)  
-                                response = await self.receive_message()  
-
-                                if response is None:
-                                    retries -= 1
-                                    logger.debug(f"No response for block {i} of piece {piece_index} from {self.ip}")
-                                    continue
-
-                                if response["id"] == 7:
-                                    self.get_piece_message(response["content"], i)
-                                    if piece_index in self.requested_blocks and offset in self.requested_blocks[piece_index]:
-                                        received = True
-                                else:
-                                    logger.debug("Incorrect message id from peer during block receiving")
-                                    retries -= 1
-
-                            except asyncio.TimeoutError:
-                                retries -= 1
-                                logger.debug(f"Timed out getting block {i} of piece {piece_index} from {self.ip}")
-
-                            except (ConnectionError, BrokenPipeError, OSError) as e:
-                                logger.error(f"Connection error with {self.ip}: {e}")
-                                self.connection_failed = True
-                                success = False
-                                break  
-
-                            except Exception as e:
-                                retries = 0
-                                logger.error(f"Unexpected error on block {i} of piece {piece_index}: {e}")
-                                break
-
-                        if not received:
-                            logger.debug(f"Block {i} of piece {piece_index} failed from {self.ip}")
-                            success = False
-                            break
-
-                    if not success:
-                        async with self.piece_manager.lock:
-                            await self.piece_manager.piece_failed(piece_index)
-                        continue  
-
-                    got_blocks = self.requested_blocks[piece_index]
-                    if len(got_blocks) != total_blocks:
-                        logger.debug(f"Piece {piece_index} incomplete from {self.ip}")
-                        async with self.piece_manager.lock:
-                            await self.piece_manager.piece_failed(piece_index)
-                        continue
+        """
+        Cancels our request for a block another peer delivered first (endgame)
+        """
 
-                    full_piece_data = bytearray()
-                    for j in range(total_blocks):
-                        full_piece_data += got_blocks[j * block_size]
-
-                    if self.verify_piece(piece_index, full_piece_data):
-                        try:
-                            await asyncio.wait_for(self.piece_manager.piece_complete(piece_index, full_piece_data), timeout=30)
-                            logger.debug(f"Completed piece {piece_index}\n")
-                            one_piece_completed = True
-                        except asyncio.TimeoutError:
-                            logger.debug(f"Piece {piece_index} timed out in piece complete function")
-                            async with self.piece_manager.lock:
-                                await self.piece_manager.piece_failed(piece_index)
-                                continue  
+        if self.outstanding.pop((piece_index, offset), None) is None:
+            return
+        if TRACER.enabled:
+            TRACER.block_dropped(self, piece_index, offset)
+        try:
+            self.writer.write(self.get_cancel_message(piece_index, offset, length))
+        except Exception as e:
+            logger.debug(f"Error sending cancel to {self.ip}: {e}")
 
-                    else:
-                        logger.debug(f"Piece {piece_index} failed hash check")
-                        async with self.piece_manager.lock:
-                            await self.piece_manager.piece_failed(piece_index)
+    async def release_pieces(self, released=None):
 
-            if not one_piece_completed and self.consecutive_failures > 0:
-                logger.debug(f"No progress made with {self.ip}, abandoning peer")
-                return False
-            
-            if await self.piece_manager.is_download_complete():
-                return True
+        """
+        Gives the blocks we requested but did not receive back so that other peers can download them.
+        released(piece_index) picks which ones, by default all
+        """
+
+        outstanding = [block for block in self.outstanding if released is None or released(block[0])]
+        for block in outstanding:
+            del self.outstanding[block]
+            if TRACER.enabled:
+                TRACER.block_dropped(self, *block)
+        if outstanding:
+            await self.piece_manager.release_blocks(self, outstanding)
 
- 
-    def verify_piece(self, piece_index, data):
+    async def verify_piece(self, piece_index, data):
 
         """
-        Ensures expected hash of piece from torrent matches hash of piece we receive
+        Ensures expected hash of piece from torrent matches hash of piece we receive.
+        Hashing runs on the verify executor so that large pieces do not stall the event loop
         """
 
-        expected_hash = self.torrent.get_piece_hashes()
-        sha1 = hashlib.sha1()
-        sha1.update(data)
-        actual_hash = sha1.digest()
-        if actual_hash == expected_hash[piece_index]:
-            logger.debug(f"\nHash matches")
+        loop = asyncio.get_running_loop()
+        self.piece_manager.verify_queue += 1
+        try:
+            if TRACER.enabled:
+                queued = TRACER.now()
+                actual_hash, hashing = await loop.run_in_executor(self.verify_executor, timed_hash, hash_piece, data)
+                TRACER.piece_verified(self.piece_manager, piece_index, queued, hashing)
+            else:
+                actual_hash = await loop.run_in_executor(self.verify_executor, hash_piece, data)
+        finally:
+            self.piece_manager.verify_queue -= 1
+        if actual_hash == self.torrent.get_piece_hash(piece_index):
+            logger.debug("Hash matches")
             return True
         logger.debug("Hash not matching")
         return False
 
-
-            
\ No newline at end of file
+def hash_piece(data):
+    return hashlib.sha1(data).digest()
@@ -0,0 +1,40 @@
+import socket
+import struct
+import hashlib
+
+# BEP 6 message ids
+SUGGEST_PIECE = 0x0D
+HAVE_ALL = 0x0E
+HAVE_NONE = 0x0F
+REJECT_REQUEST = 0x10
+ALLOWED_FAST = 0x11
+
+# Pieces a peer may request while choked, and how many allowed fast or suggested pieces we
+# keep from a peer at most
+ALLOWED_FAST_COUNT = 10
+MAX_FAST_PIECES = 32
+
+def generate_allowed_fast(ip, info_hash, total_pieces, count=ALLOWED_FAST_COUNT):
+
+    """
+    The canonical allowed fast set of BEP 6 for an IPv4 peer, derived from its /24 network so that
+    reconnecting from another port does not give a peer a new set. Empty for other addresses
+    """
+
+    try:
+        address = socket.inet_aton(ip)
+    except OSError:
+        return []
+
+    count = min(count, total_pieces)
+    pieces = []
+    x = bytes(address[:3]) + b"\x00" + info_hash
+    while len(pieces) < count:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(pieces) >= count:
+                break
+            piece_index = struct.unpack(">I", x[i:i + 4])[0] % total_pieces
+            if piece_index not in pieces:
+                pieces.append(piece_index)
+    return pieces
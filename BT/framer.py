@@ -0,0 +1,36 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+class MessageFramer:
+    def __init__(self, reader, max_length=2 * 1024 * 1024):
+        self.reader = reader
+        self.max_length = max_length
+
+        # Length prefix of a message whose payload has not fully arrived yet. Kept across
+        # calls so that a timeout between prefix and payload does not desync the stream
+        self.pending_length = None
+
+    async def read_message(self):
+
+        """
+        Reads the next length-prefixed message off the stream. Returns None for keep-alives,
+        otherwise a dict with the message id and its payload as a memoryview (no copies are made
+        of piece data). Raises asyncio.IncompleteReadError once the peer closed the connection
+        """
+
+        if self.pending_length is None:
+            length_prefix = await self.reader.readexactly(4)
+            mssg_length = int.from_bytes(length_prefix, 'big')
+            if mssg_length > self.max_length:
+                raise ValueError(f"Message of {mssg_length} bytes exceeds limit of {self.max_length}")
+            self.pending_length = mssg_length
+
+        if self.pending_length == 0:
+            self.pending_length = None
+            return None
+
+        message = memoryview(await self.reader.readexactly(self.pending_length))
+        self.pending_length = None
+
+        return {"id": message[0], "content": message[1:]}
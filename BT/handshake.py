@@ -3,15 +3,26 @@ import asyncio
 
 logger = logging.getLogger(__name__)
 
+PSTR = b"BitTorrent protocol"
+
+# Reserved byte 5, bit 0x10 announces the extension protocol (BEP 10), byte 7, bit 0x04 the
+# fast extension (BEP 6)
+EXTENSION_PROTOCOL_BYTE = 5
+EXTENSION_PROTOCOL_BIT = 0x10
+FAST_EXTENSION_BYTE = 7
+FAST_EXTENSION_BIT = 0x04
+
 class Handshake:
-    def __init__(self, ip, port, info_hash, peer_id):
+    def __init__(self, ip, port, info_hash, peer_id, timeout=3):
         self.ip = ip
         self.port = port
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.handshake = False
+        self.peer_reserved = bytes(8)
         self.writer = None
         self.reader = None
+        self.timeout = timeout
 
     async def connect_with_peer(self):
 
@@ -21,7 +32,7 @@ class Handshake:
 
         writer = None
         try:
-            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), timeout=3)
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), timeout=self.timeout)
             self.writer = writer
             self.reader = reader
             logger.debug(f"Successfully connected to {self.ip}, {self.port}")
@@ -33,15 +44,8 @@ class Handshake:
         if writer is None:
             return False         
 
-        pstr = b"BitTorrent protocol"
-        pstrlen = bytes([len(pstr)])
-        reserved = bytes(8)
-        info_hash = self.info_hash
-        peer_id = self.peer_id.encode("utf-8")
-        handshake_message = pstrlen + pstr + reserved + info_hash + peer_id
-
         try:
-            writer.write(handshake_message)
+            writer.write(self.get_handshake_message())
             await writer.drain()
         except Exception as e:
             logger.debug(f"Error: {e} to {self.ip}")
@@ -49,34 +53,96 @@ class Handshake:
             return False
      
         try:
-            reply = await reader.read(68)
+            reply = await asyncio.wait_for(reader.readexactly(68), timeout=self.timeout)
 
         except Exception as e:
             logger.debug(f"Error: {e} to {self.ip}")
             await self.close_writer(writer) 
             return False
 
+        if not self.validate_reply(reply):
+            await self.close_writer(writer)
+            return False
+    
+        self.handshake = True
+        logger.debug(f"Handshake successful between {self.ip}")
+        return True
+
+    async def accept_peer(self, reader, writer, reply=None):
+
+        """
+        Validates the handshake of a peer that connected to us and answers with ours. The
+        handshake may already have been read to find out which torrent the peer wants
+        """
+
+        self.reader = reader
+        self.writer = writer
+
+        if reply is None:
+            try:
+                reply = await asyncio.wait_for(reader.readexactly(68), timeout=self.timeout)
+            except Exception as e:
+                logger.debug(f"Error: {e} from {self.ip}")
+                await self.close_writer(writer)
+                return False
+
+        if not self.validate_reply(reply):
+            await self.close_writer(writer)
+            return False
+
+        try:
+            writer.write(self.get_handshake_message())
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"Error: {e} to {self.ip}")
+            await self.close_writer(writer)
+            return False
+
+        self.handshake = True
+        logger.debug(f"Accepted handshake from {self.ip}")
+        return True
+
+    def get_handshake_message(self):
+        pstrlen = bytes([len(PSTR)])
+        reserved = bytearray(8)
+        reserved[EXTENSION_PROTOCOL_BYTE] |= EXTENSION_PROTOCOL_BIT
+        reserved[FAST_EXTENSION_BYTE] |= FAST_EXTENSION_BIT
+        return pstrlen + PSTR + bytes(reserved) + self.info_hash + self.peer_id.encode("utf-8")
+
+    def peer_supports_extensions(self):
+        return bool(self.peer_reserved[EXTENSION_PROTOCOL_BYTE] & EXTENSION_PROTOCOL_BIT)
+
+    def peer_supports_fast(self):
+        return bool(self.peer_reserved[FAST_EXTENSION_BYTE] & FAST_EXTENSION_BIT)
+
+    def validate_reply(self, reply):
+
+        """
+        Checks a handshake the peer sent is for our torrent and not from ourselves
+        """
+
         if len(reply) != 68:
             logger.debug(f"Incorrect or incomplete handshake reply from {self.ip}")
-            await self.close_writer(writer) 
             return False
-        
+
         reply_pstr = reply[1:1 + reply[0]]
         reply_info_hash = reply[28:48]
-        #reply_peer_id = reply[48:]
-    
-        if reply_pstr != pstr:
+        reply_peer_id = reply[48:]
+
+        if reply_pstr != PSTR:
             logger.debug(f"Invalid handshake reply from {self.ip}")
-            await self.close_writer(writer)  
             return False
-        
-        if reply_info_hash != info_hash:
+
+        if reply_info_hash != self.info_hash:
             logger.debug(f"Info hash not matched from {self.ip}")
-            await self.close_writer(writer)
             return False
-    
-        self.handshake = True
-        logger.debug(f"Handshake successful between {self.ip}")
+
+        # Trackers list us among the peers, so we end up connecting to our own listener
+        if reply_peer_id == self.peer_id.encode("utf-8"):
+            logger.debug(f"Connected to ourselves at {self.ip}")
+            return False
+
+        self.peer_reserved = bytes(reply[20:28])
         return True
 
     async def close_writer(self, writer):
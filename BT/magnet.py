@@ -0,0 +1,44 @@
+import base64
+import binascii
+import urllib.parse
+
+def parse_magnet(uri):
+
+    """
+    Returns the info hash, display name, trackers and peers of a magnet link (BEP 9)
+    """
+
+    parsed = urllib.parse.urlparse(uri)
+    if parsed.scheme != "magnet":
+        raise ValueError(f"Not a magnet link: {uri}")
+    params = urllib.parse.parse_qs(parsed.query)
+
+    info_hash = None
+    for topic in params.get("xt", []):
+        if not topic.startswith("urn:btih:"):
+            continue
+        encoded = topic[len("urn:btih:"):]
+        try:
+            if len(encoded) == 40:
+                info_hash = bytes.fromhex(encoded)
+            elif len(encoded) == 32:
+                info_hash = base64.b32decode(encoded.upper())
+        except (ValueError, binascii.Error):
+            pass
+        if info_hash is not None:
+            break
+    if info_hash is None:
+        raise ValueError(f"Magnet link has no BitTorrent info hash: {uri}")
+
+    peers = []
+    for peer in params.get("x.pe", []):
+        host, _, port = peer.rpartition(":")
+        if host and port.isdigit():
+            peers.append((host.strip("[]"), int(port)))
+
+    return {
+        "info_hash": info_hash,
+        "name": params.get("dn", [info_hash.hex()])[0],
+        "trackers": params.get("tr", []),
+        "peers": peers
+    }
@@ -1,158 +1,183 @@
 import sys
-import logging
+import cProfile
 import asyncio
-
-log_level = logging.DEBUG if len(sys.argv) == 3 and sys.argv[2].lower() == "debug" else logging.INFO
-
-logging.basicConfig(
-    level=log_level,
-    format='%(message)s'
-)
+import logging
+import argparse
 
 logger = logging.getLogger(__name__)
 
-from parser import TorrentDecoder
-from tracker import Tracker
-import random
-import string
-from handshake import Handshake # type: ignore
-from exchange import exchange
-from PieceManager import PieceManager
-
-async def main():
-
-    async def download_from_peers(metadata, peer_id, piece_length, total_pieces,
-                            last_piece_length, piece_manager, torrent, ip, port):
-            
-            handshake = Handshake(
-                ip = ip,
-                port = port,
-                info_hash = metadata["info_hash"],
-                peer_id = peer_id
-            )
-
-            if not await handshake.connect_with_peer():
-                    return
-
-            ex = exchange(
-                info_hash = handshake.info_hash,
-                peer_id = handshake.peer_id,
-                ip = ip,
-                piece_length = piece_length,
-                total_pieces = total_pieces,
-                last_piece_length = last_piece_length,
-                piece_manager = piece_manager,
-                torrent = torrent,
-                writer = handshake.writer,
-                reader = handshake.reader
-            ) 
-
-            bitfield = await ex.receive_message()
-
-            if bitfield and bitfield["id"] == 5:
-                ex.parse_message(bitfield["content"], torrent.get_number_of_pieces())
-            else:
-                logger.debug(f"Did not recieve valid bitfield from {ip}") 
-           
-            if await ex.decide_interest():
-                    try:
-                        await ex.get_all_pieces()
-                    except Exception as e:
-                        logger.debug(f"Error downloading from {ip}: {e}")
-
-    def generate_peer_id():
-        id = "-SB001-"
-        characters = string.ascii_lowercase + string.digits
-        result = "".join(random.choices(characters, k=13))
-        return id + result
-
-    if len(sys.argv) > 3:
-        logger.info("Usage: python3 main.py <torrent file path> <optional: debug>")
-        sys.exit()
-    else:    
-        torrent_path = sys.argv[1]
-        torrent = TorrentDecoder(torrent_path)
-     
-
-    port = 6885 
-    peer_id = generate_peer_id() 
-    
-    metadata = torrent.get_metadata(port, peer_id) # type: ignore
-    piece_length = torrent.get_piece_length()
-    last_piece_length = torrent.get_last_piece_length()
-    file_list = torrent.get_file_list()
-    http = torrent.http
-
-    if metadata["announce url"][0] != "h":
-        logger.info("Torrents which use udp tracker servers are currently not supported.")
-        sys.exit()
-    
-    for i in range(len(file_list)):
-        logger.info(f"File name:  {file_list[i]["Path"]} ||  File size:  {file_list[i]["Length"]}")
-
-
-    logger.debug("\n===================")
-    logger.debug(f"Length of each piece: {piece_length:,}")
-    logger.debug(f"Total File length: {torrent.get_file_length():,}")
-    total_pieces = torrent.get_number_of_pieces()
-    logger.debug(f"Number of pieces: {total_pieces}")
-    logger.debug("===================\n")
-
-    logger.debug(f"Announce: {torrent.get_announce()}")
-
-    tracker = Tracker(
-        announce_url = metadata["announce url"],
-        info_hash = metadata["info_hash"],
-        peer_id = metadata["peer_id"],
-        port = metadata["port"],
-        file_length = metadata["file length"],
-        http = http
+from picker import PICK_MODES, PRIORITIES
+from session import Session
+from dht import BOOTSTRAP_NODES
+from tracing import TRACER, SamplingProfiler
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="A command line BitTorrent client")
+    arg_parser.add_argument("torrents", nargs="+", metavar="torrent", help="path to a .torrent file or a magnet link, add 'debug' for debug logging")
+    arg_parser.add_argument("--max-peers", type=int, default=50, help="maximum number of simultaneous peer connections per torrent")
+    arg_parser.add_argument("--max-connections", type=int, default=200, help="maximum number of peer connections of all torrents together")
+    arg_parser.add_argument("--max-active-downloads", type=int, default=3, help="number of torrents downloading at once, the others wait")
+    arg_parser.add_argument("--connect-timeout", type=float, default=3, help="seconds to wait for a peer to accept and handshake")
+    arg_parser.add_argument("--pick-mode", choices=PICK_MODES, default="rarest", help="order in which pieces are downloaded")
+    arg_parser.add_argument("--endgame-threshold", type=int, default=64, help="remaining blocks at which pieces are requested from several peers")
+    arg_parser.add_argument("--verify-threads", type=int, help="threads checking piece hashes, one per CPU by default")
+    arg_parser.add_argument("--port", type=int, default=6885, help="port to accept peer connections on")
+    arg_parser.add_argument("--upload-slots", type=int, default=4, help="number of peers uploaded to at once, besides the optimistic unchoke")
+    arg_parser.add_argument("--seed", action="store_true", help="keep uploading after the download completed until interrupted")
+    arg_parser.add_argument("--download-limit", type=int, default=0, help="total download rate in KiB/s, 0 for unlimited")
+    arg_parser.add_argument("--upload-limit", type=int, default=0, help="total upload rate in KiB/s, 0 for unlimited")
+    arg_parser.add_argument("--peer-download-limit", type=int, default=0, help="download rate from each peer in KiB/s, 0 for unlimited")
+    arg_parser.add_argument("--peer-upload-limit", type=int, default=0, help="upload rate to each peer in KiB/s, 0 for unlimited")
+    arg_parser.add_argument("--no-dht", action="store_true", help="find peers through trackers only")
+    arg_parser.add_argument("--dht-state", default="dht.dat", help="file keeping the DHT routing table between runs")
+    arg_parser.add_argument("--dht-bootstrap", action="append", metavar="HOST:PORT", help="DHT node to bootstrap from, may be repeated")
+    arg_parser.add_argument("--progress-interval", type=float, default=10, help="seconds between progress lines, 0 for none")
+    arg_parser.add_argument("--metrics-port", type=int, default=0, help="serve Prometheus metrics on this localhost port")
+    arg_parser.add_argument("--metrics-json", metavar="PATH", help="write a JSON snapshot of the metrics to PATH every progress interval")
+    arg_parser.add_argument("--file-priority", action="append", metavar="INDEX[,INDEX...]=PRIORITY",
+                            help=f"priority of files by their index, one of {', '.join(PRIORITIES)}, may be repeated")
+    arg_parser.add_argument("--only-files", metavar="INDEX[,INDEX...]", help="download only these files, skip the others")
+    arg_parser.add_argument("--stream", action="store_true", help="serve a file over HTTP on localhost while it downloads, for media players")
+    arg_parser.add_argument("--stream-file", type=int, metavar="INDEX", help="index of the file to stream, the largest by default")
+    arg_parser.add_argument("--stream-port", type=int, default=8888, help="port of the streaming HTTP server")
+    arg_parser.add_argument("--trace", metavar="PATH", help="trace every block and piece, write a Chrome trace to PATH and log stage latencies")
+    arg_parser.add_argument("--profile", choices=("cprofile", "sample"), help="profile the client with cProfile or a sampling profiler")
+    arg_parser.add_argument("--profile-output", metavar="PATH", help="where the profile goes, profile.prof or profile.folded by default")
+    args = arg_parser.parse_args()
+
+    # The old '<torrent> [debug]' form still works
+    args.debug = "debug" in args.torrents
+    args.torrents = [torrent for torrent in args.torrents if torrent != "debug"]
+    if not args.torrents:
+        arg_parser.error("no torrent given")
+    if args.stream and len(args.torrents) > 1:
+        arg_parser.error("only one torrent can be streamed")
+    if args.verify_threads is not None and args.verify_threads < 1:
+        arg_parser.error("--verify-threads must be at least 1")
+
+    # File indices come from the torrent's file list, which is logged when the download starts
+    args.file_priorities = {}
+    args.default_file_priority = "normal"
+    try:
+        if args.only_files:
+            args.default_file_priority = "skip"
+            args.file_priorities.update((int(index), "normal") for index in args.only_files.split(","))
+        for spec in args.file_priority or []:
+            indices, _, priority = spec.partition("=")
+            if priority not in PRIORITIES:
+                arg_parser.error(f"invalid file priority {spec}, expected one of {', '.join(PRIORITIES)}")
+            args.file_priorities.update((int(index), priority) for index in indices.split(","))
+    except ValueError:
+        arg_parser.error("file indices must be numbers")
+
+    args.dht_bootstrap_nodes = BOOTSTRAP_NODES
+    if args.dht_bootstrap:
+        args.dht_bootstrap_nodes = []
+        for node in args.dht_bootstrap:
+            host, _, port = node.rpartition(":")
+            if not host or not port.isdigit():
+                arg_parser.error(f"invalid DHT bootstrap node {node}")
+            args.dht_bootstrap_nodes.append((host, int(port)))
+    return args
+
+async def main(args):
+
+    # All torrents run in one session, sharing the listening port, the trackers' connections
+    # and the connection and bandwidth budgets
+    session = Session(
+        port = args.port,
+        max_connections = args.max_connections,
+        max_active_downloads = args.max_active_downloads,
+        connect_timeout = args.connect_timeout,
+        upload_slots = args.upload_slots,
+        download_rate = args.download_limit * 1024,
+        upload_rate = args.upload_limit * 1024,
+        peer_download_rate = args.peer_download_limit * 1024,
+        peer_upload_rate = args.peer_upload_limit * 1024,
+        dht = not args.no_dht,
+        dht_state_path = args.dht_state,
+        dht_bootstrap = args.dht_bootstrap_nodes,
+        progress_interval = args.progress_interval,
+        metrics_port = args.metrics_port,
+        metrics_json = args.metrics_json,
+        verify_threads = args.verify_threads
     )
-            
-    peer_list = tracker.decode_peer_list(tracker.send_request())
-      
-    logger.debug("\nAvailable peers: \n")
-    logger.debug(f"{peer_list}\n")
-    
-    piece_manager = PieceManager(total_pieces=total_pieces, torrent=torrent) 
-    logger.info("Gathering pieces from peers...")
-
-    tasks = []
-    for ip, port in peer_list:
-         
-        tasks.append(
-            download_from_peers(metadata, peer_id, piece_length, total_pieces,
-                            last_piece_length, piece_manager, torrent, ip, port)
-
-        )
-
-    await asyncio.gather(*tasks)    
-
-    info = await piece_manager.get_info()
-    logger.debug(f"Info: {info}")
-
-    if await piece_manager.is_download_complete():
-        logger.info("Attempting to download file(s) to disk now...")
-        piece_manager.write_to_file()
-    else:
-        logger.info("File(s) could not be downloaded, please retry downloading this torrent")      
-         
-if __name__ == "__main__":
-    asyncio.run(main())
-     
-
-    
-        
-
-
-
+    await session.start()
+
+    try:
+        handles = []
+        for torrent_path in args.torrents:
+            handles.append(await session.add_torrent(
+                torrent_path,
+                seed = args.seed,
+                pick_mode = args.pick_mode,
+                endgame_threshold = args.endgame_threshold,
+                max_peers = args.max_peers,
+                stream_port = args.stream_port if args.stream else None,
+                stream_file = args.stream_file,
+                file_priorities = args.file_priorities,
+                default_file_priority = args.default_file_priority
+            ))
+        if args.seed:
+            logger.info(f"Seeding on port {args.port} once downloaded, press Ctrl+C to stop")
+
+        await asyncio.gather(*(handle.wait() for handle in handles))
+
+        # The stream stays up after the download, until interrupted
+        if args.stream and handles[0].stream_server is not None and handles[0].state != "failed":
+            logger.info(f"Still streaming on {handles[0].stream_server.get_url()}, press Ctrl+C to stop")
+            await asyncio.Event().wait()
+
+        for status in session.get_status():
+            logger.debug(f"Status: {status}")
+        if session.dht is not None:
+            logger.debug(f"DHT: {session.dht.get_stats()}")
+
+        # Non-zero exit status when any torrent failed
+        return 1 if any(handle.state == "failed" for handle in handles) else 0
+    finally:
+        await session.close()
 
+if __name__ == "__main__":
+    args = parse_args()
 
-      
-     
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(message)s'
+    )
 
-    
-   
-    
-    
-   
\ No newline at end of file
+    if args.trace:
+        TRACER.start()
+
+    # cProfile sees every call and slows the client down accordingly, the sampling profiler only
+    # looks at the stack every few milliseconds
+    profiler = None
+    if args.profile == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif args.profile == "sample":
+        profiler = SamplingProfiler()
+        profiler.start()
+
+    status = 0
+    try:
+        status = asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.profile == "cprofile":
+            profiler.disable()
+            profiler.dump_stats(args.profile_output or "profile.prof")
+            logger.info(f"Profile written to {args.profile_output or 'profile.prof'}, read it with python -m pstats")
+        elif args.profile == "sample":
+            profiler.stop()
+            profiler.write(args.profile_output or "profile.folded")
+            logger.info(f"{profiler.samples} stack samples written to {args.profile_output or 'profile.folded'}")
+
+        if args.trace:
+            TRACER.stop()
+            TRACER.log_summary()
+            TRACER.write(args.trace)
+            logger.info(f"Trace written to {args.trace}")
+
+    sys.exit(status)
@@ -0,0 +1,192 @@
+import math
+import asyncio
+import hashlib
+import logging
+import bencoding
+from framer import MessageFramer
+
+logger = logging.getLogger(__name__)
+
+# BEP 10: message id 20 carries extension messages, extended message id 0 is the handshake.
+# Peers send us ut_metadata (BEP 9) and ut_pex (BEP 11) messages with the ids we assign to
+# them in our handshake
+EXTENDED_MESSAGE_ID = 20
+EXTENDED_HANDSHAKE_ID = 0
+UT_METADATA_ID = 1
+UT_PEX_ID = 2
+METADATA_PIECE_SIZE = 16384
+METADATA_REQUEST = 0
+METADATA_DATA = 1
+METADATA_REJECT = 2
+
+def get_extended_message(extended_id, payload):
+    return (len(payload) + 2).to_bytes(4, 'big') + bytes([EXTENDED_MESSAGE_ID, extended_id]) + payload
+
+def get_extended_handshake(metadata_size=None, listen_port=None, pex=False):
+    handshake = {b"m": {b"ut_metadata": UT_METADATA_ID}, b"v": b"SB001"}
+    if pex:
+        handshake[b"m"][b"ut_pex"] = UT_PEX_ID
+    if metadata_size:
+        handshake[b"metadata_size"] = metadata_size
+    if listen_port:
+        handshake[b"p"] = listen_port
+    return get_extended_message(EXTENDED_HANDSHAKE_ID, bencoding.encode(handshake))
+
+def parse_metadata_message(payload):
+
+    """
+    Splits a ut_metadata message into its bencoded header and the piece data following it
+    """
+
+    decoder = bencoding.Decoder(payload)
+    header, end = decoder.decode_plain(0)
+    if not isinstance(header, dict):
+        raise bencoding.BencodeError("ut_metadata header is not a dictionary")
+    return header, decoder.data[end:]
+
+def get_metadata_piece_message(peer_metadata_id, raw_info, piece):
+
+    """
+    Answers a peer's request for a piece of the info dict, or rejects it if the piece does not exist
+    """
+
+    start = piece * METADATA_PIECE_SIZE
+    if raw_info is None or not 0 <= start < len(raw_info):
+        header = bencoding.encode({b"msg_type": METADATA_REJECT, b"piece": piece})
+        return get_extended_message(peer_metadata_id, header)
+    header = bencoding.encode({b"msg_type": METADATA_DATA, b"piece": piece, b"total_size": len(raw_info)})
+    return get_extended_message(peer_metadata_id, header + bytes(raw_info[start:start + METADATA_PIECE_SIZE]))
+
+class MetadataFetcher:
+    def __init__(self, info_hash, max_size=16 * 1024 * 1024, timeout=10):
+        self.info_hash = info_hash
+        self.max_size = max_size
+        self.timeout = timeout
+
+        # Set by the first peer that tells us the size, pieces are handed out to different
+        # peers so that the info dict is fetched from several of them in parallel
+        self.size = None
+        self.pieces = []
+        self.requesters = []
+        self.raw_info = None
+        self.done = asyncio.Event()
+
+    def set_size(self, size):
+        if self.size is not None:
+            return size == self.size
+        if not 0 < size <= self.max_size:
+            return False
+        self.size = size
+        total = math.ceil(size / METADATA_PIECE_SIZE)
+        self.pieces = [None] * total
+        self.requesters = [set() for _ in range(total)]
+        return True
+
+    def next_piece(self, peer):
+
+        """
+        Returns a missing piece nobody requested yet, or else one this peer has not requested
+        """
+
+        missing = [i for i, data in enumerate(self.pieces) if data is None and peer not in self.requesters[i]]
+        if not missing:
+            return None
+        piece = min(missing, key=lambda i: len(self.requesters[i]))
+        self.requesters[piece].add(peer)
+        return piece
+
+    def release(self, peer):
+        for requesters in self.requesters:
+            requesters.discard(peer)
+
+    def piece_received(self, piece, data):
+        if self.done.is_set() or not 0 <= piece < len(self.pieces) or self.pieces[piece] is not None:
+            return
+        expected = min(METADATA_PIECE_SIZE, self.size - piece * METADATA_PIECE_SIZE)
+        if len(data) != expected:
+            logger.debug(f"Metadata piece {piece} has {len(data)} bytes, expected {expected}")
+            return
+        self.pieces[piece] = data
+
+        if all(data is not None for data in self.pieces):
+            raw_info = b"".join(self.pieces)
+            if hashlib.sha1(raw_info).digest() == self.info_hash:
+                self.raw_info = raw_info
+                self.done.set()
+                logger.info(f"Fetched metadata ({self.size} bytes)")
+            else:
+                logger.info("Metadata does not match the info hash, fetching it again")
+                self.pieces = [None] * len(self.pieces)
+                self.requesters = [set() for _ in self.pieces]
+
+    async def fetch_from_peer(self, reader, writer, ip, pipeline=2):
+
+        """
+        Runs ut_metadata with a peer that completed the handshake. Returns the number of bytes of
+        metadata the peer gave us
+        """
+
+        framer = MessageFramer(reader)
+        peer = writer
+        peer_metadata_id = None
+        outstanding = set()
+        received = 0
+
+        writer.write(get_extended_handshake())
+        await writer.drain()
+
+        try:
+            while not self.done.is_set():
+                if peer_metadata_id is not None:
+                    while len(outstanding) < pipeline:
+                        piece = self.next_piece(peer)
+                        if piece is None:
+                            break
+                        outstanding.add(piece)
+                        request = bencoding.encode({b"msg_type": METADATA_REQUEST, b"piece": piece})
+                        writer.write(get_extended_message(peer_metadata_id, request))
+                    await writer.drain()
+                    if not outstanding:
+                        # Everything is requested from other peers, stay around in case they fail
+                        async with asyncio.timeout(self.timeout):
+                            await self.done.wait()
+                        continue
+
+                async with asyncio.timeout(self.timeout):
+                    message = await framer.read_message()
+                if message is None or message["id"] != EXTENDED_MESSAGE_ID or len(message["content"]) < 1:
+                    continue
+
+                extended_id = message["content"][0]
+                payload = bytes(message["content"][1:])
+
+                if extended_id == EXTENDED_HANDSHAKE_ID:
+                    handshake = bencoding.decode(payload)
+                    if not isinstance(handshake, dict) or not isinstance(handshake.get(b"m", {}), dict):
+                        raise ValueError("Malformed extended handshake")
+                    peer_metadata_id = handshake.get(b"m", {}).get(b"ut_metadata")
+                    size = handshake.get(b"metadata_size")
+                    if not peer_metadata_id or not isinstance(size, int) or not self.set_size(size):
+                        logger.debug(f"{ip} cannot send us the metadata")
+                        return received
+
+                elif extended_id == UT_METADATA_ID:
+                    header, data = parse_metadata_message(payload)
+                    piece = header.get(b"piece")
+                    if not isinstance(piece, int):
+                        raise ValueError("Metadata message without a piece number")
+                    outstanding.discard(piece)
+                    if header.get(b"msg_type") == METADATA_REJECT:
+                        logger.debug(f"{ip} rejected metadata piece {piece}")
+                        return received
+                    if header.get(b"msg_type") == METADATA_DATA:
+                        received += len(data)
+                        self.piece_received(piece, data)
+
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            logger.debug(f"Fetching metadata from {ip} stopped: {e}")
+
+        finally:
+            self.release(peer)
+
+        return received
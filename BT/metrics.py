@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Metric:
+    def __init__(self, name, kind, help):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        # Value by label set, labels are kept as a sorted tuple of (name, value) pairs
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def clear(self):
+        self.values.clear()
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+        # Gauges of state which already lives elsewhere (peers, pieces) are filled in by
+        # collectors when a snapshot is taken, instead of being updated on every change
+        self.collectors = []
+
+    def counter(self, name, help):
+        return self.get_metric(name, "counter", help)
+
+    def gauge(self, name, help):
+        return self.get_metric(name, "gauge", help)
+
+    def get_metric(self, name, kind, help):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Metric(name, kind, help)
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def collect(self):
+        for collector in list(self.collectors):
+            try:
+                collector(self)
+            except Exception as e:
+                logger.debug(f"Metrics collector failed: {e}")
+
+    def snapshot(self):
+
+        """
+        Returns every metric as a dict that can be dumped as JSON
+        """
+
+        self.collect()
+        return {
+            name: {
+                "type": metric.kind,
+                "help": metric.help,
+                "values": [{"labels": dict(labels), "value": value} for labels, value in metric.values.items()]
+            }
+            for name, metric in sorted(self.metrics.items())
+        }
+
+    def to_prometheus(self):
+
+        """
+        Returns every metric in the Prometheus text exposition format
+        """
+
+        self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, value in metric.values.items():
+                if labels:
+                    label_text = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels)
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+# The registry the client's modules report to, like the root logger
+REGISTRY = MetricsRegistry()
+
+def write_snapshot(path, registry=REGISTRY):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"time": time.time(), "metrics": registry.snapshot()}, f, indent=2)
+    os.replace(temp_path, path)
+
+class LoopLagMonitor:
+    def __init__(self, interval=0.5, registry=REGISTRY):
+
+        """
+        Measures how late the event loop wakes up from a sleep. A lag that stays high means
+        something blocks the loop, e.g. hashing or disk I/O done in it
+        """
+
+        self.interval = interval
+        self.lag = 0
+        self.max_lag = 0
+        self.lag_gauge = registry.gauge("bt_event_loop_lag_seconds", "How late the event loop woke up from the last sleep")
+        self.max_lag_gauge = registry.gauge("bt_event_loop_lag_max_seconds", "Largest event loop lag seen")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0, loop.time() - start - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+            self.lag_gauge.set(round(self.lag, 6))
+            self.max_lag_gauge.set(round(self.max_lag, 6))
+
+class MetricsServer:
+    def __init__(self, port, host="127.0.0.1", registry=REGISTRY):
+
+        """
+        Serves /metrics in the Prometheus text format and /metrics.json as a JSON snapshot. It
+        listens on localhost only unless told otherwise
+        """
+
+        self.port = port
+        self.host = host
+        self.registry = registry
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def handle(self, reader, writer):
+        try:
+            async with asyncio.timeout(5):
+                request = await reader.readuntil(b"\r\n\r\n")
+            parts = request.split(b" ")
+            path = parts[1].decode("latin-1") if len(parts) > 1 else ""
+
+            if path == "/metrics":
+                status, content_type = "200 OK", "text/plain; version=0.0.4"
+                body = self.registry.to_prometheus().encode()
+            elif path == "/metrics.json":
+                status, content_type = "200 OK", "application/json"
+                body = json.dumps(self.registry.snapshot()).encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+            logger.debug(f"Metrics request failed: {e}")
+
+        finally:
+            writer.close()
@@ -1,19 +1,66 @@
-import bencodepy # type: ignore
 import hashlib
+from bencoding import Decoder, RawValue, encode
 
 class TorrentDecoder:
-    def __init__(self, filepath):
+    def __init__(self, filepath, data=None):
         self.filepath = filepath
-        self.metadata = self.load()
-        self.multi_file = False
+        self.metadata = self.load(data)
+        # SHA-1 of piece i lives at [i*20:i*20+20], kept as one immutable buffer
+        self.piece_hashes = bytes(self.metadata[b'info'][b'pieces'])
+        self.multi_file = b'files' in self.metadata[b'info']
         self.http = True
 
-    def load(self):
-        with open(self.filepath, "rb") as f:
-            return bencodepy.decode(f.read())
+        # Derived fields are computed on first use and kept, the file list of a multi-file
+        # torrent is only decoded when it is first asked for
+        self.info_hash = None
+        self.files = None
+        self.file_list = None
+        self.file_length = None
+
+    @classmethod
+    def from_bytes(cls, data, name="<metadata>"):
+
+        """
+        Decodes a torrent held in memory, e.g. one built from metadata fetched from peers
+        """
+
+        return cls(name, data)
+
+    @classmethod
+    def from_info(cls, raw_info, announce_list):
+
+        """
+        Builds a torrent around the raw bytes of an info dict, which are kept as they are
+        """
+
+        metadata = {b'info': RawValue(raw_info, 0, len(raw_info))}
+        if announce_list:
+            metadata[b'announce'] = announce_list[0][0]
+            metadata[b'announce-list'] = announce_list
+        return cls.from_bytes(encode(metadata))
+
+    def load(self, data=None):
+
+        """
+        Decodes the torrent, keeping the raw bytes of the info dict for the info hash
+        """
+
+        if data is None:
+            with open(self.filepath, "rb") as f:
+                data = f.read()
+        decoder = Decoder(data, lazy_keys=[(b'info', b'files')])
+        metadata = decoder.decode()
+        if b'info' not in decoder.spans:
+            raise ValueError(f"{self.filepath} has no info dictionary")
+        start, end = decoder.spans[b'info']
+        self.raw_info = memoryview(decoder.data)[start:end]
+        return metadata
         
     @staticmethod    
     def decode_bytes(item):
+        if isinstance(item, RawValue):
+            item = item.decode()
+
         if isinstance(item, dict):
             new_dict = {}
             for key, value in item.items():
@@ -21,6 +68,9 @@ class TorrentDecoder:
                 new_value = TorrentDecoder.decode_bytes(value)
                 new_dict[new_key] = new_value
             return new_dict
+
+        elif isinstance(item, list):
+            return [TorrentDecoder.decode_bytes(value) for value in item]
         
         elif isinstance(item, bytes):
             try:
@@ -36,26 +86,39 @@ class TorrentDecoder:
     
     def get_piece_length(self):
         return int(self.metadata[b'info'][b'piece length'])
+
+    def get_files(self):
+
+        """
+        Returns the raw file dicts of a multi-file torrent, decoding them on first use
+        """
+
+        if self.files is None:
+            self.files = self.metadata[b'info'][b'files'].decode()
+        return self.files
     
     def get_file_length(self):
-        info = self.metadata[b'info'] 
-        if b'length' in info:
-            return int(info[b'length'])
-        else:
-            multi_file_length = 0
-            for file in info[b'files']:
-                multi_file_length += int(file[b'length'])
-                self.multi_file = True
-            return multi_file_length   
+        if self.file_length is None:
+            info = self.metadata[b'info'] 
+            if b'length' in info:
+                self.file_length = int(info[b'length'])
+            else:
+                self.file_length = sum(int(file[b'length']) for file in self.get_files())
+        return self.file_length
 
     def get_file_list(self):
+        if self.file_list is not None:
+            return self.file_list
+
         info = self.metadata[b'info']
         file_list = []
 
         if b'files' in info:
-            for file in info[b'files']:
-                part_path = [self.decode_bytes(_) for _ in file[b'path']]
-                path = "/".join(part_path)
+            for file in self.get_files():
+                try:
+                    path = b"/".join(file[b'path']).decode('utf-8')
+                except UnicodeDecodeError:
+                    path = "/".join(self.decode_bytes(_) for _ in file[b'path'])
                 file_list.append({
                     "Path": path,
                     "Length": int(file[b'length']) 
@@ -66,29 +129,60 @@ class TorrentDecoder:
                 "Length": int(info[b'length'])
             })  
 
+        self.file_list = file_list
         return file_list         
 
     def get_piece_hashes(self):
         all_pieces = []
-        pieces = self.metadata[b'info'][b'pieces']
+        pieces = self.piece_hashes
         for i in range(0, len(pieces), 20):
             new_piece = pieces[i: i + 20]
             all_pieces.append(new_piece)
         return all_pieces    
+
+    def get_piece_hash(self, index):
+        return self.piece_hashes[index * 20: index * 20 + 20]
     
     def get_announce(self):
-        announce = self.metadata.get(b'announce').decode('utf-8')
+        announce = self.metadata.get(b'announce')
+        if announce is None:
+            # Torrents built from a magnet link without trackers
+            return None
+        announce = announce.decode('utf-8')
         if announce[0] == "u":
             self.http = False
         return announce
     
+    def get_announce_list(self):
+
+        """
+        Returns tracker tiers from announce-list (BEP 12), or a single tier with the announce url
+        """
+
+        if b'announce-list' in self.metadata:
+            tiers = []
+            for tier in self.metadata[b'announce-list']:
+                urls = [url.decode('utf-8') for url in tier]
+                if urls:
+                    tiers.append(urls)
+            if tiers:
+                return tiers
+        announce = self.get_announce()
+        return [[announce]] if announce else []
+
     def get_info_hash(self):
-        encoded_info = bencodepy.encode(self.metadata[b'info'])
-        return hashlib.sha1(encoded_info).digest()
+
+        """
+        SHA-1 of the info dict exactly as it appears in the file, so torrents whose encoding is not
+        canonical still get the info hash the swarm uses
+        """
+
+        if self.info_hash is None:
+            self.info_hash = hashlib.sha1(self.raw_info).digest()
+        return self.info_hash
     
     def get_number_of_pieces(self):
-        pieces_field = self.metadata[b'info'][b'pieces']
-        return len(pieces_field) // 20
+        return len(self.piece_hashes) // 20
     
     def get_last_piece_length(self):
         total_length = self.get_file_length()
@@ -107,10 +201,17 @@ class TorrentDecoder:
             "port": port
         }
     
+    def is_private(self):
+
+        """
+        Private torrents (BEP 27) get their peers from their trackers only, never from the DHT or PEX
+        """
+
+        return self.metadata[b'info'].get(b'private') == 1
+
     def get_file_name(self):
         info = self.metadata[b'info']
         return self.decode_bytes(info[b'name'])
     
     def is_torrent_multi_file(self):
         return self.multi_file
-    
\ No newline at end of file
@@ -0,0 +1,81 @@
+import socket
+import struct
+import logging
+import bencoding
+from metadata import get_extended_message
+
+logger = logging.getLogger(__name__)
+
+# BEP 11: a message at most every minute, with at most 50 added and 50 dropped peers
+PEX_INTERVAL = 60
+MAX_PEX_PEERS = 50
+
+# Flags of added peers
+PEX_SEED = 0x02
+PEX_CONNECTABLE = 0x10
+
+def get_family(ip):
+
+    """
+    The address family of an ip, socket.AF_INET or socket.AF_INET6, None for a hostname
+    """
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, ip)
+            return family
+        except OSError:
+            pass
+    return None
+
+def encode_peers(peers, family=socket.AF_INET):
+    return b"".join(socket.inet_pton(family, ip) + struct.pack(">H", port) for ip, port in peers)
+
+def decode_peers(data, family=socket.AF_INET):
+    peers = []
+    if not isinstance(data, bytes):
+        return peers
+    size = 6 if family == socket.AF_INET else 18
+    for i in range(0, len(data) - size + 1, size):
+        port = struct.unpack(">H", data[i + size - 2:i + size])[0]
+        ip = socket.inet_ntop(family, data[i:i + size - 2])
+        if port and ip not in ("0.0.0.0", "::"):
+            peers.append((ip, port))
+    return peers
+
+def get_pex_message(peer_pex_id, added, dropped):
+
+    """
+    added maps (ip, port) to the peer's flags, dropped is a list of (ip, port). IPv6 peers go in
+    added6 and dropped6, peers known by hostname are left out
+    """
+
+    message = {}
+    for family, suffix in ((socket.AF_INET, b""), (socket.AF_INET6, b"6")):
+        family_added = {address: flags for address, flags in added.items() if get_family(address[0]) == family}
+        message[b"added" + suffix] = encode_peers(family_added, family)
+        message[b"added" + suffix + b".f"] = bytes(family_added.values())
+        message[b"dropped" + suffix] = encode_peers([address for address in dropped if get_family(address[0]) == family], family)
+    return get_extended_message(peer_pex_id, bencoding.encode(message))
+
+def parse_pex_message(payload):
+
+    """
+    Returns the added peers with their flags, and the dropped peers, of a ut_pex message. Only
+    the first MAX_PEX_PEERS of each are taken, so a peer cannot flood the pool
+    """
+
+    message = bencoding.decode(payload)
+    if not isinstance(message, dict):
+        raise bencoding.BencodeError("ut_pex message is not a dictionary")
+
+    added = {}
+    dropped = []
+    for family, suffix in ((socket.AF_INET, b""), (socket.AF_INET6, b"6")):
+        family_added = decode_peers(message.get(b"added" + suffix), family)[:MAX_PEX_PEERS - len(added)]
+        flags = message.get(b"added" + suffix + b".f")
+        if not isinstance(flags, bytes) or len(flags) < len(family_added):
+            flags = bytes(len(family_added))
+        added.update(zip(family_added, flags))
+        dropped += decode_peers(message.get(b"dropped" + suffix), family)[:MAX_PEX_PEERS - len(dropped)]
+    return added, dropped
@@ -0,0 +1,274 @@
+import random
+import logging
+from bitarray import bitarray
+from bitarray.util import ones, zeros
+
+logger = logging.getLogger(__name__)
+
+PICK_MODES = ("rarest", "sequential", "random")
+
+# Priorities of files, and of the pieces they are in. Skipped pieces are never picked
+PRIORITIES = {"skip": 0, "low": 1, "normal": 2, "high": 3}
+
+class PiecePicker:
+    def __init__(self, total_pieces, mode="rarest", random_first_pieces=4):
+        if mode not in PICK_MODES:
+            raise ValueError(f"Unknown piece picking mode {mode}, expected one of {PICK_MODES}")
+
+        self.total_pieces = total_pieces
+        self.mode = mode
+        # In rarest mode the first few pieces are picked at random so that we quickly have
+        # something to trade, rare pieces tend to be slow to get
+        self.random_first_pieces = random_first_pieces
+        self.have_count = 0
+
+        # buckets[a] lists the pickable pieces which a peers have. Pieces are removed by swapping
+        # with the last element, position[i] is the index of piece i inside its bucket. Seeds have
+        # every piece and would move all of them, so they are only counted in seeds, which is on
+        # top of the availability of every piece
+        self.availability = [0] * total_pieces
+        self.seeds = 0
+        self.pickable = ones(total_pieces, endian='big')
+        self.buckets = [list(range(total_pieces))]
+        self.position = list(range(total_pieces))
+
+        # Every piece below this index is known to be not pickable
+        self.sequential_cursor = 0
+
+        # Pieces needed by a time (time.monotonic()), e.g. those a stream is about to read, are
+        # picked before all others, earliest deadline first
+        self.deadlines = {}
+
+        # Pieces of skipped files are kept out of the pickable set, skipped marks those to put
+        # back if they are wanted again. priority_masks has the pieces of each priority, highest
+        # first, and is empty while all wanted pieces share one priority
+        self.wanted = ones(total_pieces, endian='big')
+        self.skipped = zeros(total_pieces, endian='big')
+        self.priority_masks = []
+
+    def bucket_add(self, availability, piece_index):
+        while len(self.buckets) <= availability:
+            self.buckets.append([])
+        bucket = self.buckets[availability]
+        self.position[piece_index] = len(bucket)
+        bucket.append(piece_index)
+
+    def bucket_remove(self, availability, piece_index):
+        bucket = self.buckets[availability]
+        position = self.position[piece_index]
+        last = bucket.pop()
+        if last != piece_index:
+            bucket[position] = last
+            self.position[last] = position
+
+    def peer_has(self, piece_index):
+
+        """
+        Increases the availability of a piece after a bitfield or have message
+        """
+
+        availability = self.availability[piece_index]
+        if self.pickable[piece_index]:
+            self.bucket_remove(availability, piece_index)
+            self.bucket_add(availability + 1, piece_index)
+        self.availability[piece_index] = availability + 1
+
+    def peer_lost(self, piece_index):
+
+        """
+        Decreases the availability of a piece when a peer that had it goes away
+        """
+
+        availability = self.availability[piece_index]
+        if availability == 0:
+            return
+        if self.pickable[piece_index]:
+            self.bucket_remove(availability, piece_index)
+            self.bucket_add(availability - 1, piece_index)
+        self.availability[piece_index] = availability - 1
+
+    def add_peer(self, pieces):
+        if pieces.all():
+            self.seeds += 1
+            return
+        for piece_index in pieces.search(1):
+            self.peer_has(piece_index)
+
+    def remove_peer(self, pieces):
+        if pieces.all():
+            self.seeds -= 1
+            return
+        for piece_index in pieces.search(1):
+            self.peer_lost(piece_index)
+
+    def peer_completed(self):
+
+        """
+        Counts a peer whose have messages completed its bitfield as a seed from now on, so that
+        remove_peer takes it off the seeds
+        """
+
+        for piece_index in range(self.total_pieces):
+            self.peer_lost(piece_index)
+        self.seeds += 1
+
+    def start(self, piece_index):
+
+        """
+        Takes a piece out of the pickable set when a peer starts downloading it
+        """
+
+        if self.pickable[piece_index]:
+            self.bucket_remove(self.availability[piece_index], piece_index)
+            self.pickable[piece_index] = 0
+
+    def abort(self, piece_index):
+
+        """
+        Makes a piece pickable again after its download failed
+        """
+
+        if not self.pickable[piece_index]:
+            if not self.wanted[piece_index]:
+                self.skipped[piece_index] = 1
+                return
+            self.pickable[piece_index] = 1
+            self.bucket_add(self.availability[piece_index], piece_index)
+            self.sequential_cursor = min(self.sequential_cursor, piece_index)
+
+    def complete(self, piece_index):
+        self.start(piece_index)
+        self.skipped[piece_index] = 0
+        self.have_count += 1
+        self.deadlines.pop(piece_index, None)
+
+    def set_priorities(self, priorities):
+
+        """
+        Takes the priority of every piece (a sequence of PRIORITIES values). Pieces which are
+        started or complete are left alone, they were taken out of the pickable set already
+        """
+
+        wanted = bitarray([priority > 0 for priority in priorities], endian='big')
+        for piece_index in (self.wanted & ~wanted).search(1):
+            if self.pickable[piece_index]:
+                self.start(piece_index)
+                self.skipped[piece_index] = 1
+        self.wanted = wanted
+        for piece_index in (self.skipped & wanted).search(1):
+            self.skipped[piece_index] = 0
+            self.abort(piece_index)
+
+        levels = sorted({priority for priority in priorities if priority > 0}, reverse=True)
+        self.priority_masks = []
+        if len(levels) > 1:
+            self.priority_masks = [bitarray([priority == level for priority in priorities], endian='big')
+                                   for level in levels]
+
+    def set_deadlines(self, deadlines):
+
+        """
+        Replaces the deadlines, a dict of piece index to the time the piece is needed by
+        """
+
+        self.deadlines = deadlines
+
+    def pick(self, peer_pieces, suggested=None):
+
+        """
+        Returns the next piece to download out of the pieces a peer has (a bitarray), or None.
+        Pieces the peer suggested (a list, BEP 6) come first within the priority level picked
+        from, pieces with deadlines still come before them
+        """
+
+        if self.deadlines:
+            piece_index = self.pick_deadline(peer_pieces)
+            if piece_index is not None:
+                return piece_index
+
+        # Higher priorities first, within one the pick mode decides
+        for mask in self.priority_masks:
+            candidates = peer_pieces & mask
+            if candidates.any():
+                piece_index = self.pick_suggested(candidates, suggested) if suggested else None
+                if piece_index is None:
+                    piece_index = self.pick_by_mode(candidates)
+                if piece_index is not None:
+                    return piece_index
+        if self.priority_masks:
+            return None
+
+        if suggested:
+            piece_index = self.pick_suggested(peer_pieces, suggested)
+            if piece_index is not None:
+                return piece_index
+        return self.pick_by_mode(peer_pieces)
+
+    def pick_suggested(self, candidates, suggested):
+
+        """
+        Takes the first suggested piece out of the candidates off the list, suggestions which can
+        no longer be picked are dropped on the way
+        """
+
+        for piece_index in list(suggested):
+            if not self.pickable[piece_index]:
+                suggested.remove(piece_index)
+            elif candidates[piece_index]:
+                suggested.remove(piece_index)
+                return piece_index
+        return None
+
+    def pick_by_mode(self, peer_pieces):
+        if self.mode == "sequential":
+            return self.pick_sequential(peer_pieces)
+
+        if self.mode == "random" or self.have_count < self.random_first_pieces:
+            piece_index = self.pick_random(peer_pieces)
+            if piece_index is not None:
+                return piece_index
+
+        return self.pick_rarest(peer_pieces)
+
+    def pick_rarest(self, peer_pieces):
+
+        """
+        Walks the availability buckets from the rarest up and returns a piece the peer has.
+        Scanning a bucket starts at a random position so that ties are broken randomly. Pieces
+        of bucket 0 are only had by seeds, if there are any
+        """
+
+        for availability in range(0 if self.seeds else 1, len(self.buckets)):
+            bucket = self.buckets[availability]
+            size = len(bucket)
+            if not size:
+                continue
+            start = random.randrange(size)
+            for k in range(size):
+                piece_index = bucket[(start + k) % size]
+                if peer_pieces[piece_index]:
+                    return piece_index
+        return None
+
+    def pick_deadline(self, peer_pieces):
+        for piece_index in sorted(self.deadlines, key=self.deadlines.get):
+            if self.pickable[piece_index] and peer_pieces[piece_index]:
+                return piece_index
+        return None
+
+    def pick_random(self, peer_pieces, attempts=32):
+        if not self.total_pieces:
+            return None
+        for _ in range(attempts):
+            piece_index = random.randrange(self.total_pieces)
+            if self.pickable[piece_index] and peer_pieces[piece_index]:
+                return piece_index
+        return None
+
+    def pick_sequential(self, peer_pieces):
+        while self.sequential_cursor < self.total_pieces and not self.pickable[self.sequential_cursor]:
+            self.sequential_cursor += 1
+
+        candidates = self.pickable & peer_pieces
+        piece_index = candidates.find(1, self.sequential_cursor)
+        return piece_index if piece_index >= 0 else None
@@ -0,0 +1,80 @@
+import math
+from bitarray.util import zeros
+
+class PieceBuffer:
+    def __init__(self, piece_index, length, block_size=16384):
+        self.piece_index = piece_index
+        self.length = length
+        self.block_size = block_size
+        self.total_blocks = math.ceil(length / block_size)
+
+        # Blocks are written into one buffer per piece, whichever peer they come from
+        self.data = bytearray(length)
+        self.received = zeros(self.total_blocks, endian='big')
+
+        # Peers with an outstanding request for each block, more than one only in endgame.
+        # requested mirrors which blocks have any requester so free blocks are found with bit ops
+        self.requesters = [set() for _ in range(self.total_blocks)]
+        self.requested = zeros(self.total_blocks, endian='big')
+        self.verifying = False
+
+    def get_block_length(self, block):
+        return min(self.block_size, self.length - block * self.block_size)
+
+    def get_request(self, block):
+        return self.piece_index, block * self.block_size, self.get_block_length(block)
+
+    def add_requester(self, block, peer):
+        self.requesters[block].add(peer)
+        self.requested[block] = 1
+
+    def remove_requester(self, block, peer):
+        self.requesters[block].discard(peer)
+        if not self.requesters[block]:
+            self.requested[block] = 0
+
+    def clear_requesters(self, block):
+        self.requesters[block].clear()
+        self.requested[block] = 0
+
+    def free_blocks(self):
+
+        """
+        Returns the blocks that neither arrived nor are requested by anyone
+        """
+
+        return (~(self.received | self.requested)).search(1)
+
+    def write_block(self, offset, data):
+
+        """
+        Copies a block into the piece and returns False if it was already there
+        """
+
+        block = offset // self.block_size
+        if self.received[block]:
+            return False
+        self.data[offset:offset + len(data)] = data
+        self.received[block] = 1
+        return True
+
+    def missing_blocks(self):
+        return self.total_blocks - self.received.count()
+
+    def is_complete(self):
+        return self.received.all()
+
+    def is_idle(self):
+
+        """
+        True if no block arrived and nobody is requesting any, so the buffer can be dropped
+        """
+
+        return not self.received.any() and not self.requested.any()
+
+    def reset(self):
+        self.received.setall(0)
+        self.requested.setall(0)
+        for requesters in self.requesters:
+            requesters.clear()
+        self.verifying = False
@@ -0,0 +1,165 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    def __init__(self, rate=0, burst_time=1):
+        # rate in bytes per second, 0 means unlimited. The bucket holds up to burst_time seconds
+        # of tokens, so transfers below the rate never wait
+        self.burst_time = burst_time
+        self.rate = 0
+        self.capacity = 0
+        self.tokens = 0
+        self.last_refill = time.monotonic()
+
+        # Consumers that ran out of tokens, served first come first served as the bucket refills
+        self.waiters = deque()
+        self.timer = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.refill()
+        limited = bool(self.rate)
+        self.rate = rate
+        self.capacity = max(rate * self.burst_time, 65536)
+        self.tokens = min(self.tokens, self.capacity) if limited else self.capacity
+        if self.waiters:
+            self.wake()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def available(self):
+
+        """
+        Returns how many bytes may be sent right now without waiting
+        """
+
+        if not self.rate:
+            return float("inf")
+        self.refill()
+        if self.waiters:
+            return 0
+        return max(0, int(self.tokens))
+
+    def take(self, amount):
+        if self.rate:
+            self.tokens -= amount
+
+    def refund(self, amount):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + amount)
+            if self.waiters:
+                self.wake()
+
+    async def consume(self, amount):
+
+        """
+        Takes amount bytes from the bucket, waiting behind earlier consumers while it is empty.
+        The bucket may go into debt, which later consumers wait off
+        """
+
+        if not self.rate:
+            return
+        self.refill()
+        if self.tokens > 0 and not self.waiters:
+            self.tokens -= amount
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((future, amount))
+        self.schedule()
+        await future
+
+    def schedule(self):
+        if self.timer is None and self.waiters and self.rate:
+            delay = max(0, -self.tokens) / self.rate
+            self.timer = asyncio.get_running_loop().call_later(delay, self.wake)
+
+    def wake(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.refill()
+        while self.waiters and (self.tokens > 0 or not self.rate):
+            future, amount = self.waiters.popleft()
+            if future.done():
+                continue
+            self.take(amount)
+            future.set_result(None)
+        self.schedule()
+
+class PeerRateLimits:
+    def __init__(self, download_rate=0, upload_rate=0):
+        self.download = TokenBucket(download_rate)
+        self.upload = TokenBucket(upload_rate)
+
+class RateLimiter:
+    def __init__(self, download_rate=0, upload_rate=0, peer_download_rate=0, peer_upload_rate=0):
+        # Every transfer passes through the peer's own buckets and the global ones. Rates are in
+        # bytes per second, 0 means unlimited
+        self.download = TokenBucket(download_rate)
+        self.upload = TokenBucket(upload_rate)
+        self.peer_download_rate = peer_download_rate
+        self.peer_upload_rate = peer_upload_rate
+        self.peers = set()
+
+    def add_peer(self):
+        limits = PeerRateLimits(self.peer_download_rate, self.peer_upload_rate)
+        self.peers.add(limits)
+        return limits
+
+    def remove_peer(self, limits):
+        self.peers.discard(limits)
+
+    def set_rates(self, download_rate=None, upload_rate=None, peer_download_rate=None, peer_upload_rate=None):
+
+        """
+        Changes limits while connections are running, None leaves a limit as it is
+        """
+
+        if download_rate is not None:
+            self.download.set_rate(download_rate)
+        if upload_rate is not None:
+            self.upload.set_rate(upload_rate)
+        if peer_download_rate is not None:
+            self.peer_download_rate = peer_download_rate
+            for limits in self.peers:
+                limits.download.set_rate(peer_download_rate)
+        if peer_upload_rate is not None:
+            self.peer_upload_rate = peer_upload_rate
+            for limits in self.peers:
+                limits.upload.set_rate(peer_upload_rate)
+        logger.info(f"Rate limits: download {self.download.rate}, upload {self.upload.rate}, "
+                    f"per peer {self.peer_download_rate}/{self.peer_upload_rate} bytes/s")
+
+    def take_download(self, limits, amount):
+
+        """
+        Grants up to amount bytes of download without waiting. No connection is granted more
+        than its share of the global bucket at once, so the fastest peer cannot drain it
+        """
+
+        share = self.download.capacity // max(1, len(self.peers)) if self.download.rate else amount
+        granted = min(amount, share, limits.download.available(), self.download.available())
+        limits.download.take(granted)
+        self.download.take(granted)
+        return granted
+
+    def refund_download(self, limits, amount):
+        limits.download.refund(amount)
+        self.download.refund(amount)
+
+    async def acquire_download(self, limits, amount):
+        await limits.download.consume(amount)
+        await self.download.consume(amount)
+
+    async def acquire_upload(self, limits, amount):
+        await limits.upload.consume(amount)
+        await self.upload.consume(amount)
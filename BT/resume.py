@@ -0,0 +1,126 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import bencoding
+from bitarray import bitarray
+from bitarray.util import zeros
+
+logger = logging.getLogger(__name__)
+
+class ResumeData:
+    def __init__(self, torrent, storage, info_hash):
+        self.torrent = torrent
+        self.storage = storage
+        self.info_hash = info_hash
+        self.total_pieces = torrent.get_number_of_pieces()
+        self.path = os.path.join(storage.download_dir, torrent.get_file_name() + ".resume")
+
+    def get_file_state(self):
+
+        """
+        Returns size and modification time of every file of the torrent, None for files missing on disk
+        """
+
+        state = []
+        for file in self.storage.files:
+            try:
+                st = os.stat(file["Path"])
+            except FileNotFoundError:
+                state.append(None)
+                continue
+            state.append({b"length": st.st_size, b"mtime": st.st_mtime_ns})
+        return state
+
+    def load(self):
+
+        """
+        Returns a bitarray of verified pieces from the resume file, or None if there is no resume file
+        or the files on disk changed since it was written
+        """
+
+        try:
+            with open(self.path, "rb") as f:
+                data = bencoding.decode(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.info(f"Ignoring unreadable resume file {self.path}: {e}")
+            return None
+
+        if data.get(b"info hash") != self.info_hash:
+            logger.info("Resume file belongs to another torrent, ignoring it")
+            return None
+
+        if list(data.get(b"files", [])) != self.get_file_state():
+            logger.info("Files changed since resume file was written")
+            return None
+
+        pieces = bitarray(endian='big')
+        pieces.frombytes(data[b"pieces"])
+        if len(pieces) < self.total_pieces:
+            logger.info("Resume file has a truncated bitfield, ignoring it")
+            return None
+        del pieces[self.total_pieces:]
+        logger.info(f"Resuming with {pieces.count()}/{self.total_pieces} pieces")
+        return pieces
+
+    def save(self, have_pieces):
+
+        """
+        Writes the verified pieces together with the current file sizes and mtimes
+        """
+
+        data = {
+            b"info hash": self.info_hash,
+            b"pieces": have_pieces.tobytes(),
+            b"files": self.get_file_state()
+        }
+
+        # Write to a temporary file first so that an interrupted save never leaves a broken resume file
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(bencoding.encode(data))
+        os.replace(temp_path, self.path)
+
+    async def recheck(self, executor=None):
+
+        """
+        Hashes the data already on disk against the piece hashes of the torrent and returns a bitarray
+        of the pieces which are valid. Pieces are hashed in parallel on the executor since hashlib
+        releases the GIL for large buffers. Pieces touching files that did not exist before, or skipped
+        files never written to, are not checked
+        """
+
+        piece_length = self.torrent.get_piece_length()
+        last_piece_length = self.torrent.get_last_piece_length()
+
+        def check(index):
+            length = last_piece_length if index == self.total_pieces - 1 else piece_length
+            data = self.storage.read_piece(index, length)
+            return hashlib.sha1(data).digest() == self.torrent.get_piece_hash(index)
+
+        candidates = []
+        for index in range(self.total_pieces):
+            length = last_piece_length if index == self.total_pieces - 1 else piece_length
+            files = self.storage.map_range(index * piece_length, length)
+            if not any(self.storage.is_missing(i) for i, _, _ in files):
+                candidates.append(index)
+
+        pieces = zeros(self.total_pieces, endian='big')
+        if not candidates:
+            return pieces
+
+        logger.info(f"Checking {len(candidates)} pieces already on disk...")
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(loop.run_in_executor(executor, check, index) for index in candidates))
+        elapsed = max(time.monotonic() - start, 1e-6)
+
+        for index, valid in zip(candidates, results):
+            pieces[index] = valid
+        checked_mib = len(candidates) * piece_length / (1024 * 1024)
+        logger.info(f"Recheck found {pieces.count()}/{self.total_pieces} valid pieces "
+                    f"({checked_mib:.1f} MiB in {elapsed:.2f}s, {checked_mib / elapsed:.1f} MiB/s)")
+        return pieces
@@ -0,0 +1,774 @@
+import os
+import random
+import string
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+from parser import TorrentDecoder
+from magnet import parse_magnet
+from metadata import MetadataFetcher
+from tracker import Tracker
+from handshake import Handshake
+from exchange import exchange
+from PieceManager import PieceManager
+from picker import PRIORITIES
+from storage import Storage
+from resume import ResumeData
+from choker import Choker
+from rate_limiter import RateLimiter
+from connection_manager import ConnectionManager, ConnectionBudget
+from dht import DHTNode, BOOTSTRAP_NODES
+from stream import StreamServer
+from metrics import REGISTRY, LoopLagMonitor, MetricsServer, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+torrent_pieces = REGISTRY.gauge("bt_torrent_pieces", "Pieces of a torrent by state: have, downloading, wanted or total")
+torrent_bytes = REGISTRY.gauge("bt_torrent_bytes", "Bytes of a torrent downloaded, uploaded or left")
+torrent_peers = REGISTRY.gauge("bt_torrent_peers", "Connected peers of a torrent")
+verify_queue_depth = REGISTRY.gauge("bt_verify_queue_depth", "Pieces of a torrent waiting for or being hashed")
+peer_download_rate = REGISTRY.gauge("bt_peer_download_rate_bytes", "Download rate from a peer in bytes per second")
+peer_inflight = REGISTRY.gauge("bt_peer_inflight_requests", "Blocks requested from a peer and not received yet")
+peer_choked = REGISTRY.gauge("bt_peer_choked", "1 while the peer chokes us (direction=in) or we choke it (direction=out)")
+connections_used = REGISTRY.gauge("bt_connections", "Peer connections in use out of the session's budget")
+dht_nodes = REGISTRY.gauge("bt_dht_nodes", "Nodes in the DHT routing table")
+dht_lookup_latency = REGISTRY.gauge("bt_dht_lookup_latency_seconds", "Average duration of recent DHT lookups")
+
+def check_priorities(priorities):
+    for priority in priorities:
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown file priority {priority}, expected one of {list(PRIORITIES)}")
+
+def generate_peer_id():
+    id = "-SB001-"
+    characters = string.ascii_lowercase + string.digits
+    result = "".join(random.choices(characters, k=13))
+    return id + result
+
+class TorrentHandle:
+    def __init__(self, session, torrent_path, download_dir="", seed=False, pick_mode="rarest",
+                 endgame_threshold=64, max_peers=50, stream_port=None, stream_file=None, file_priorities=None,
+                 default_file_priority="normal"):
+        self.session = session
+        self.torrent = None
+        self.metadata = None
+
+        # A magnet link only gives the info hash, the torrent is built once the info dict has
+        # been fetched from peers. Peers found meanwhile are kept for the swarm
+        self.magnet = None
+        self.initial_peers = []
+        if torrent_path.startswith("magnet:"):
+            self.magnet = parse_magnet(torrent_path)
+            self.info_hash = self.magnet["info_hash"]
+            self.name = self.magnet["name"]
+            self.initial_peers = list(self.magnet["peers"])
+            if not self.magnet["trackers"] and not self.initial_peers and session.dht is None:
+                raise ValueError(f"Magnet link for {self.name} has no trackers or peers to get the metadata from")
+        else:
+            self.set_torrent(TorrentDecoder(torrent_path))
+
+        self.download_dir = download_dir
+        self.seed = seed
+        self.pick_mode = pick_mode
+        self.endgame_threshold = endgame_threshold
+        self.max_peers = max_peers
+
+        # With a stream_port, one file (stream_file, by default the largest) is served over HTTP
+        # on localhost while it downloads, from the moment the files are open
+        self.stream_port = stream_port
+        self.stream_file = stream_file
+        self.stream_server = None
+
+        # Priority names (see PRIORITIES) by file index, files not listed get default_file_priority.
+        # Skipped files are neither downloaded nor created, apart from pieces shared with wanted files
+        self.file_priorities = dict(file_priorities or {})
+        self.default_file_priority = default_file_priority
+        check_priorities(list(self.file_priorities.values()) + [default_file_priority])
+
+        # One of metadata, checking, queued, downloading, seeding, complete, stopped or failed
+        self.state = "checking"
+        self.storage = None
+        self.piece_manager = None
+        self.tracker = None
+        self.choker = None
+        self.connection_manager = None
+        self.inbound = set()
+        self.task = None
+
+    def set_torrent(self, torrent):
+        self.torrent = torrent
+        self.metadata = torrent.get_metadata(self.session.port, self.session.peer_id)
+        self.info_hash = self.metadata["info_hash"]
+        self.name = torrent.get_file_name()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def get_file_priorities(self):
+
+        """
+        Returns the priority value of every file of the torrent
+        """
+
+        priorities = [PRIORITIES[self.default_file_priority]] * len(self.torrent.get_file_list())
+        for index, priority in self.file_priorities.items():
+            if 0 <= index < len(priorities):
+                priorities[index] = PRIORITIES[priority]
+            else:
+                logger.info(f"{self.name} has no file {index}, ignoring its priority")
+        return priorities
+
+    def set_file_priorities(self, file_priorities, default_file_priority=None):
+
+        """
+        Changes the priorities of some files, by index, while the torrent runs. Files which become
+        wanted are downloaded, files which become skipped are no longer requested
+        """
+
+        check_priorities(list(file_priorities.values()) + [default_file_priority or self.default_file_priority])
+        self.file_priorities.update(file_priorities)
+        if default_file_priority is not None:
+            self.default_file_priority = default_file_priority
+
+        if self.piece_manager is not None:
+            priorities = self.get_file_priorities()
+            self.storage.set_skipped(i for i, priority in enumerate(priorities) if not priority)
+            self.piece_manager.set_file_priorities(priorities)
+
+    async def wait(self):
+
+        """
+        Waits until the torrent finished downloading, or stopped seeding
+        """
+
+        await asyncio.wait([self.task])
+
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.wait([self.task])
+        if self.stream_server is not None:
+            self.stream_server.close()
+            self.stream_server = None
+
+    def get_status(self):
+        status = {
+            "name": self.name,
+            "info_hash": self.info_hash.hex(),
+            "state": self.state,
+            "peers": 0
+        }
+        if self.piece_manager is not None:
+            status.update(self.piece_manager.get_transfer_stats())
+            status["have"] = self.piece_manager.have_pieces.count()
+            status["wanted"] = self.piece_manager.wanted_pieces.count()
+            status["total"] = self.piece_manager.total_pieces
+            status["peers"] = len(self.piece_manager.peers)
+        return status
+
+    async def connect_peer(self, ip, port):
+
+        """
+        Connects to a peer from the tracker and runs the exchange with it
+        """
+
+        handshake = Handshake(
+            ip = ip,
+            port = port,
+            info_hash = self.info_hash,
+            peer_id = self.session.peer_id,
+            timeout = self.session.connect_timeout
+        )
+
+        if not await handshake.connect_with_peer():
+            return {"connected": False, "downloaded": 0}
+
+        return await self.run_exchange(handshake, ip, port)
+
+    async def connect_metadata_peer(self, fetcher, ip, port):
+
+        """
+        Connects to a peer and fetches what it can give us of the info dict
+        """
+
+        handshake = Handshake(
+            ip = ip,
+            port = port,
+            info_hash = self.info_hash,
+            peer_id = self.session.peer_id,
+            timeout = self.session.connect_timeout
+        )
+
+        if not await handshake.connect_with_peer():
+            return {"connected": False, "downloaded": 0}
+
+        downloaded = 0
+        try:
+            if handshake.peer_supports_extensions():
+                downloaded = await fetcher.fetch_from_peer(handshake.reader, handshake.writer, ip)
+        finally:
+            await handshake.close_writer(handshake.writer)
+        return {"connected": True, "downloaded": downloaded}
+
+    async def fetch_metadata(self):
+
+        """
+        Gets the info dict of a magnet link from peers (BEP 9), pieces of it from several peers at
+        once, and builds the torrent from it. Returns False if no peer could give it to us
+        """
+
+        fetcher = MetadataFetcher(self.info_hash)
+        announce_list = [[url] for url in self.magnet["trackers"]]
+        logger.info(f"Fetching metadata of {self.name} from peers...")
+
+        connection_manager = ConnectionManager(
+            connect_peer = lambda ip, port: self.connect_metadata_peer(fetcher, ip, port),
+            max_active = self.max_peers,
+            budget = self.session.connection_budget
+        )
+        connection_manager.add_peers(self.initial_peers)
+
+        dht_task = None
+        if self.session.dht is not None:
+            dht_task = asyncio.create_task(self.session.dht.run_announces(self.info_hash, self.session.port,
+                                                                          connection_manager.add_peers))
+
+        tracker = None
+        if announce_list:
+            # How much is left is not known before the metadata, any non-zero amount gets us seeders
+            tracker = Tracker(
+                announce_list = announce_list,
+                info_hash = self.info_hash,
+                peer_id = self.session.peer_id,
+                port = self.session.port,
+                file_length = 1,
+                http_session = self.session.http_session,
+                udp_trackers = self.session.udp_trackers
+            )
+            connection_manager.on_starved = tracker.request_announce
+
+        manager_task = tracker_task = done_task = None
+        try:
+            manager_task = asyncio.create_task(connection_manager.run())
+            done_task = asyncio.create_task(fetcher.done.wait())
+            if tracker is not None:
+                tracker_task = asyncio.create_task(tracker.run(connection_manager.add_peers, initial_event="started"))
+            await asyncio.wait([manager_task, done_task], return_when=asyncio.FIRST_COMPLETED)
+
+        finally:
+            for task in (manager_task, tracker_task, done_task, dht_task):
+                if task is not None:
+                    task.cancel()
+            await connection_manager.close()
+            self.initial_peers = list(connection_manager.peers)
+
+        if fetcher.raw_info is None:
+            return False
+        self.set_torrent(TorrentDecoder.from_info(fetcher.raw_info, announce_list))
+        return True
+
+    async def run_exchange(self, handshake, ip, port=None):
+
+        """
+        Runs the message exchange with a peer after the handshake, whichever side connected. port
+        is the peer's port if we connected to it
+        """
+
+        # Peers learned through PEX go into the connection pool, except for private torrents
+        on_peers = None if self.torrent.is_private() else self.connection_manager.add_peers
+
+        ex = exchange(
+            info_hash = handshake.info_hash,
+            peer_id = handshake.peer_id,
+            ip = ip,
+            piece_length = self.torrent.get_piece_length(),
+            total_pieces = self.torrent.get_number_of_pieces(),
+            last_piece_length = self.torrent.get_last_piece_length(),
+            piece_manager = self.piece_manager,
+            torrent = self.torrent,
+            writer = handshake.writer,
+            reader = handshake.reader,
+            verify_executor = self.session.verify_executor,
+            choker = self.choker,
+            rate_limiter = self.session.rate_limiter,
+            extensions = handshake.peer_supports_extensions(),
+            listen_port = self.session.port,
+            peer_port = port,
+            on_peers = on_peers,
+            fast = handshake.peer_supports_fast()
+        )
+
+        try:
+            await ex.run()
+        except Exception as e:
+            logger.debug(f"Error exchanging with {ip}: {e}")
+        finally:
+            await ex.disconnect()
+
+        return {"connected": True, "downloaded": ex.downloaded}
+
+    async def accept_peer(self, handshake, ip):
+
+        """
+        Runs the exchange with a peer which connected to us, once the torrent is in a swarm
+        """
+
+        if self.piece_manager is None or self.connection_manager is None:
+            await handshake.close_writer(handshake.writer)
+            return
+
+        task = asyncio.current_task()
+        self.inbound.add(task)
+        try:
+            await self.run_exchange(handshake, ip)
+        finally:
+            self.inbound.discard(task)
+
+    async def check(self):
+
+        """
+        Opens the files and finds out which pieces are already on disk
+        """
+
+        priorities = self.get_file_priorities()
+        names = {value: name for name, value in PRIORITIES.items()}
+        for i, file in enumerate(self.torrent.get_file_list()):
+            logger.info(f"File {i}:  {file['Path']} ||  File size:  {file['Length']} ||  Priority:  {names[priorities[i]]}")
+
+        logger.debug("\n===================")
+        logger.debug(f"Length of each piece: {self.torrent.get_piece_length():,}")
+        logger.debug(f"Total File length: {self.torrent.get_file_length():,}")
+        logger.debug(f"Number of pieces: {self.torrent.get_number_of_pieces()}")
+        logger.debug("===================\n")
+
+        self.storage = Storage(self.torrent, self.download_dir)
+        self.storage.set_skipped(i for i, priority in enumerate(priorities) if not priority)
+        resume = ResumeData(self.torrent, self.storage, self.info_hash)
+        have_pieces = resume.load()
+        self.storage.open()
+        if have_pieces is None:
+            have_pieces = await resume.recheck(self.session.verify_executor)
+
+        self.piece_manager = PieceManager(total_pieces=self.torrent.get_number_of_pieces(), torrent=self.torrent,
+                                          storage=self.storage, resume=resume, pick_mode=self.pick_mode,
+                                          endgame_threshold=self.endgame_threshold)
+        self.piece_manager.set_file_priorities(priorities)
+        self.piece_manager.load_pieces(have_pieces)
+
+    async def start_stream(self):
+        stream_server = StreamServer(self.piece_manager, self.storage, file_index=self.stream_file, port=self.stream_port)
+        try:
+            await stream_server.start()
+            self.stream_server = stream_server
+        except (OSError, ValueError) as e:
+            logger.info(f"Could not stream {self.name}: {e}")
+            stream_server.close()
+
+    async def run(self):
+
+        """
+        Checks the torrent, waits for a download slot, downloads from the swarm and, if asked to,
+        seeds afterwards. Cancelling it (stop) leaves the swarm with a stopped announce
+        """
+
+        try:
+            if self.torrent is None:
+                self.state = "metadata"
+                if not await self.fetch_metadata():
+                    logger.info(f"Could not get the metadata of {self.name}")
+                    self.state = "failed"
+                    return
+
+            self.state = "checking"
+            await self.check()
+            if self.stream_port:
+                await self.start_stream()
+
+            already_complete = self.piece_manager.is_seeding()
+            if already_complete and not self.seed:
+                logger.info(f"All wanted pieces of {self.name} are already on disk")
+                self.piece_manager.write_to_file()
+                self.state = "complete"
+                return
+
+            if not already_complete:
+                self.state = "queued"
+                await self.session.acquire_download_slot(self)
+
+            await self.join_swarm(already_complete)
+
+        except asyncio.CancelledError:
+            # Stopped before joining the swarm, only the files need closing
+            self.state = "stopped"
+            if self.storage is not None:
+                self.storage.close()
+            raise
+
+        except Exception as e:
+            # Nobody retrieves the task's exception, the state tells what happened
+            logger.error(f"{self.name} failed: {e}")
+            logger.debug("Traceback of the failure", exc_info=True)
+            self.state = "failed"
+            if self.storage is not None:
+                self.storage.close()
+            if self.stream_server is not None:
+                self.stream_server.close()
+                self.stream_server = None
+
+        finally:
+            self.session.release_download_slot(self)
+
+    async def join_swarm(self, already_complete):
+        piece_manager = self.piece_manager
+        self.state = "seeding" if already_complete else "downloading"
+
+        # Peers connecting to us are served from the same piece manager, unchoked by the choker
+        self.choker = Choker(piece_manager, upload_slots=self.session.upload_slots)
+
+        # All torrents share the session's HTTP connection pool and UDP tracker connections
+        self.tracker = Tracker(
+            announce_list = self.torrent.get_announce_list(),
+            info_hash = self.info_hash,
+            peer_id = self.session.peer_id,
+            port = self.session.port,
+            file_length = self.metadata["file length"],
+            http_session = self.session.http_session,
+            udp_trackers = self.session.udp_trackers
+        )
+        self.tracker.update_stats(**piece_manager.get_transfer_stats())
+
+        # Peers from every announce go into one pool, the connection manager keeps at most
+        # max_peers of them connected, within the session's connection budget
+        self.connection_manager = ConnectionManager(
+            connect_peer = self.connect_peer,
+            max_active = self.max_peers,
+            on_starved = self.tracker.request_announce,
+            budget = self.session.connection_budget
+        )
+
+        cancelled = False
+        manager_task = tracker_task = completed_task = choker_task = dht_task = None
+        try:
+            # Peers from the DHT stream into the pool while the tracker is still being asked, and the
+            # first announce runs in the tracker's task, so that a tracker which is down or slow
+            # does not hold up the download or noticing that it completed
+            logger.info(f"Gathering pieces of {self.name} from peers...")
+            self.connection_manager.add_peers(self.initial_peers)
+            manager_task = asyncio.create_task(self.connection_manager.run())
+            if self.session.dht is not None and not self.torrent.is_private():
+                dht_task = asyncio.create_task(self.session.dht.run_announces(self.info_hash, self.session.port,
+                                                                              self.connection_manager.add_peers))
+
+            completed_task = asyncio.create_task(piece_manager.completed.wait())
+            choker_task = asyncio.create_task(self.choker.run())
+            tracker_task = asyncio.create_task(self.tracker.run(self.connection_manager.add_peers,
+                                                                piece_manager.get_transfer_stats,
+                                                                initial_event="started"))
+
+            await asyncio.wait([manager_task, completed_task], return_when=asyncio.FIRST_COMPLETED)
+            self.session.release_download_slot(self)
+
+            if self.seed and piece_manager.is_seeding():
+                if not already_complete:
+                    logger.info(f"Download of {self.name} complete")
+                    await self.tracker.announce("completed")
+                self.state = "seeding"
+                logger.info(f"Seeding {self.name}")
+                await tracker_task
+
+        except asyncio.CancelledError:
+            cancelled = True
+            logger.info(f"Stopping {self.name}")
+
+        finally:
+            for task in (manager_task, tracker_task, completed_task, choker_task, dht_task):
+                if task is not None:
+                    task.cancel()
+            for task in list(self.inbound):
+                task.cancel()
+            await asyncio.gather(*self.inbound, return_exceptions=True)
+            await self.connection_manager.close()
+            piece_manager.save_resume()
+
+        complete = await piece_manager.is_download_complete()
+        await self.tracker.stop("completed" if complete and not self.seed else "stopped",
+                                piece_manager.get_transfer_stats)
+
+        info = await piece_manager.get_info()
+        logger.debug(f"Info: {info}")
+
+        if complete:
+            logger.info("Attempting to download file(s) to disk now...")
+            piece_manager.write_to_file()
+            self.state = "stopped" if cancelled else "complete"
+        else:
+            self.storage.close()
+            self.state = "stopped" if cancelled else "failed"
+            if not cancelled:
+                logger.info(f"{self.name} could not be downloaded, please retry downloading this torrent")
+
+class Session:
+    def __init__(self, port=6885, max_connections=200, max_active_downloads=3, connect_timeout=3,
+                 upload_slots=4, download_rate=0, upload_rate=0, peer_download_rate=0, peer_upload_rate=0,
+                 dht=True, dht_state_path=None, dht_bootstrap=BOOTSTRAP_NODES, progress_interval=10,
+                 metrics_port=None, metrics_json=None, verify_threads=None):
+        self.port = port
+        self.peer_id = generate_peer_id()
+        self.connect_timeout = connect_timeout
+        self.upload_slots = upload_slots
+
+        # Torrents by info hash, inbound connections are routed by the info hash of their handshake
+        self.torrents = {}
+
+        # Budgets shared by all torrents: connection slots, bandwidth (bytes per second) and the
+        # number of torrents downloading at once. Further torrents wait in order of addition
+        self.connection_budget = ConnectionBudget(max_connections)
+        self.rate_limiter = RateLimiter(download_rate, upload_rate, peer_download_rate, peer_upload_rate)
+        self.max_active_downloads = max_active_downloads
+        self.active_downloads = set()
+        self.download_queue = []
+        self.download_slots_changed = asyncio.Condition()
+
+        # SHA-1 checks run on a pool of verify_threads threads, one per CPU by default, shared by
+        # all peers. hashlib releases the GIL while hashing
+        self.verify_executor = ThreadPoolExecutor(max_workers=verify_threads or os.cpu_count())
+
+        # One pooled HTTP session and one UDPTracker per url serve every torrent's announces
+        self.http_session = requests.Session()
+        self.udp_trackers = {}
+
+        # A DHT node (BEP 5) on the UDP side of our port finds peers without trackers. Its routing
+        # table is kept in dht_state_path between runs
+        self.dht_enabled = dht
+        self.dht_state_path = dht_state_path
+        self.dht_bootstrap = dht_bootstrap
+        self.dht = None
+
+        # Metrics of every torrent go to the registry. Every progress_interval seconds a progress
+        # line is logged and the JSON snapshot written, the Prometheus endpoint is served on
+        # localhost at metrics_port
+        self.progress_interval = progress_interval
+        self.metrics_port = metrics_port
+        self.metrics_json = metrics_json
+        self.metrics_server = None
+        self.loop_lag = LoopLagMonitor()
+        self.background_tasks = []
+        self.last_progress = {}
+        REGISTRY.add_collector(self.collect_metrics)
+
+        self.server = None
+
+    async def start(self):
+
+        """
+        Starts listening for peers and the DHT, torrents can still be added if the port is taken
+        """
+
+        try:
+            self.server = await asyncio.start_server(self.accept_peer, port=self.port)
+        except OSError as e:
+            logger.info(f"Could not listen on port {self.port}: {e}")
+
+        if self.dht_enabled:
+            dht = DHTNode(self.port, state_path=self.dht_state_path, bootstrap_nodes=self.dht_bootstrap)
+            try:
+                await dht.start()
+                self.dht = dht
+            except OSError as e:
+                logger.info(f"Could not start the DHT on port {self.port}: {e}")
+
+        self.background_tasks.append(asyncio.create_task(self.loop_lag.run()))
+        if self.progress_interval:
+            self.background_tasks.append(asyncio.create_task(self.report_progress()))
+        if self.metrics_port:
+            self.metrics_server = MetricsServer(self.metrics_port)
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.info(f"Could not serve metrics on port {self.metrics_port}: {e}")
+                self.metrics_server = None
+
+    async def add_torrent(self, torrent_path, **options):
+
+        """
+        Adds a torrent and starts it, options are passed on to TorrentHandle. Returns its handle
+        """
+
+        handle = TorrentHandle(self, torrent_path, **options)
+        if handle.info_hash in self.torrents:
+            raise ValueError(f"{handle.name} is already in the session")
+        self.torrents[handle.info_hash] = handle
+        handle.start()
+        return handle
+
+    async def remove_torrent(self, info_hash):
+        handle = self.torrents.pop(info_hash, None)
+        if handle is not None:
+            await handle.stop()
+
+    def get_status(self):
+        return [handle.get_status() for handle in self.torrents.values()]
+
+    def collect_metrics(self, registry):
+
+        """
+        Fills in the gauges of torrents and peers from their current state
+        """
+
+        for gauge in (torrent_pieces, torrent_bytes, torrent_peers, verify_queue_depth,
+                      peer_download_rate, peer_inflight, peer_choked):
+            gauge.clear()
+
+        for handle in self.torrents.values():
+            piece_manager = handle.piece_manager
+            if piece_manager is None:
+                continue
+            name = handle.name
+            torrent_pieces.set(piece_manager.have_pieces.count(), torrent=name, state="have")
+            torrent_pieces.set(piece_manager.downloading_pieces.count(), torrent=name, state="downloading")
+            torrent_pieces.set(piece_manager.wanted_pieces.count(), torrent=name, state="wanted")
+            torrent_pieces.set(piece_manager.total_pieces, torrent=name, state="total")
+            for kind, value in piece_manager.get_transfer_stats().items():
+                torrent_bytes.set(value, torrent=name, kind=kind)
+            torrent_peers.set(len(piece_manager.peers), torrent=name)
+            verify_queue_depth.set(piece_manager.verify_queue, torrent=name)
+
+            for peer in piece_manager.peers:
+                address = f"{peer.ip}:{peer.peer_port or 0}"
+                peer_download_rate.set(round(peer.get_download_rate()), torrent=name, peer=address)
+                peer_inflight.set(len(peer.outstanding), torrent=name, peer=address)
+                peer_choked.set(int(peer.peer_choking), torrent=name, peer=address, direction="in")
+                peer_choked.set(int(peer.am_choking), torrent=name, peer=address, direction="out")
+
+        connections_used.set(self.connection_budget.used)
+        if self.dht is not None:
+            stats = self.dht.get_stats()
+            dht_nodes.set(stats["nodes"])
+            if stats["lookup latency"] is not None:
+                dht_lookup_latency.set(round(stats["lookup latency"], 3))
+
+    async def report_progress(self):
+
+        """
+        Logs a progress line per torrent and writes the JSON snapshot every progress interval
+        """
+
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            now = asyncio.get_running_loop().time()
+            for handle in self.torrents.values():
+                piece_manager = handle.piece_manager
+                if piece_manager is None or handle.state not in ("downloading", "seeding"):
+                    continue
+
+                last_time, last_downloaded, last_uploaded = self.last_progress.get(handle, (None, 0, 0))
+                self.last_progress[handle] = (now, piece_manager.downloaded, piece_manager.uploaded)
+                if last_time is None:
+                    continue
+                elapsed = now - last_time
+                down = (piece_manager.downloaded - last_downloaded) / elapsed / 1e6
+                up = (piece_manager.uploaded - last_uploaded) / elapsed / 1e6
+                have = (piece_manager.have_pieces & piece_manager.wanted_pieces).count()
+                wanted = piece_manager.wanted_pieces.count()
+                logger.info(f"{handle.name}: {100 * have / max(1, wanted):.1f}% "
+                            f"({have}/{wanted} pieces), {down:.2f} MB/s down, {up:.2f} MB/s up, "
+                            f"{len(piece_manager.peers)} peers, loop lag {self.loop_lag.lag * 1000:.0f} ms")
+
+            if self.metrics_json:
+                self.write_metrics()
+
+    def write_metrics(self):
+        try:
+            write_snapshot(self.metrics_json)
+        except OSError as e:
+            logger.info(f"Could not write metrics to {self.metrics_json}: {e}")
+
+    def set_rate_limits(self, download_rate=None, upload_rate=None, peer_download_rate=None, peer_upload_rate=None):
+        self.rate_limiter.set_rates(download_rate, upload_rate, peer_download_rate, peer_upload_rate)
+
+    async def set_max_active_downloads(self, max_active_downloads):
+        self.max_active_downloads = max_active_downloads
+        await self.notify_download_slots()
+
+    async def acquire_download_slot(self, handle):
+
+        """
+        Waits until the torrent is first in line and fewer than max_active_downloads are downloading
+        """
+
+        self.download_queue.append(handle)
+        try:
+            async with self.download_slots_changed:
+                await self.download_slots_changed.wait_for(
+                    lambda: self.download_queue[0] is handle and len(self.active_downloads) < self.max_active_downloads
+                )
+                self.active_downloads.add(handle)
+        finally:
+            self.download_queue.remove(handle)
+            await self.notify_download_slots()
+
+    def release_download_slot(self, handle):
+        if handle in self.active_downloads:
+            self.active_downloads.discard(handle)
+            asyncio.create_task(self.notify_download_slots())
+
+    async def notify_download_slots(self):
+        async with self.download_slots_changed:
+            self.download_slots_changed.notify_all()
+
+    async def accept_peer(self, reader, writer):
+
+        """
+        Handles a connection from a peer, handing it to the torrent its handshake asks for
+        """
+
+        ip = writer.get_extra_info("peername")[0]
+        try:
+            reply = await asyncio.wait_for(reader.readexactly(68), timeout=self.connect_timeout)
+        except Exception as e:
+            logger.debug(f"Error: {e} from {ip}")
+            writer.close()
+            return
+
+        handle = self.torrents.get(bytes(reply[28:48]))
+        if handle is None or not self.connection_budget.acquire():
+            writer.close()
+            return
+
+        try:
+            handshake = Handshake(
+                ip = ip,
+                port = self.port,
+                info_hash = handle.info_hash,
+                peer_id = self.peer_id,
+                timeout = self.connect_timeout
+            )
+            if await handshake.accept_peer(reader, writer, reply):
+                await handle.accept_peer(handshake, ip)
+        finally:
+            self.connection_budget.release()
+
+    async def close(self):
+
+        """
+        Stops every torrent, then releases what they shared
+        """
+
+        if self.server is not None:
+            self.server.close()
+        await asyncio.gather(*(handle.stop() for handle in self.torrents.values()))
+        if self.dht is not None:
+            self.dht.close()
+        for task in self.background_tasks:
+            task.cancel()
+        if self.metrics_json:
+            self.write_metrics()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        REGISTRY.remove_collector(self.collect_metrics)
+        for udp_tracker in self.udp_trackers.values():
+            udp_tracker.close()
+        self.http_session.close()
+        self.verify_executor.shutdown(wait=False)
@@ -0,0 +1,124 @@
+import os
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Storage:
+    def __init__(self, torrent, download_dir=""):
+        self.piece_length = torrent.get_piece_length()
+        self.download_dir = download_dir
+        self.files = []
+        self.fds = {}
+        self.created = set()
+
+        # Files the user does not want are not created. One that shares a piece with a wanted file
+        # is still created when that piece is written, holding only the bytes of that piece
+        self.skipped = set()
+
+        # Each file gets its offset in the torrent's contiguous byte stream so that piece
+        # offsets can be mapped onto the multi-file layout with a binary search
+        offset = 0
+        for file in torrent.get_file_list():
+            self.files.append({
+                "Path": os.path.join(download_dir, file["Path"]),
+                "Length": file["Length"],
+                "Offset": offset
+            })
+            offset += file["Length"]
+        self.total_length = offset
+        self.file_offsets = [file["Offset"] for file in self.files]
+
+    def set_skipped(self, skipped):
+        self.skipped = set(skipped)
+
+    def open(self):
+
+        """
+        Creates every file which is not skipped (and its folders) and sizes it to its final length
+        up front. Existing files are kept so that data already on disk is not lost
+        """
+
+        for i in range(len(self.files)):
+            if i not in self.skipped:
+                self.open_file(i)
+
+    def open_file(self, i):
+        file = self.files[i]
+        folder = os.path.dirname(file["Path"])
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        if not os.path.exists(file["Path"]):
+            self.created.add(i)
+        fd = os.open(file["Path"], os.O_RDWR | os.O_CREAT, 0o644)
+        if i not in self.skipped and os.fstat(fd).st_size != file["Length"]:
+            os.ftruncate(fd, file["Length"])
+        self.fds[i] = fd
+        return fd
+
+    def get_fd(self, i):
+        fd = self.fds.get(i)
+        if fd is None:
+            fd = self.open_file(i)
+        return fd
+
+    def is_missing(self, i):
+
+        """
+        Whether a file had no data on disk when it was opened, or was never opened and does not exist
+        """
+
+        return i in self.created or (i not in self.fds and not os.path.exists(self.files[i]["Path"]))
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+
+    def map_range(self, offset, length):
+
+        """
+        Yields (file index, offset in file, length) for every file a range of the torrent's
+        byte stream falls into
+        """
+
+        i = bisect.bisect_right(self.file_offsets, offset) - 1
+        while length > 0 and i < len(self.files):
+            file = self.files[i]
+            start = offset - file["Offset"]
+            count = min(length, file["Length"] - start)
+            if count > 0:
+                yield i, start, count
+                offset += count
+                length -= count
+            i += 1
+
+    def write_piece(self, piece_index, data):
+
+        """
+        Writes a verified piece straight to its final position in the file(s) it spans
+        """
+
+        view = memoryview(data)
+        position = 0
+        for i, start, count in self.map_range(piece_index * self.piece_length, len(data)):
+            written = 0
+            while written < count:
+                written += os.pwrite(self.get_fd(i), view[position + written:position + count], start + written)
+            position += count
+
+    def read(self, offset, length):
+
+        """
+        Reads a range of the torrent's byte stream back from disk
+        """
+
+        segments = [os.pread(self.get_fd(i), count, start) for i, start, count in self.map_range(offset, length)]
+        # Blocks within a single file, the common case when uploading, are returned without copying
+        if len(segments) == 1:
+            return segments[0]
+        return b"".join(segments)
+
+    def read_piece(self, piece_index, length):
+        return self.read(piece_index * self.piece_length, length)
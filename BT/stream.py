@@ -0,0 +1,199 @@
+import os
+import time
+import asyncio
+import logging
+import mimetypes
+
+logger = logging.getLogger(__name__)
+
+# Bytes sent at most per read, reads never cross a piece boundary either
+STREAM_CHUNK_SIZE = 262144
+
+def parse_range(header, length):
+
+    """
+    Returns the (start, end) byte range, end inclusive, of a Range header such as 'bytes=0-',
+    'bytes=100-199' or 'bytes=-500'. None means the whole file, ValueError an unsatisfiable range.
+    Only the first range of a multi-range request is served
+    """
+
+    if header is None:
+        return None
+    unit, _, ranges = header.strip().partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    first, _, last = ranges.split(",")[0].strip().partition("-")
+
+    if not first:
+        if not last.isdigit() or int(last) == 0:
+            raise ValueError(f"Unsatisfiable range {header}")
+        return max(0, length - int(last)), length - 1
+    if not first.isdigit() or (last and not last.isdigit()):
+        raise ValueError(f"Invalid range {header}")
+    start = int(first)
+    end = min(int(last), length - 1) if last else length - 1
+    if start >= length or start > end:
+        raise ValueError(f"Unsatisfiable range {header}")
+    return start, end
+
+class StreamServer:
+    def __init__(self, piece_manager, storage, file_index=None, port=8888, host="127.0.0.1",
+                 readahead=8388608, head_tail=2097152, piece_interval=1):
+
+        """
+        Serves one file of a torrent over HTTP, with Range requests, while it is being downloaded.
+        Pieces from each reader's position up to readahead bytes ahead get deadlines
+        piece_interval seconds apart, and so do the first and last head_tail bytes of the file,
+        where players look for the container's index. Reads of missing pieces wait for them to be
+        verified. By default the largest file is served, on localhost only
+        """
+
+        self.piece_manager = piece_manager
+        self.storage = storage
+        if file_index is None:
+            file_index = max(range(len(storage.files)), key=lambda i: storage.files[i]["Length"])
+        if not 0 <= file_index < len(storage.files):
+            raise ValueError(f"The torrent has no file {file_index}, it has {len(storage.files)}")
+
+        self.file = storage.files[file_index]
+        self.port = port
+        self.host = host
+        self.piece_length = piece_manager.piece_length
+        self.readahead_pieces = max(2, readahead // self.piece_length)
+        self.piece_interval = piece_interval
+        self.content_type = mimetypes.guess_type(self.file["Path"])[0] or "application/octet-stream"
+
+        # The file's first and last pieces, and the pieces at its head and tail which are wanted
+        # until they are in
+        self.first_piece = self.file["Offset"] // self.piece_length
+        self.last_piece = max(self.first_piece, (self.file["Offset"] + self.file["Length"] - 1) // self.piece_length)
+        edge_pieces = max(1, head_tail // self.piece_length)
+        self.edge_pieces = list(range(self.first_piece, min(self.first_piece + edge_pieces, self.last_piece + 1)))
+        self.edge_pieces += [piece_index for piece_index in range(max(self.first_piece, self.last_piece - edge_pieces + 1), self.last_piece + 1)
+                             if piece_index not in self.edge_pieces]
+        self.edge_deadline = None
+
+        # The next byte of the file each connection reads
+        self.positions = {}
+        self.tasks = set()
+        self.fd = None
+        self.server = None
+
+    def get_url(self):
+        return f"http://{self.host}:{self.port}/{os.path.basename(self.file['Path'])}"
+
+    async def start(self):
+        self.fd = os.open(self.file["Path"], os.O_RDONLY)
+        self.edge_deadline = time.monotonic()
+        self.update_deadlines()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"Streaming {self.file['Path']} on {self.get_url()}")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for task in list(self.tasks):
+            task.cancel()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.piece_manager.set_deadlines({})
+
+    def update_deadlines(self):
+
+        """
+        Gives the pieces ahead of every reader, and those at the file's head and tail, deadlines
+        """
+
+        now = time.monotonic()
+        deadlines = {}
+        for k, piece_index in enumerate(self.edge_pieces):
+            deadlines[piece_index] = self.edge_deadline + k * self.piece_interval
+
+        for position in self.positions.values():
+            first = (self.file["Offset"] + position) // self.piece_length
+            for k, piece_index in enumerate(range(first, min(first + self.readahead_pieces, self.last_piece + 1))):
+                deadline = now + k * self.piece_interval
+                deadlines[piece_index] = min(deadline, deadlines.get(piece_index, deadline))
+
+        self.piece_manager.set_deadlines(deadlines)
+
+    async def read(self, position, length):
+
+        """
+        Reads up to length bytes of the file from position, within one piece, once that piece is in
+        """
+
+        offset = self.file["Offset"] + position
+        piece_index = offset // self.piece_length
+        length = min(length, (piece_index + 1) * self.piece_length - offset)
+        await self.piece_manager.wait_for_piece(piece_index)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, os.pread, self.fd, length, position)
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            async with asyncio.timeout(10):
+                request = await reader.readuntil(b"\r\n\r\n")
+            await self.respond(request.decode("latin-1"), writer)
+
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+            logger.debug(f"Stream request failed: {e}")
+
+        finally:
+            self.tasks.discard(task)
+            if self.positions.pop(task, None) is not None:
+                self.update_deadlines()
+            writer.close()
+
+    async def respond(self, request, writer):
+        lines = request.split("\r\n")
+        method = lines[0].split(" ")[0]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = self.file["Length"]
+        if method not in ("GET", "HEAD"):
+            writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nAllow: GET, HEAD\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            return
+
+        try:
+            byte_range = parse_range(headers.get("range"), length)
+        except ValueError as e:
+            logger.debug(f"{e}")
+            writer.write(f"HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */{length}\r\n"
+                         f"Content-Length: 0\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            return
+
+        if byte_range is None:
+            start, end = 0, length - 1
+            status = "200 OK"
+            content_range = ""
+        else:
+            start, end = byte_range
+            status = "206 Partial Content"
+            content_range = f"Content-Range: bytes {start}-{end}/{length}\r\n"
+
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {self.content_type}\r\nAccept-Ranges: bytes\r\n"
+                     f"{content_range}Content-Length: {end - start + 1}\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        if method == "HEAD":
+            return
+
+        task = asyncio.current_task()
+        position = start
+        while position <= end:
+            self.positions[task] = position
+            self.update_deadlines()
+            data = await self.read(position, min(STREAM_CHUNK_SIZE, end - position + 1))
+            writer.write(data)
+            await writer.drain()
+            position += len(data)
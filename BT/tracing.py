@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Stages of a piece's life, in microseconds:
+#   request      a block request until its block arrived (also kept per peer)
+#   download     the first request of a piece until its last block arrived
+#   verify_wait  the piece waiting for a hashing thread
+#   hash         hashing the piece
+#   write        piece_complete, handing the piece to storage
+#   piece        the first request until the piece was written
+STAGES = ("request", "download", "verify_wait", "hash", "write", "piece")
+
+class Histogram:
+    def __init__(self, sub_bucket_bits=7):
+
+        """
+        A log-linear histogram of integer values in the manner of HdrHistogram: every power of two
+        is split into 2 ** (sub_bucket_bits - 1) buckets, so values are kept to within
+        2 ** (1 - sub_bucket_bits), 1.6% by default, at any magnitude in a few hundred counters
+        """
+
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = max(0, int(value))
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        self.counts[value >> shift << shift] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percent):
+
+        """
+        The highest value of the bucket holding the given percentile, never above the largest
+        value recorded
+        """
+
+        if not self.count:
+            return 0
+        wanted = max(1, self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= wanted:
+                shift = max(0, bucket.bit_length() - self.sub_bucket_bits)
+                return min(self.max, bucket + (1 << shift) - 1)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "min": self.min or 0,
+            "mean": round(self.total / self.count) if self.count else 0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max or 0
+        }
+
+class Tracer:
+    def __init__(self, max_events=1000000):
+
+        """
+        Records when each block and piece passes through the stages of STAGES, into a histogram
+        per stage, one per peer for block requests, and Chrome trace events. Off until start() is
+        called: call sites check enabled before calling in, so a disabled tracer costs an
+        attribute lookup per block. At most max_events trace events are kept, the histograms
+        keep counting after that
+        """
+
+        self.enabled = False
+        self.max_events = max_events
+        self.origin = time.perf_counter()
+        self.events = []
+        self.dropped_events = 0
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.peers = {}
+
+        # Start times of the blocks in flight by (peer, piece_index, offset), and of the pieces
+        # being downloaded by (piece_manager, piece_index)
+        self.blocks = {}
+        self.pieces = {}
+
+    def start(self):
+        self.enabled = True
+        self.origin = time.perf_counter()
+
+    def stop(self):
+        self.enabled = False
+
+    def now(self):
+        return time.perf_counter()
+
+    def micros(self, timestamp):
+        return round((timestamp - self.origin) * 1000000)
+
+    def add_event(self, event):
+        if len(self.events) < self.max_events:
+            self.events.append(event)
+        else:
+            self.dropped_events += 1
+
+    def add_span(self, name, category, start, end, span_id, args):
+
+        """
+        Spans of blocks and pieces overlap each other, so they go out as async begin/end pairs
+        which trace viewers lay out side by side
+        """
+
+        self.add_event({"name": name, "cat": category, "ph": "b", "id": span_id, "pid": os.getpid(),
+                        "tid": 0, "ts": self.micros(start), "args": args})
+        self.add_event({"name": name, "cat": category, "ph": "e", "id": span_id, "pid": os.getpid(),
+                        "tid": 0, "ts": self.micros(end)})
+
+    def block_requested(self, peer, piece_manager, piece_index, offset):
+        now = self.now()
+        self.blocks[(peer, piece_index, offset)] = now
+        self.pieces.setdefault((piece_manager, piece_index), now)
+
+    def block_dropped(self, peer, piece_index, offset):
+
+        """
+        A request that will not be answered: cancelled, rejected, or the peer went away
+        """
+
+        self.blocks.pop((peer, piece_index, offset), None)
+
+    def block_received(self, peer, piece_index, offset):
+        start = self.blocks.pop((peer, piece_index, offset), None)
+        if start is None:
+            return
+        end = self.now()
+        duration = round((end - start) * 1000000)
+        self.stages["request"].record(duration)
+        address = f"{peer.ip}:{peer.peer_port}" if peer.peer_port else peer.ip
+        histogram = self.peers.get(address)
+        if histogram is None:
+            histogram = self.peers[address] = Histogram()
+        histogram.record(duration)
+        self.add_span("block", "request", start, end, f"{address}:{piece_index}:{offset}",
+                      {"peer": address, "piece": piece_index, "offset": offset})
+
+    def piece_downloaded(self, piece_manager, piece_index):
+        start = self.pieces.get((piece_manager, piece_index))
+        if start is not None:
+            end = self.now()
+            self.stages["download"].record((end - start) * 1000000)
+            self.add_span("download", "piece", start, end, f"{piece_manager.name}:{piece_index}:download",
+                          {"torrent": piece_manager.name, "piece": piece_index})
+
+    def piece_verified(self, piece_manager, piece_index, queued, hashing):
+        hash_start, hash_end, thread_id = hashing
+        self.stages["verify_wait"].record((hash_start - queued) * 1000000)
+        self.stages["hash"].record((hash_end - hash_start) * 1000000)
+
+        # Hashing runs on a pool thread, where it does not overlap anything else
+        self.add_event({"name": "hash", "cat": "piece", "ph": "X", "pid": os.getpid(), "tid": thread_id,
+                        "ts": self.micros(hash_start), "dur": round((hash_end - hash_start) * 1000000),
+                        "args": {"torrent": piece_manager.name, "piece": piece_index}})
+
+    def piece_written(self, piece_manager, piece_index, start):
+        end = self.now()
+        self.stages["write"].record((end - start) * 1000000)
+        self.add_span("write", "piece", start, end, f"{piece_manager.name}:{piece_index}:write",
+                      {"torrent": piece_manager.name, "piece": piece_index})
+
+        piece_start = self.pieces.pop((piece_manager, piece_index), None)
+        if piece_start is not None:
+            self.stages["piece"].record((end - piece_start) * 1000000)
+
+    def piece_failed(self, piece_manager, piece_index):
+        self.pieces.pop((piece_manager, piece_index), None)
+
+    def piece_aborted(self, piece_manager, piece_index):
+
+        """
+        A piece went back to the picker after a choke or disconnect, the time until it is requested
+        again is not part of its download
+        """
+
+        self.pieces.pop((piece_manager, piece_index), None)
+
+    def get_summary(self):
+
+        """
+        Percentiles in microseconds of each stage and of each peer's block requests, peers by ip:port
+        """
+
+        return {
+            "stages": {stage: histogram.summary() for stage, histogram in self.stages.items()},
+            "peers": {ip: histogram.summary() for ip, histogram in sorted(self.peers.items())}
+        }
+
+    def log_summary(self):
+        for stage, histogram in self.stages.items():
+            if histogram.count:
+                summary = histogram.summary()
+                logger.info(f"{stage:>12}: {summary['count']} samples, p50 {summary['p50'] / 1000:.1f} ms, "
+                            f"p90 {summary['p90'] / 1000:.1f} ms, p99 {summary['p99'] / 1000:.1f} ms, "
+                            f"max {summary['max'] / 1000:.1f} ms")
+
+    def write(self, path):
+
+        """
+        Writes the events in the Chrome trace event format, for chrome://tracing or Perfetto. The
+        histogram summaries go along under otherData
+        """
+
+        metadata = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": "BitTorrent client"}}]
+        trace = {
+            "traceEvents": metadata + self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {"dropped_events": self.dropped_events, "latency_us": self.get_summary()}
+        }
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(trace, f)
+        os.replace(temp_path, path)
+
+# The tracer the client's modules report to, like metrics.REGISTRY
+TRACER = Tracer()
+
+def timed_hash(hash_function, data):
+
+    """
+    Runs hash_function(data) and returns its result with the times hashing started and ended, and
+    the thread it ran on
+    """
+
+    start = time.perf_counter()
+    result = hash_function(data)
+    return result, (start, time.perf_counter(), threading.get_ident())
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, thread_id=None):
+
+        """
+        Samples the stack of one thread (by default the calling one, which runs the event loop)
+        every interval seconds from a background thread. Unlike cProfile it does not slow down
+        the code it watches, and it also shows where time goes while the loop waits
+        """
+
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.sample, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+
+    def sample(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def write(self, path):
+
+        """
+        Writes the samples as collapsed stacks, one 'frame;frame;frame count' line per stack, the
+        input of flamegraph.pl, speedscope and the like
+        """
+
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
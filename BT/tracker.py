@@ -1,15 +1,32 @@
-import logging 
+import time
+import random
+import asyncio
+import logging
 import urllib.parse
 import requests
-import bencodepy
-import socket 
+import bencoding
+import socket
 import struct
+from udp_tracker import UDPTracker
+from metrics import REGISTRY
 
 logger = logging.getLogger(__name__)
 
+announces = REGISTRY.counter("bt_tracker_announces_total", "Announces by tracker and result")
+announce_seconds = REGISTRY.gauge("bt_tracker_announce_seconds", "Duration of the last announce to a tracker")
+announce_peers = REGISTRY.gauge("bt_tracker_peers", "Number of peers the last announce to a tracker returned")
+
+class TrackerError(Exception):
+    pass
+
 class Tracker:
-    def __init__(self, announce_url, info_hash, peer_id, port, file_length , http):
-        self.announce = announce_url
+    def __init__(self, announce_list, info_hash, peer_id, port, file_length, http_session=None, timeout=15,
+                 udp_trackers=None, udp_timeout=3, udp_retries=2, udp_deadline=15):
+        # BEP 12: trackers are tried tier by tier, in random order within a tier
+        self.tiers = [list(tier) for tier in announce_list]
+        for tier in self.tiers:
+            random.shuffle(tier)
+
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.port = port
@@ -17,51 +34,220 @@ class Tracker:
         self.uploaded = 0
         self.left = file_length
         self.compact = 1
-        self.http = http
+        self.timeout = timeout
+
+        # One pooled HTTP session keeps connections to trackers alive between announces
+        self.http_session = http_session or requests.Session()
+
+        # UDP trackers by url, they cache their connection id between announces. While there are
+        # other trackers to fail over to, a UDP announce gets udp_retries retransmits starting
+        # after udp_timeout seconds and gives up after udp_deadline seconds. A lone tracker gets
+        # the full BEP 15 backoff
+        self.udp_trackers = udp_trackers if udp_trackers is not None else {}
+        # A session shares its HTTP session and UDP trackers between torrents and closes them
+        # itself, close() only releases those made here
+        self.owns_http_session = http_session is None
+        self.owns_udp_trackers = udp_trackers is None
+        self.udp_timeout = udp_timeout
+        self.udp_retries = udp_retries
+        self.udp_deadline = udp_deadline
+        self.tracker_count = sum(len(tier) for tier in self.tiers)
+
+        self.interval = 1800
+        self.min_interval = 60
+        self.failures = 0
+        self.last_announce = 0
+        self.wakeup = asyncio.Event()
 
     def get_encoded_info_hash(self):
         return urllib.parse.quote_from_bytes(self.info_hash)
 
     def get_encoded_peer_id(self):
         return urllib.parse.quote_from_bytes(self.peer_id.encode("utf-8"))
-    
-    def get_parameters(self):
-        return {
+
+    def get_parameters(self, event=None):
+        parameters = {
             "info_hash": self.get_encoded_info_hash(),
-            "peer_id": self.get_encoded_peer_id(),  
+            "peer_id": self.get_encoded_peer_id(),
             "port": self.port,
-            "uploaded": 0,
-            "downloaded": 0,
+            "uploaded": self.uploaded,
+            "downloaded": self.downloaded,
             "left": self.left,
-            "compact": 1,
-            "event": "started"
+            "compact": self.compact
         }
-    
-    def send_request(self):
+        if event:
+            parameters["event"] = event
+        return parameters
+
+    def update_stats(self, uploaded, downloaded, left):
+        self.uploaded = uploaded
+        self.downloaded = downloaded
+        self.left = left
+
+    def send_request(self, announce_url, event=None):
+
+        """
+        Request peer list from an HTTP tracker
+        """
+
+        param = urllib.parse.urlencode(self.get_parameters(event), safe="%_")
+        separator = "&" if "?" in announce_url else "?"
+        tracker_url = announce_url + separator + param
+        r = self.http_session.get(tracker_url, timeout=self.timeout)
+        r.raise_for_status()
+        response = bencoding.decode(r.content)
+
+        if b'failure reason' in response:
+            raise TrackerError(response[b'failure reason'].decode('utf-8', 'replace'))
+
+        self.interval = int(response.get(b'interval', self.interval))
+        self.min_interval = int(response.get(b'min interval', min(self.min_interval, self.interval)))
+        return self.decode_peer_list(response.get(b'peers', b''))
+
+    async def send_udp_request(self, announce_url, event=None):
+
+        """
+        Request peer list from a UDP tracker (BEP 15)
+        """
+
+        if announce_url not in self.udp_trackers:
+            self.udp_trackers[announce_url] = UDPTracker(announce_url)
+        udp_tracker = self.udp_trackers[announce_url]
+
+        if self.tracker_count > 1:
+            async with asyncio.timeout(self.udp_deadline):
+                response = await udp_tracker.announce(self.info_hash, self.peer_id, self.port, self.uploaded,
+                                                      self.downloaded, self.left, event, base_timeout=self.udp_timeout,
+                                                      max_retries=self.udp_retries)
+        else:
+            response = await udp_tracker.announce(self.info_hash, self.peer_id, self.port, self.uploaded,
+                                                  self.downloaded, self.left, event)
+        self.interval = response["interval"] or self.interval
+        self.min_interval = min(self.min_interval, self.interval)
+        return self.decode_peer_list(response["peers"])
+
+    async def announce_to(self, announce_url, event=None):
+        if announce_url.startswith("http"):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.send_request, announce_url, event)
+        if announce_url.startswith("udp"):
+            return await self.send_udp_request(announce_url, event)
+        raise TrackerError(f"Unsupported tracker protocol: {announce_url}")
+
+    def close(self):
+        if self.owns_udp_trackers:
+            for udp_tracker in self.udp_trackers.values():
+                udp_tracker.close()
+        if self.owns_http_session:
+            self.http_session.close()
+
+    async def announce(self, event=None):
+
+        """
+        Announces to the first tracker that answers, trying tiers in order. A tracker that
+        answers is moved to the front of its tier. Returns the list of peers it sent
+        """
+
+        self.last_announce = time.monotonic()
+        if not self.tiers:
+            # Trackerless torrents find their peers through the DHT
+            return []
+
+        for tier in self.tiers:
+            for announce_url in list(tier):
+                start = time.monotonic()
+                try:
+                    peers = await self.announce_to(announce_url, event)
+                except Exception as e:
+                    logger.debug(f"Announce to {announce_url} failed: {e}")
+                    announces.inc(tracker=announce_url, result="error")
+                    continue
+                finally:
+                    announce_seconds.set(round(time.monotonic() - start, 3), tracker=announce_url)
+
+                announces.inc(tracker=announce_url, result="ok")
+                announce_peers.set(len(peers), tracker=announce_url)
+
+                tier.remove(announce_url)
+                tier.insert(0, announce_url)
+                self.failures = 0
+                logger.debug(f"{announce_url} returned {len(peers)} peers, next announce in {self.interval}s")
+                return peers
+
+        self.failures += 1
+        logger.info("No tracker could be reached")
+        return []
+
+    def request_announce(self):
+
+        """
+        Asks the announce loop to announce again as soon as min interval allows
+        """
+
+        self.wakeup.set()
+
+    def next_announce_delay(self):
+        if self.failures:
+            # Back off while every tracker is failing, without going beyond the regular interval
+            return min(self.interval, 30 * 2 ** (self.failures - 1))
+        return self.interval
+
+    async def run(self, on_peers, get_stats=None, initial_event=None):
 
         """
-        Request peer list from tracker
+        Re-announces every interval (or earlier on request, but never before min interval)
+        with up to date transfer stats, and hands the returned peers to on_peers. With an
+        initial_event, e.g. started, it announces that first
         """
 
-        param = Tracker.get_parameters(self)
-        param = urllib.parse.urlencode(param, safe="%_")    
-        tracker_url = self.announce + "?" + param
-        r = requests.get(tracker_url)
-        encoded_return_info = bencodepy.decode(r.content)
-        return encoded_return_info[b'peers']
-        
+        # Requests made while an announce is in flight are kept for the next pass
+        self.wakeup.clear()
+        if initial_event is not None:
+            peers = await self.announce(initial_event)
+            logger.debug(f"Peers from the {initial_event} announce: {peers}")
+            if peers:
+                on_peers(peers)
+
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.next_announce_delay())
+                await asyncio.sleep(max(0, self.last_announce + self.min_interval - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            if get_stats is not None:
+                self.update_stats(**get_stats())
+            peers = await self.announce()
+            if peers:
+                on_peers(peers)
+
+    async def stop(self, event="stopped", get_stats=None, timeout=5):
+
+        """
+        Sends a final completed/stopped announce, failures are ignored. It is a courtesy to the
+        tracker, so it gets only a few seconds
+        """
+
+        if get_stats is not None:
+            self.update_stats(**get_stats())
+        try:
+            async with asyncio.timeout(timeout):
+                await self.announce(event)
+        except asyncio.TimeoutError:
+            logger.debug(f"Announce of {event} timed out")
+
     def decode_peer_list(self, encoded_peer):
         list_of_peers = []
-        for i in range(0, len(encoded_peer), 6):
+
+        # Non-compact trackers send a list of dicts instead of 6-byte entries
+        if isinstance(encoded_peer, list):
+            for peer in encoded_peer:
+                list_of_peers.append((peer[b'ip'].decode('utf-8'), int(peer[b'port'])))
+            return list_of_peers
+
+        for i in range(0, len(encoded_peer) - 5, 6):
             ip = socket.inet_ntoa(encoded_peer[i:i+4])
             tracker_port = struct.unpack(">H", encoded_peer[i+4:i+6])[0]
             list_of_peers.append((ip,tracker_port))
-        return list_of_peers 
-    
-
-
-        
-        
-        
-    
-
+        return list_of_peers
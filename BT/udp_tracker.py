@@ -0,0 +1,184 @@
+import time
+import random
+import struct
+import asyncio
+import logging
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# BEP 15 constants
+PROTOCOL_ID = 0x41727101980
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+EVENTS = {None: 0, "completed": 1, "started": 2, "stopped": 3}
+
+class UDPTrackerError(Exception):
+    pass
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        # Transaction id -> future waiting for the matching response
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        transaction_id = struct.unpack(">I", data[4:8])[0]
+        future = self.pending.pop(transaction_id, None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+
+        """
+        ICMP errors, e.g. port unreachable when nothing listens, fail the waiting requests at once
+        instead of leaving them to time out and retransmit
+        """
+
+        logger.debug(f"UDP tracker socket error: {exc}")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("UDP tracker socket closed"))
+        self.pending.clear()
+
+class UDPTracker:
+    def __init__(self, announce_url, base_timeout=15, max_retries=8, connection_id_ttl=60):
+        parsed = urllib.parse.urlparse(announce_url)
+        self.announce_url = announce_url
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+
+        # Retransmit after base_timeout * 2^n seconds, n = 0..max_retries (BEP 15 uses 15s and 8).
+        # Both can be lowered per request, for trackers with alternatives to fail over to
+        self.base_timeout = base_timeout
+        self.max_retries = max_retries
+
+        # A connection id may be reused for one minute after it was received
+        self.connection_id_ttl = connection_id_ttl
+        self.connection_id = None
+        self.connection_time = 0
+
+        self.protocol = None
+        self.key = random.getrandbits(32)
+
+    async def open(self):
+        if self.protocol is not None and self.protocol.transport is not None and not self.protocol.transport.is_closing():
+            return
+        loop = asyncio.get_running_loop()
+        _, self.protocol = await loop.create_datagram_endpoint(UDPTrackerProtocol, remote_addr=(self.host, self.port))
+
+    def close(self):
+        if self.protocol is not None and self.protocol.transport is not None:
+            self.protocol.transport.close()
+        self.protocol = None
+
+    async def transact(self, action, body=b"", base_timeout=None, max_retries=None):
+
+        """
+        Sends a request and waits for the response with the same transaction id, retransmitting
+        with exponential backoff. Requests other than connect first make sure we hold a valid
+        connection id, which can expire while we are retransmitting
+        """
+
+        if base_timeout is None:
+            base_timeout = self.base_timeout
+        if max_retries is None:
+            max_retries = self.max_retries
+
+        await self.open()
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(max_retries + 1):
+            if action == ACTION_CONNECT:
+                header = struct.pack(">Q", PROTOCOL_ID)
+            else:
+                await self.connect(base_timeout, max_retries)
+                header = struct.pack(">Q", self.connection_id)
+
+            transaction_id = random.getrandbits(32)
+            future = loop.create_future()
+            self.protocol.pending[transaction_id] = future
+            self.protocol.transport.sendto(header + struct.pack(">II", action, transaction_id) + body)
+
+            try:
+                async with asyncio.timeout(base_timeout * 2 ** attempt):
+                    data = await future
+            except asyncio.TimeoutError:
+                logger.debug(f"No response from {self.announce_url}, retransmitting (attempt {attempt + 1})")
+                continue
+            finally:
+                self.protocol.pending.pop(transaction_id, None)
+
+            response_action = struct.unpack(">I", data[:4])[0]
+            if response_action == ACTION_ERROR:
+                raise UDPTrackerError(data[8:].decode("utf-8", "replace"))
+            if response_action != action:
+                raise UDPTrackerError(f"Expected action {action} from {self.announce_url}, got {response_action}")
+            return data
+
+        raise UDPTrackerError(f"{self.announce_url} did not respond")
+
+    async def connect(self, base_timeout=None, max_retries=None):
+
+        """
+        Obtains a connection id, reusing the cached one while it is still valid
+        """
+
+        if self.connection_id is not None and time.monotonic() - self.connection_time < self.connection_id_ttl:
+            return
+
+        data = await self.transact(ACTION_CONNECT, base_timeout=base_timeout, max_retries=max_retries)
+        if len(data) < 16:
+            raise UDPTrackerError(f"Short connect response from {self.announce_url}")
+        self.connection_id = struct.unpack(">Q", data[8:16])[0]
+        self.connection_time = time.monotonic()
+
+    async def announce(self, info_hash, peer_id, port, uploaded, downloaded, left, event=None, num_want=-1,
+                       base_timeout=None, max_retries=None):
+
+        """
+        Returns the announce response as a dict with interval, leechers, seeders and compact peers
+        """
+
+        body = (info_hash + peer_id.encode("utf-8") +
+                struct.pack(">QQQIIIiH", downloaded, left, uploaded, EVENTS.get(event, 0), 0, self.key, num_want, port))
+        data = await self.transact(ACTION_ANNOUNCE, body, base_timeout, max_retries)
+        if len(data) < 20:
+            raise UDPTrackerError(f"Short announce response from {self.announce_url}")
+
+        interval, leechers, seeders = struct.unpack(">III", data[8:20])
+        return {
+            "interval": interval,
+            "leechers": leechers,
+            "seeders": seeders,
+            "peers": data[20:]
+        }
+
+    async def scrape(self, info_hashes, base_timeout=None, max_retries=None):
+
+        """
+        Returns seeders, completed and leechers for each info hash, in order
+        """
+
+        data = await self.transact(ACTION_SCRAPE, b"".join(info_hashes), base_timeout, max_retries)
+        results = []
+        for i in range(len(info_hashes)):
+            entry = data[8 + i * 12: 20 + i * 12]
+            if len(entry) < 12:
+                break
+            seeders, completed, leechers = struct.unpack(">III", entry)
+            results.append({"seeders": seeders, "completed": completed, "leechers": leechers})
+        return results
@@ -0,0 +1,414 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import struct
+import asyncio
+import hashlib
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "BT")
+sys.path.insert(0, BT_DIR)
+
+import bencoding
+
+logger = logging.getLogger(__name__)
+
+# random.randbytes overflows at 256 MiB, larger torrents are generated in pieces of this size
+DATA_CHUNK_SIZE = 64 * 2 ** 20
+
+class Swarm:
+    def __init__(self, size, piece_length, file_count, seed=0):
+
+        """
+        A synthetic torrent of size bytes split over file_count files, with random contents
+        """
+
+        rng = random.Random(seed)
+        self.data = bytearray()
+        for offset in range(0, size, DATA_CHUNK_SIZE):
+            self.data += rng.randbytes(min(DATA_CHUNK_SIZE, size - offset))
+        self.piece_length = piece_length
+        self.total_pieces = (size + piece_length - 1) // piece_length
+        self.info_hash = None
+
+        # Files of roughly equal size, the last one takes the remainder
+        self.files = []
+        file_size = size // file_count
+        for i in range(file_count):
+            length = file_size if i < file_count - 1 else size - file_size * (file_count - 1)
+            self.files.append((f"file{i}.bin", length))
+
+    def write_torrent(self, path, announce):
+        data = memoryview(self.data)
+        pieces = b"".join(hashlib.sha1(data[i:i + self.piece_length]).digest()
+                          for i in range(0, len(data), self.piece_length))
+        if len(self.files) == 1:
+            info = {b"name": self.files[0][0], b"length": len(self.data)}
+        else:
+            info = {b"name": b"bench", b"files": [{b"length": length, b"path": [name]} for name, length in self.files]}
+        info[b"piece length"] = self.piece_length
+        info[b"pieces"] = pieces
+
+        raw_info = bencoding.encode(info)
+        self.info_hash = hashlib.sha1(raw_info).digest()
+        with open(path, "wb") as f:
+            f.write(bencoding.encode({b"announce": announce, b"info": bencoding.RawValue(raw_info, 0, len(raw_info))}))
+
+    def verify(self, download_dir):
+
+        """
+        Returns True if the downloaded files hold exactly the torrent's data
+        """
+
+        # The client puts the files of multi-file torrents straight into the download directory
+        offset = 0
+        for name, length in self.files:
+            try:
+                with open(os.path.join(download_dir, name), "rb") as f:
+                    if f.read() != self.data[offset:offset + length]:
+                        return False
+            except FileNotFoundError:
+                return False
+            offset += length
+        return True
+
+class Link:
+    def __init__(self, latency=0, bandwidth=0, loss=0, rto=0.2, rng=None):
+        # One direction of an emulated network path: every message arrives latency seconds after
+        # it went out, the link carries bandwidth bytes per second (0 is unlimited) and a message
+        # is lost with probability loss, arriving one retransmission timeout later. Messages stay
+        # in order, as on TCP a lost one holds up those behind it
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.rto = rto
+        self.rng = rng or random.Random()
+        self.busy_until = 0
+        self.queue = deque()
+
+    def arrival(self, size):
+        now = asyncio.get_running_loop().time()
+        sent = now
+        if self.bandwidth:
+            sent = max(now, self.busy_until) + size / self.bandwidth
+            self.busy_until = sent
+        arrival = sent + self.latency
+        if self.loss and self.rng.random() < self.loss:
+            arrival += self.rto
+        if self.queue:
+            arrival = max(arrival, self.queue[-1][0])
+        return arrival
+
+    def send(self, writer, message):
+        if not (self.latency or self.bandwidth or self.loss):
+            writer.write(message)
+            return
+        self.queue.append((self.arrival(len(message)), message))
+        if len(self.queue) == 1:
+            asyncio.get_running_loop().call_at(self.queue[0][0], self.deliver, writer)
+
+    def deliver(self, writer):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        while self.queue and self.queue[0][0] <= now:
+            _, message = self.queue.popleft()
+            if not writer.is_closing():
+                writer.write(message)
+        if self.queue:
+            loop.call_at(self.queue[0][0], self.deliver, writer)
+
+class StandInPeer:
+    def __init__(self, swarm, stats, has_all=True, latency=0, bandwidth=0, loss=0, rto=0.2, seed=0):
+
+        """
+        A minimal peer on localhost. Seeders serve every request through an emulated link. A
+        peer without pieces stays interested in the client, so that the client tells it about
+        every piece it completes, which times the download from the outside
+        """
+
+        self.swarm = swarm
+        self.stats = stats
+        self.has_all = has_all
+        self.link_options = (latency, bandwidth, loss, rto)
+        self.rng = random.Random(seed)
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self.server.close()
+
+    async def handle(self, reader, writer):
+        latency, bandwidth, loss, rto = self.link_options
+        link = Link(latency, bandwidth, loss, rto, self.rng)
+        swarm = self.swarm
+        data = memoryview(swarm.data)
+        try:
+            handshake = await reader.readexactly(68)
+            if handshake[28:48] != swarm.info_hash:
+                return
+            self.stats.connected()
+            writer.write(bytes([19]) + b"BitTorrent protocol" + bytes(8) + swarm.info_hash + b"-BENCH0-" + os.urandom(6).hex().encode())
+
+            bitfield = bytearray((swarm.total_pieces + 7) // 8)
+            if self.has_all:
+                for i in range(swarm.total_pieces):
+                    bitfield[i // 8] |= 0x80 >> (i % 8)
+            writer.write(struct.pack(">IB", 1 + len(bitfield), 5) + bitfield)
+            if not self.has_all:
+                writer.write(struct.pack(">IB", 1, 2))
+
+            while True:
+                length = struct.unpack(">I", await reader.readexactly(4))[0]
+                if length == 0:
+                    continue
+                message = await reader.readexactly(length)
+
+                if message[0] == 2 and self.has_all:
+                    link.send(writer, struct.pack(">IB", 1, 1))
+                elif message[0] == 4 and length >= 5:
+                    self.stats.have(struct.unpack(">I", message[1:5])[0])
+                elif message[0] == 6 and self.has_all and length >= 13:
+                    index, offset, block_length = struct.unpack(">III", message[1:13])
+                    start = index * swarm.piece_length + offset
+                    block = data[start:start + block_length]
+                    link.send(writer, struct.pack(">IBII", 9 + len(block), 7, index, offset) + block)
+                    self.stats.uploaded += len(block)
+                await writer.drain()
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        finally:
+            writer.close()
+
+class SwarmStats:
+    def __init__(self, total_pieces):
+        self.total_pieces = total_pieces
+        self.first_connection = None
+        self.first_piece = None
+        self.last_piece = None
+        self.pieces = set()
+        self.uploaded = 0
+
+    def connected(self):
+        if self.first_connection is None:
+            self.first_connection = time.monotonic()
+
+    def have(self, piece_index):
+        now = time.monotonic()
+        if self.first_piece is None:
+            self.first_piece = now
+        self.pieces.add(piece_index)
+        if len(self.pieces) == self.total_pieces:
+            self.last_piece = now
+
+def run_tracker(peers):
+
+    """
+    A local HTTP tracker answering every announce with the stand-in peers
+    """
+
+    body = bencoding.encode({
+        b"interval": 1800,
+        b"peers": b"".join(socket.inet_aton("127.0.0.1") + struct.pack(">H", port) for port in peers)
+    })
+
+    class TrackerHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TrackerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def run_case(size, piece_length, file_count, args):
+
+    """
+    Downloads one synthetic torrent from the stand-in seeders with the real client, in a child
+    process so that its CPU time and peak memory are its own
+    """
+
+    swarm = Swarm(size, piece_length, file_count, seed=args.seed)
+    stats = SwarmStats(swarm.total_pieces)
+    workdir = tempfile.mkdtemp(prefix="bt-bench-")
+
+    peers = [StandInPeer(swarm, stats, True, args.latency / 1000, args.bandwidth * 1024, args.loss, args.rto / 1000, seed=args.seed + i)
+             for i in range(args.seeders)]
+    peers.append(StandInPeer(swarm, stats, has_all=False))
+    for peer in peers:
+        await peer.start()
+    tracker = run_tracker([peer.port for peer in peers])
+
+    try:
+        swarm.write_torrent(os.path.join(workdir, "bench.torrent"), f"http://127.0.0.1:{tracker.server_address[1]}/announce")
+        usage_path = os.path.join(workdir, "usage.json")
+        client_args = ["bench.torrent", "--port", str(get_free_port()), "--no-dht", *args.client_args]
+
+        start = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--client", usage_path, "--", *client_args,
+            cwd=workdir, stdout=asyncio.subprocess.DEVNULL, stderr=None if args.verbose else asyncio.subprocess.DEVNULL
+        )
+        try:
+            async with asyncio.timeout(args.timeout):
+                await process.wait()
+        except TimeoutError:
+            process.kill()
+            await process.wait()
+        wall = time.monotonic() - start
+
+        try:
+            with open(usage_path) as f:
+                usage = json.load(f)
+        except FileNotFoundError:
+            usage = {"cpu_seconds": None, "peak_rss_bytes": None}
+
+        # The swarm time runs from the first connection to the last have, without interpreter
+        # start up, checking and the tracker announce
+        end = stats.last_piece or (start + wall)
+        swarm_seconds = end - (stats.first_connection or start)
+        cpu = usage["cpu_seconds"]
+        return {
+            "size_bytes": size,
+            "piece_length": piece_length,
+            "files": file_count,
+            "seeders": args.seeders,
+            "latency_ms": args.latency,
+            "bandwidth_kib": args.bandwidth,
+            "loss": args.loss,
+            "ok": process.returncode == 0 and swarm.verify(workdir),
+            "wall_seconds": round(wall, 3),
+            "swarm_seconds": round(swarm_seconds, 3),
+            "mb_per_s": round(size / 1e6 / swarm_seconds, 2) if swarm_seconds > 0 else None,
+            "time_to_first_piece": round(stats.first_piece - stats.first_connection, 3) if stats.first_piece else None,
+            "cpu_seconds": cpu,
+            "cpu_seconds_per_gb": round(cpu / (size / 1e9), 2) if cpu is not None else None,
+            "peak_rss_mib": round(usage["peak_rss_bytes"] / 2 ** 20, 1) if usage["peak_rss_bytes"] else None,
+            "seeded_bytes": stats.uploaded
+        }
+
+    finally:
+        tracker.shutdown()
+        for peer in peers:
+            peer.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_client(usage_path, client_args):
+
+    """
+    Runs the client's own main() in this process, then records the CPU time and peak RSS it used.
+    Returns main()'s exit status, non-zero when a torrent failed
+    """
+
+    import main
+    sys.argv = ["main.py", *client_args]
+    args = main.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    status = asyncio.run(main.main(args))
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    with open(usage_path, "w") as f:
+        json.dump({
+            "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+            "peak_rss_bytes": get_peak_rss()
+        }, f)
+    return status
+
+def get_peak_rss():
+
+    """
+    Peak resident set size of this process in bytes. On Linux ru_maxrss survives exec, so it would
+    include the benchmark process which started us and holds the torrent's data. VmHWM does not
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="Downloads synthetic torrents from stand-in seeders on localhost and reports throughput")
+    arg_parser.add_argument("--sizes", type=float, nargs="+", default=[16, 64], help="torrent sizes in MiB")
+    arg_parser.add_argument("--piece-lengths", type=int, nargs="+", default=[256], help="piece lengths in KiB")
+    arg_parser.add_argument("--file-counts", type=int, nargs="+", default=[1], help="number of files per torrent")
+    arg_parser.add_argument("--seeders", type=int, default=4, help="number of stand-in seeders")
+    arg_parser.add_argument("--latency", type=float, default=0, help="one way latency of each seeder in ms")
+    arg_parser.add_argument("--bandwidth", type=int, default=0, help="upload rate of each seeder in KiB/s, 0 for unlimited")
+    arg_parser.add_argument("--loss", type=float, default=0, help="fraction of messages lost and retransmitted")
+    arg_parser.add_argument("--rto", type=float, default=200, help="retransmission timeout of lost messages in ms")
+    arg_parser.add_argument("--repeat", type=int, default=1, help="runs of every case")
+    arg_parser.add_argument("--timeout", type=float, default=600, help="seconds after which a download is given up")
+    arg_parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data and losses")
+    arg_parser.add_argument("--output", help="file to write the JSON report to, standard output by default")
+    arg_parser.add_argument("--verbose", action="store_true", help="show the client's output")
+    arg_parser.add_argument("--client-args", nargs=argparse.REMAINDER, default=[], help="options passed on to the client, must come last")
+    return arg_parser.parse_args()
+
+async def main(args):
+    results = []
+    for size in args.sizes:
+        for piece_length in args.piece_lengths:
+            for file_count in args.file_counts:
+                for _ in range(args.repeat):
+                    result = await run_case(int(size * 2 ** 20), piece_length * 1024, file_count, args)
+                    logger.info(f"{size:g} MiB, {piece_length} KiB pieces, {file_count} files: "
+                                f"{result['mb_per_s']} MB/s, first piece after {result['time_to_first_piece']}s, "
+                                f"{result['cpu_seconds_per_gb']} CPU s/GB, {result['peak_rss_mib']} MiB peak RSS"
+                                f"{'' if result['ok'] else ' (FAILED)'}")
+                    results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return all(result["ok"] for result in results)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--client":
+        separator = sys.argv.index("--") if "--" in sys.argv else 2
+        sys.exit(run_client(sys.argv[2], sys.argv[separator + 1:]))
+
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    sys.exit(0 if asyncio.run(main(args)) else 1)
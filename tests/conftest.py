@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The client's modules import each other without a package prefix, as when main.py is run
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "BT"))
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import pytest
+
+import bencoding
+from dht import DHTNode, DHTError
+
+INFO_HASH = hashlib.sha1(b"test torrent").digest()
+
+async def start_network(count=12, **options):
+
+    """
+    Starts count nodes on localhost, all bootstrapping from the first, and waits until each has
+    filled its routing table
+    """
+
+    first = DHTNode(0, bootstrap_nodes=[], query_timeout=0.5, **options)
+    await first.start()
+    address = ("127.0.0.1", first.transport.get_extra_info("sockname")[1])
+
+    nodes = [first]
+    for _ in range(count - 1):
+        node = DHTNode(0, bootstrap_nodes=[address], query_timeout=0.5, **options)
+        await node.start()
+        nodes.append(node)
+    async with asyncio.timeout(10):
+        await asyncio.gather(*(node.ready.wait() for node in nodes))
+    return nodes
+
+def get_address(node):
+    return "127.0.0.1", node.transport.get_extra_info("sockname")[1]
+
+def close_network(nodes):
+    for node in nodes:
+        node.close()
+
+def test_nodes_find_each_other():
+    async def run():
+        nodes = await start_network()
+        try:
+            # Nodes which joined late only know the network through the bootstrap node's answers
+            # and their own lookups, yet every one of them knows several others
+            assert all(len(node.table) >= 3 for node in nodes)
+        finally:
+            close_network(nodes)
+
+    asyncio.run(run())
+
+def test_announce_then_get_peers():
+    async def run():
+        nodes = await start_network()
+        try:
+            await nodes[3].announce(INFO_HASH, 7000)
+            assert any(INFO_HASH in node.stored_peers for node in nodes)
+
+            found = []
+            await nodes[9].lookup(INFO_HASH, get_peers=True, on_peers=found.extend)
+            assert ("127.0.0.1", 7000) in found
+        finally:
+            close_network(nodes)
+
+    asyncio.run(run())
+
+def test_announce_needs_a_valid_token():
+    async def run():
+        nodes = await start_network(count=2)
+        querier, storer = nodes
+        try:
+            with pytest.raises(DHTError, match="Bad token"):
+                await querier.query(get_address(storer), b"announce_peer",
+                                    {b"info_hash": INFO_HASH, b"port": 7000, b"token": b"forged"})
+            assert INFO_HASH not in storer.stored_peers
+
+            response = await querier.query(get_address(storer), b"get_peers", {b"info_hash": INFO_HASH})
+            await querier.query(get_address(storer), b"announce_peer",
+                                {b"info_hash": INFO_HASH, b"port": 7000, b"token": response[b"token"]})
+            assert list(storer.stored_peers[INFO_HASH]) == [("127.0.0.1", 7000)]
+
+            # Tokens are tied to the address they were handed to
+            assert response[b"token"] != storer.get_token("127.0.0.2")
+        finally:
+            close_network(nodes)
+
+    asyncio.run(run())
+
+def test_stored_peers_are_limited_per_torrent():
+    async def run():
+        nodes = await start_network(count=2, max_peers_per_torrent=3, max_torrents=2)
+        querier, storer = nodes
+        try:
+            response = await querier.query(get_address(storer), b"get_peers", {b"info_hash": INFO_HASH})
+            for port in range(7000, 7005):
+                await querier.query(get_address(storer), b"announce_peer",
+                                    {b"info_hash": INFO_HASH, b"port": port, b"token": response[b"token"]})
+
+            # The peers which announced most recently are kept
+            assert list(storer.stored_peers[INFO_HASH]) == [("127.0.0.1", port) for port in range(7002, 7005)]
+            assert len(storer.get_stored_peers(INFO_HASH)) == 3
+
+            for n in range(3):
+                storer.store_peer(hashlib.sha1(bytes([n])).digest(), "127.0.0.1", 7000)
+            assert len(storer.stored_peers) == 2
+        finally:
+            close_network(nodes)
+
+    asyncio.run(run())
+
+def test_malformed_transaction_ids_are_ignored():
+    async def run():
+        node = DHTNode(0, bootstrap_nodes=[], query_timeout=0.5)
+        await node.start()
+        loop = asyncio.get_running_loop()
+        future = node.pending[b"aa"] = loop.create_future()
+        try:
+            for transaction_id in ([b"aa"], {b"a": 1}, 7):
+                node.datagram_received(bencoding.encode({b"t": transaction_id, b"y": b"r", b"r": {}}), ("127.0.0.1", 1))
+                node.datagram_received(bencoding.encode({b"t": transaction_id, b"y": b"q", b"q": b"ping",
+                                                         b"a": {b"id": bytes(20)}}), ("127.0.0.1", 1))
+            assert not future.done()
+        finally:
+            node.close()
+
+    asyncio.run(run())
@@ -0,0 +1,48 @@
+import asyncio
+import hashlib
+import pytest
+
+import bencoding
+from metadata import MetadataFetcher, EXTENDED_HANDSHAKE_ID, UT_METADATA_ID, get_extended_message
+
+INFO_HASH = hashlib.sha1(b"test info").digest()
+
+async def fetch_from(messages):
+
+    """
+    Has a MetadataFetcher fetch from a local peer which answers its extended handshake with
+    messages, then keeps the connection open
+    """
+
+    async def handle(reader, writer):
+        await reader.read(1024)
+        for message in messages:
+            writer.write(message)
+        await writer.drain()
+        await asyncio.sleep(1)
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        fetcher = MetadataFetcher(INFO_HASH, timeout=0.5)
+        received = await fetcher.fetch_from_peer(reader, writer, "127.0.0.1")
+        writer.close()
+        return received
+    finally:
+        server.close()
+
+@pytest.mark.parametrize("handshake", [
+    bencoding.encode([b"m"]),
+    bencoding.encode({b"m": [b"ut_metadata", 2], b"metadata_size": 100}),
+    bencoding.encode({b"m": b"ut_metadata", b"metadata_size": 100}),
+])
+def test_malformed_handshake_is_a_peer_failure(handshake):
+    assert asyncio.run(fetch_from([get_extended_message(EXTENDED_HANDSHAKE_ID, handshake)])) == 0
+
+def test_metadata_message_without_piece_number_is_a_peer_failure():
+    handshake = bencoding.encode({b"m": {b"ut_metadata": UT_METADATA_ID}, b"metadata_size": 100})
+    data = bencoding.encode({b"msg_type": 1, b"piece": [0]}) + bytes(100)
+    messages = [get_extended_message(EXTENDED_HANDSHAKE_ID, handshake), get_extended_message(UT_METADATA_ID, data)]
+    assert asyncio.run(fetch_from(messages)) == 0
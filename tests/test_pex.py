@@ -0,0 +1,26 @@
+import bencoding
+
+from pex import PEX_SEED, PEX_CONNECTABLE, get_pex_message, parse_pex_message
+
+def get_payload(message):
+    return message[6:]
+
+def test_ipv4_and_ipv6_peers_round_trip():
+    added = {("10.0.0.1", 6881): PEX_SEED, ("2001:db8::1", 6882): PEX_CONNECTABLE,
+             ("10.0.0.2", 6883): 0, ("::1", 6884): PEX_SEED | PEX_CONNECTABLE}
+    dropped = [("10.0.0.3", 6885), ("2001:db8::2", 6886)]
+
+    payload = get_payload(get_pex_message(1, added, dropped))
+    message = bencoding.decode(payload)
+    assert len(message[b"added"]) == 12 and message[b"added.f"] == bytes([PEX_SEED, 0])
+    assert len(message[b"added6"]) == 36 and message[b"added6.f"] == bytes([PEX_CONNECTABLE, PEX_SEED | PEX_CONNECTABLE])
+    assert len(message[b"dropped"]) == 6 and len(message[b"dropped6"]) == 18
+
+    parsed_added, parsed_dropped = parse_pex_message(payload)
+    assert parsed_added == added
+    assert sorted(parsed_dropped) == sorted(dropped)
+
+def test_hostnames_are_left_out():
+    payload = get_payload(get_pex_message(1, {("tracker.example.org", 6881): 0, ("10.0.0.1", 6881): 0}, []))
+    added, dropped = parse_pex_message(payload)
+    assert added == {("10.0.0.1", 6881): 0} and dropped == []
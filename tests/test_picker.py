@@ -0,0 +1,47 @@
+from bitarray import bitarray
+from bitarray.util import ones, zeros
+
+from picker import PiecePicker
+
+def get_pieces(bits):
+    return bitarray(bits, endian='big')
+
+def test_seeds_do_not_touch_the_buckets():
+    picker = PiecePicker(4, random_first_pieces=0)
+    picker.add_peer(ones(4, endian='big'))
+    assert picker.seeds == 1 and picker.availability == [0, 0, 0, 0]
+    assert picker.buckets[0] == [0, 1, 2, 3]
+
+    # Pieces only the seed has are still picked, the rarest first
+    picker.add_peer(get_pieces("0111"))
+    assert picker.pick(ones(4, endian='big')) == 0
+
+    picker.remove_peer(ones(4, endian='big'))
+    assert picker.seeds == 0
+    assert picker.pick(get_pieces("1000")) is None
+
+def test_peer_completed_by_have_messages_becomes_a_seed():
+    picker = PiecePicker(4, random_first_pieces=0)
+    pieces = get_pieces("1110")
+    picker.add_peer(pieces)
+    picker.peer_has(3)
+    pieces[3] = 1
+    picker.peer_completed()
+    assert picker.seeds == 1 and picker.availability == [0, 0, 0, 0]
+
+    picker.remove_peer(pieces)
+    assert picker.seeds == 0 and picker.availability == [0, 0, 0, 0]
+
+def test_rarest_counts_seeds_and_peers_together():
+    picker = PiecePicker(3, random_first_pieces=0)
+    picker.add_peer(ones(3, endian='big'))
+    picker.add_peer(get_pieces("110"))
+    picker.add_peer(get_pieces("100"))
+    assert picker.pick(ones(3, endian='big')) == 2
+    picker.start(2)
+    assert picker.pick(ones(3, endian='big')) == 1
+
+def test_empty_torrent_picks_nothing():
+    picker = PiecePicker(0, mode="random")
+    picker.add_peer(zeros(0, endian='big'))
+    assert picker.pick(zeros(0, endian='big')) is None
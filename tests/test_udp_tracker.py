@@ -0,0 +1,229 @@
+import time
+import socket
+import struct
+import asyncio
+import pytest
+
+from udp_tracker import (UDPTracker, UDPTrackerError, PROTOCOL_ID, ACTION_CONNECT, ACTION_ANNOUNCE,
+                         ACTION_SCRAPE, ACTION_ERROR)
+from tracker import Tracker
+
+INFO_HASH = b"\x11" * 20
+PEER_ID = "-SB001-abcdefghijklm"
+PEERS = [("10.0.0.1", 6881), ("10.0.0.2", 51413)]
+
+class StandInTracker(asyncio.DatagramProtocol):
+
+    """
+    A BEP 15 tracker on localhost which hands out connection ids, answers announces with PEERS and
+    scrapes with fixed counts. It can ignore the first drop requests, to make the client retransmit,
+    and answer with an error instead
+    """
+
+    def __init__(self, drop=0, error=None):
+        self.transport = None
+        self.drop = drop
+        self.error = error
+        self.requests = []
+        self.connection_ids = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        connection_id, action, transaction_id = struct.unpack(">QII", data[:16])
+        self.requests.append((action, connection_id))
+        if self.drop:
+            self.drop -= 1
+            return
+
+        if self.error is not None:
+            self.transport.sendto(struct.pack(">II", ACTION_ERROR, transaction_id) + self.error.encode(), addr)
+        elif action == ACTION_CONNECT:
+            assert connection_id == PROTOCOL_ID
+            new_id = len(self.connection_ids) + 1000
+            self.connection_ids.add(new_id)
+            self.transport.sendto(struct.pack(">IIQ", ACTION_CONNECT, transaction_id, new_id), addr)
+        elif connection_id not in self.connection_ids:
+            self.transport.sendto(struct.pack(">II", ACTION_ERROR, transaction_id) + b"unknown connection id", addr)
+        elif action == ACTION_ANNOUNCE:
+            peers = b"".join(socket.inet_aton(ip) + struct.pack(">H", port) for ip, port in PEERS)
+            self.transport.sendto(struct.pack(">IIIII", ACTION_ANNOUNCE, transaction_id, 1800, 3, 7) + peers, addr)
+        elif action == ACTION_SCRAPE:
+            count = (len(data) - 16) // 20
+            self.transport.sendto(struct.pack(">II", ACTION_SCRAPE, transaction_id) +
+                                  struct.pack(">III", 7, 42, 3) * count, addr)
+
+    def actions(self, action):
+        return [request for request in self.requests if request[0] == action]
+
+async def start_stand_in(**options):
+    loop = asyncio.get_running_loop()
+    transport, stand_in = await loop.create_datagram_endpoint(lambda: StandInTracker(**options),
+                                                              local_addr=("127.0.0.1", 0))
+    return transport, stand_in, f"udp://127.0.0.1:{transport.get_extra_info('sockname')[1]}/announce"
+
+def closed_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def announce(udp_tracker, **options):
+    return udp_tracker.announce(INFO_HASH, PEER_ID, 6881, 0, 0, 1000, "started", **options)
+
+def test_announce_reuses_connection_id():
+    async def run():
+        transport, stand_in, url = await start_stand_in()
+        udp_tracker = UDPTracker(url, base_timeout=0.2)
+        try:
+            first = await announce(udp_tracker)
+            second = await announce(udp_tracker)
+        finally:
+            udp_tracker.close()
+            transport.close()
+
+        assert first["interval"] == 1800 and first["leechers"] == 3 and first["seeders"] == 7
+        assert len(first["peers"]) == 6 * len(PEERS)
+        assert second["interval"] == 1800
+        assert len(stand_in.actions(ACTION_CONNECT)) == 1
+        assert len(stand_in.actions(ACTION_ANNOUNCE)) == 2
+
+    asyncio.run(run())
+
+def test_connection_id_expires():
+    async def run():
+        transport, stand_in, url = await start_stand_in()
+        udp_tracker = UDPTracker(url, base_timeout=0.2, connection_id_ttl=0.1)
+        try:
+            await announce(udp_tracker)
+            first_id = udp_tracker.connection_id
+            await asyncio.sleep(0.15)
+            await announce(udp_tracker)
+        finally:
+            udp_tracker.close()
+            transport.close()
+
+        assert len(stand_in.actions(ACTION_CONNECT)) == 2
+        assert udp_tracker.connection_id != first_id
+        assert [connection_id for _, connection_id in stand_in.actions(ACTION_ANNOUNCE)] == [first_id, udp_tracker.connection_id]
+
+    asyncio.run(run())
+
+def test_lost_requests_are_retransmitted():
+    async def run():
+        transport, stand_in, url = await start_stand_in(drop=2)
+        udp_tracker = UDPTracker(url, base_timeout=0.05, max_retries=3)
+        try:
+            response = await announce(udp_tracker)
+        finally:
+            udp_tracker.close()
+            transport.close()
+
+        assert response["seeders"] == 7
+        # Both dropped requests were connects, the third went through
+        assert len(stand_in.actions(ACTION_CONNECT)) == 3
+        assert len(stand_in.actions(ACTION_ANNOUNCE)) == 1
+
+    asyncio.run(run())
+
+def test_gives_up_after_max_retries():
+    async def run():
+        transport, stand_in, url = await start_stand_in(drop=100)
+        udp_tracker = UDPTracker(url, base_timeout=0.02, max_retries=2)
+        try:
+            with pytest.raises(UDPTrackerError):
+                await announce(udp_tracker)
+            assert not udp_tracker.protocol.pending
+        finally:
+            udp_tracker.close()
+            transport.close()
+
+        assert len(stand_in.requests) == 3
+
+    asyncio.run(run())
+
+def test_scrape():
+    async def run():
+        transport, stand_in, url = await start_stand_in()
+        udp_tracker = UDPTracker(url, base_timeout=0.2)
+        try:
+            results = await udp_tracker.scrape([INFO_HASH, b"\x22" * 20])
+        finally:
+            udp_tracker.close()
+            transport.close()
+
+        assert results == [{"seeders": 7, "completed": 42, "leechers": 3}] * 2
+
+    asyncio.run(run())
+
+def test_error_response():
+    async def run():
+        transport, stand_in, url = await start_stand_in(error="torrent not registered")
+        udp_tracker = UDPTracker(url, base_timeout=0.2)
+        try:
+            with pytest.raises(UDPTrackerError, match="torrent not registered"):
+                await announce(udp_tracker)
+        finally:
+            udp_tracker.close()
+            transport.close()
+
+    asyncio.run(run())
+
+def test_port_unreachable_fails_at_once():
+    async def run():
+        udp_tracker = UDPTracker(f"udp://127.0.0.1:{closed_udp_port()}/announce", base_timeout=5)
+        start = time.monotonic()
+        try:
+            with pytest.raises(OSError):
+                await announce(udp_tracker)
+        finally:
+            udp_tracker.close()
+        assert time.monotonic() - start < 2
+
+    asyncio.run(run())
+
+def test_tracker_fails_over_to_next_tier():
+    async def run():
+        transport, stand_in, url = await start_stand_in()
+        dead = await start_stand_in(drop=100)
+        tracker = Tracker([[dead[2]], [url]], INFO_HASH, PEER_ID, 6881, 1000, udp_timeout=0.05, udp_retries=1,
+                          udp_deadline=1)
+        start = time.monotonic()
+        try:
+            peers = await tracker.announce("started")
+        finally:
+            tracker.close()
+            transport.close()
+            dead[0].close()
+
+        assert peers == PEERS
+        assert time.monotonic() - start < 2
+        assert tracker.failures == 0
+
+    asyncio.run(run())
+
+def test_announce_requested_during_initial_announce_is_kept():
+    async def run():
+        tracker = Tracker([["udp://127.0.0.1:1/announce"]], INFO_HASH, PEER_ID, 6881, 1000)
+        tracker.min_interval = 0
+        events = []
+
+        async def announce(event=None):
+            events.append(event)
+            if event == "started":
+                tracker.request_announce()
+            return []
+
+        tracker.announce = announce
+        task = asyncio.create_task(tracker.run(lambda peers: None, initial_event="started"))
+        try:
+            async with asyncio.timeout(2):
+                while len(events) < 2:
+                    await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+            tracker.close()
+
+        assert events == ["started", None]
+
+    asyncio.run(run())